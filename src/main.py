@@ -1,7 +1,8 @@
 import os
 import sys
-import threading
 import logging
+import decimal
+import orjson
 from dotenv import load_dotenv
 
 # Загружаем переменные окружения
@@ -11,11 +12,13 @@ load_dotenv()
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
 from flask import Flask, send_from_directory, jsonify
+from flask.json.provider import JSONProvider
+from sqlalchemy import event
+from werkzeug.exceptions import NotFound
 from src.models.user import db as user_db
-from src.models.template import db as template_db, Template, UserWorkflow, UserSession, ExecutionLog
+from src.models.template import db as template_db, upgrade_schema
 from src.routes.user import user_bp
 from src.routes.template import template_bp
-from src.telegram_bot import N8nTelegramBot
 
 # Настройка логирования
 logging.basicConfig(
@@ -24,7 +27,25 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def _orjson_default(obj):
+    """Сериализация типов, которые orjson не поддерживает сам"""
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    if hasattr(obj, '__html__'):
+        return str(obj.__html__())
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+class OrjsonProvider(JSONProvider):
+    """JSON-провайдер Flask на базе orjson для jsonify и request.get_json()"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
+app.json = OrjsonProvider(app)
 app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY', 'asdf#FGSgvasgf$5$WGT')
 
 # Регистрация blueprints
@@ -35,79 +56,108 @@ app.register_blueprint(template_bp, url_prefix='/api')
 database_path = os.path.join(os.path.dirname(__file__), 'database', 'app.db')
 app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{database_path}"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# SQLite допускает одного писателя на файл, а gunicorn запускает $(nproc) воркеров:
+# большой пул на воркер лишь множит соединения, ждущие одну блокировку. Небольшой
+# пул ставит greenlet'ы в очередь внутри воркера (ожидание слота уступает управление
+# gevent), а конкуренцию между воркерами за запись сглаживает busy_timeout
+SQLITE_BUSY_TIMEOUT_MS = 5000
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 4,
+    'max_overflow': 4,
+    'pool_timeout': 30,
+    'pool_pre_ping': False
+}
 
 # Инициализация баз данных
 user_db.init_app(app)
 template_db.init_app(app)
 
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL-журнал и mmap: чтения не блокируются записью, горячие страницы читаются из page cache
+    
+    busy_timeout: занятая другим процессом блокировка записи ожидается, а не
+    сразу дает "database is locked".
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
 # Создание таблиц
 with app.app_context():
+    for database in (user_db, template_db):
+        event.listen(database.engine, 'connect', _set_sqlite_pragmas)
+    
     user_db.create_all()
     template_db.create_all()
+    # Индексы и данные существующей БД приводятся к текущим моделям
+    upgrade_schema()
     logger.info("База данных инициализирована")
 
-# Глобальная переменная для бота
-telegram_bot = None
-
-def start_telegram_bot():
-    """Запуск Telegram бота в отдельном потоке"""
-    global telegram_bot
-    try:
-        telegram_bot = N8nTelegramBot()
-        logger.info("Запуск Telegram бота...")
-        telegram_bot.run()
-    except Exception as e:
-        logger.error(f"Ошибка запуска Telegram бота: {e}")
-
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def serve(path):
-    """Обслуживание статических файлов"""
+    """Обслуживание статических файлов
+
+    В production статику отдает nginx (см. nginx.conf). send_from_directory
+    сам проверяет существование файла и отдает его через wsgi.file_wrapper,
+    поэтому под gunicorn файл уходит в сокет через sendfile(2).
+    """
     static_folder_path = app.static_folder
     if static_folder_path is None:
         return "Static folder not configured", 404
 
-    if path != "" and os.path.exists(os.path.join(static_folder_path, path)):
-        return send_from_directory(static_folder_path, path)
-    else:
-        index_path = os.path.join(static_folder_path, 'index.html')
-        if os.path.exists(index_path):
-            return send_from_directory(static_folder_path, 'index.html')
-        else:
-            return "index.html not found", 404
+    if path != "":
+        try:
+            return send_from_directory(static_folder_path, path)
+        except NotFound:
+            pass
+
+    try:
+        return send_from_directory(static_folder_path, 'index.html')
+    except NotFound:
+        return "index.html not found", 404
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Проверка состояния сервиса"""
     return jsonify({
         'status': 'healthy',
-        'telegram_bot': 'running' if telegram_bot else 'not_started',
+        'telegram_bot': 'separate_process' if os.getenv('TELEGRAM_BOT_TOKEN') else 'not_configured',
         'database': 'connected'
     })
 
 @app.route('/api/bot/status', methods=['GET'])
 def bot_status():
-    """Статус Telegram бота"""
-    global telegram_bot
+    """Статус Telegram бота
     
-    if not telegram_bot:
+    Бот работает в отдельном процессе (src/run_bot.py) и делит с веб-приложением
+    только базу данных, поэтому статистика берется из нее.
+    """
+    if not os.getenv('TELEGRAM_BOT_TOKEN'):
         return jsonify({
-            'status': 'not_running',
-            'message': 'Telegram bot is not started'
+            'status': 'not_configured',
+            'message': 'TELEGRAM_BOT_TOKEN is not set'
         })
     
-    # Получаем статистику из базы данных
-    with app.app_context():
-        total_templates = Template.query.filter_by(is_active=True).count()
-        total_users = UserSession.query.filter_by(is_active=True).count()
-        total_workflows = UserWorkflow.query.count()
+    # Получаем статистику из базы данных одним запросом
+    row = template_db.session.execute(template_db.text("""
+        SELECT
+            (SELECT COUNT(*) FROM templates WHERE is_active = 1) AS total_templates,
+            (SELECT COUNT(*) FROM user_sessions WHERE is_active = 1) AS total_users,
+            (SELECT COUNT(*) FROM user_workflows) AS total_workflows
+    """)).one()
         
     return jsonify({
-        'status': 'running',
+        'status': 'separate_process',
         'statistics': {
-            'total_templates': total_templates,
-            'total_users': total_users,
-            'total_workflows': total_workflows
+            'total_templates': row.total_templates,
+            'total_users': row.total_users,
+            'total_workflows': row.total_workflows
         }
     })
 
@@ -135,19 +185,11 @@ def internal_error(error):
     return jsonify({'error': 'Internal server error'}), 500
 
 if __name__ == '__main__':
-    # Проверяем наличие необходимых переменных окружения
-    required_env_vars = ['TELEGRAM_BOT_TOKEN', 'OPENAI_API_KEY']
-    missing_vars = [var for var in required_env_vars if not os.getenv(var)]
-    
-    if missing_vars:
-        logger.error(f"Отсутствуют переменные окружения: {', '.join(missing_vars)}")
-        logger.info("Создайте файл .env на основе .env.example")
-    else:
-        # Запускаем Telegram бота в отдельном потоке
-        bot_thread = threading.Thread(target=start_telegram_bot, daemon=True)
-        bot_thread.start()
-        logger.info("Telegram бот запущен в отдельном потоке")
+    # Telegram бот запускается отдельным процессом: python -m src.run_bot
+    if not os.getenv('FLASK_DEV'):
+        logger.error("Dev-сервер Flask запускается только с FLASK_DEV=1")
+        logger.info("Для production: gunicorn -w $(nproc) -k gevent --worker-connections 1000 src.main:app")
+        sys.exit(1)
     
-    # Запускаем Flask приложение
     logger.info("Запуск Flask приложения...")
-    app.run(host='0.0.0.0', port=5000, debug=False)  # debug=False для production
+    app.run(host='0.0.0.0', port=5000, debug=False)
@@ -1,19 +1,79 @@
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
-import json
+from datetime import datetime, timezone
+from functools import lru_cache
+import base64
+import logging
+import math
+import os
+import orjson
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+logger = logging.getLogger(__name__)
 
 db = SQLAlchemy()
 
+class JSONBlob(db.TypeDecorator):
+    """JSON, хранимый как BLOB с байтами orjson
+    
+    Принимает dict/list (сериализуются orjson) или готовый JSON (str/bytes),
+    при чтении всегда отдает сырые байты JSON - их можно вставить в ответ
+    через orjson.Fragment или разобрать orjson.loads без промежуточного decode.
+    Старые строки, записанные как TEXT, читаются так же.
+    """
+    impl = db.LargeBinary
+    cache_ok = True
+    
+    def process_bind_param(self, value, dialect):
+        if value is None or isinstance(value, bytes):
+            return value
+        if isinstance(value, str):
+            return value.encode()
+        if isinstance(value, bytearray):
+            return bytes(value)
+        return orjson.dumps(value)
+    
+    def process_result_value(self, value, dialect):
+        if value is None or isinstance(value, bytes):
+            return value
+        if isinstance(value, str):
+            return value.encode()
+        return bytes(value)
+
+# Префикс зашифрованного значения n8n_api_key; значения без него - старые ключи в открытом виде
+API_KEY_CIPHER_PREFIX = 'gcm:'
+_API_KEY_SALT = b'n8n-railway-mcp:n8n_api_key'
+_API_KEY_NONCE_SIZE = 12
+
+@lru_cache(maxsize=4)
+def _derive_api_key_cipher(secret: str) -> AESGCM:
+    """AES-256-GCM с ключом, выведенным через scrypt (дорого, поэтому кэшируется)"""
+    key = Scrypt(salt=_API_KEY_SALT, length=32, n=2 ** 14, r=8, p=1).derive(secret.encode())
+    return AESGCM(key)
+
+def _api_key_cipher() -> AESGCM:
+    secret = os.getenv('N8N_KEY_SECRET') or os.getenv('FLASK_SECRET_KEY')
+    if not secret:
+        raise RuntimeError('N8N_KEY_SECRET is not set: cannot encrypt n8n API keys')
+    return _derive_api_key_cipher(secret)
+
 class Template(db.Model):
     """Модель для хранения шаблонов n8n"""
     __tablename__ = 'templates'
+    __table_args__ = (
+        # Составные индексы под основные выборки: фильтр по категории (сразу в порядке
+        # популярности, без сортировки), популярные шаблоны и листинг по дате обновления
+        db.Index('ix_tpl_active_cat_dlc', 'is_active', 'category', 'download_count'),
+        db.Index('ix_tpl_active_popular', 'is_active', 'download_count'),
+        db.Index('ix_tpl_active_updated', 'is_active', 'updated_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(255), nullable=False, index=True)
+    name = db.Column(db.String(255), nullable=False, unique=True, index=True)
     description = db.Column(db.Text)
     category = db.Column(db.String(100), nullable=False, index=True)
     complexity = db.Column(db.String(50))  # Free/Paid, Beginner/Intermediate/Advanced
-    json_content = db.Column(db.Text)  # JSON содержимое шаблона
+    json_content = db.Column(JSONBlob)  # JSON содержимое шаблона (байты orjson)
     download_url = db.Column(db.String(500))
     author = db.Column(db.String(100))
     tags = db.Column(db.Text)  # JSON массив тегов
@@ -24,11 +84,60 @@ class Template(db.Model):
     download_count = db.Column(db.Integer, default=0)
     rating = db.Column(db.Float, default=0.0)
     
+    # Связь с workflows пользователей; загружается только явно (selectinload)
+    user_workflows = db.relationship('UserWorkflow', back_populates='template', lazy='raise')
+    
     def __repr__(self):
         return f'<Template {self.name}>'
     
-    def to_dict(self):
-        """Преобразует объект в словарь"""
+    @db.validates('json_content')
+    def validate_json_content(self, key, value):
+        """Проверяет JSON при записи, чтобы при чтении отдавать байты как есть
+        
+        dict/list сериализуются сразу, готовый JSON (str/bytes) только проверяется.
+        """
+        if value is None:
+            return None
+        if isinstance(value, (bytes, bytearray, str)):
+            orjson.loads(value)
+            return value.encode() if isinstance(value, str) else bytes(value)
+        return orjson.dumps(value)
+    
+    def _json_list(self, field):
+        """Разбирает JSON-массив из текстового поля, запоминая результат на экземпляре"""
+        raw = getattr(self, field)
+        if not raw:
+            return []
+        
+        cache = self.__dict__.setdefault('_json_cache', {})
+        cached = cache.get(field)
+        if cached is None or cached[0] is not raw:
+            cached = cache[field] = (raw, orjson.loads(raw))
+        
+        return list(cached[1])
+    
+    def to_dict(self, raw=False):
+        """Преобразует объект в словарь
+        
+        raw=True - значения для прямой сериализации через orjson: даты остаются
+        datetime, а tags/nodes_used вставляются исходным JSON-текстом без разбора.
+        """
+        if raw:
+            return {
+                'id': self.id,
+                'name': self.name,
+                'description': self.description,
+                'category': self.category,
+                'complexity': self.complexity,
+                'author': self.author,
+                'tags': orjson.Fragment(self.tags) if self.tags else [],
+                'nodes_used': orjson.Fragment(self.nodes_used) if self.nodes_used else [],
+                'created_at': self.created_at,
+                'updated_at': self.updated_at,
+                'download_count': self.download_count,
+                'rating': self.rating
+            }
+        
         return {
             'id': self.id,
             'name': self.name,
@@ -36,8 +145,8 @@ class Template(db.Model):
             'category': self.category,
             'complexity': self.complexity,
             'author': self.author,
-            'tags': json.loads(self.tags) if self.tags else [],
-            'nodes_used': json.loads(self.nodes_used) if self.nodes_used else [],
+            'tags': self._json_list('tags'),
+            'nodes_used': self._json_list('nodes_used'),
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat(),
             'download_count': self.download_count,
@@ -47,30 +156,44 @@ class Template(db.Model):
     @classmethod
     def search_by_category(cls, category):
         """Поиск шаблонов по категории"""
-        return cls.query.filter_by(category=category, is_active=True).all()
+        stmt = db.lambda_stmt(lambda: db.select(cls).where(cls.is_active == True, cls.category == category))
+        return db.session.execute(stmt).scalars().all()
+    
+    @classmethod
+    def keywords_filter(cls, keywords):
+        """Условие поиска по ключевым словам через полнотекстовый индекс templates_fts"""
+        # Каждое слово экранируем как фразу и ищем по префиксу, слова объединяются через AND
+        match_query = ' '.join('"{}"*'.format(keyword.replace('"', '""')) for keyword in keywords)
+        return cls.id.in_(
+            db.text("SELECT rowid FROM templates_fts WHERE templates_fts MATCH :q")
+              .bindparams(q=match_query)
+              .columns(db.column('rowid', db.Integer))
+        )
+    
+    @classmethod
+    def tag_filter(cls, tag):
+        """Условие точного совпадения тега в JSON-массиве tags (SQLite JSON1)"""
+        tag_values = db.func.json_each(cls.tags).table_valued('value')
+        return db.exists().where(tag_values.c.value == tag)
     
     @classmethod
     def search_by_keywords(cls, keywords):
         """Поиск шаблонов по ключевым словам"""
         query = cls.query.filter(cls.is_active == True)
         
-        for keyword in keywords:
-            query = query.filter(
-                db.or_(
-                    cls.name.contains(keyword),
-                    cls.description.contains(keyword),
-                    cls.tags.contains(keyword)
-                )
-            )
+        if keywords:
+            query = query.filter(cls.keywords_filter(keywords))
         
         return query.all()
     
     @classmethod
     def get_popular_templates(cls, limit=10):
         """Получить популярные шаблоны"""
-        return cls.query.filter_by(is_active=True)\
-                       .order_by(cls.download_count.desc())\
-                       .limit(limit).all()
+        # lambda_stmt кэширует построение запроса: на повторных вызовах меняется только limit
+        stmt = db.lambda_stmt(lambda: db.select(cls).where(cls.is_active == True)
+                                                      .order_by(cls.download_count.desc()))
+        stmt += lambda s: s.limit(limit)
+        return db.session.execute(stmt).scalars().all()
     
     @classmethod
     def get_categories_stats(cls):
@@ -82,10 +205,61 @@ class Template(db.Model):
          .group_by(cls.category)\
          .all()
 
+    
+    @classmethod
+    def get_categories_share(cls):
+        """Статистика по категориям с долей каждой в процентах - одним запросом
+        
+        Доля считается оконной функцией SUM(COUNT(*)) OVER () по тому же GROUP BY;
+        числитель приводится к REAL, чтобы деление не было целочисленным.
+        """
+        count = db.func.count(cls.id)
+        percentage = db.cast(count, db.Float) * 100.0 / db.func.sum(count).over()
+        return db.session.query(
+            cls.category,
+            count.label('count'),
+            percentage.label('percentage')
+        ).filter(cls.is_active == True)\
+         .group_by(cls.category)\
+         .all()
+
+
+# Полнотекстовый индекс FTS5 по name/description/tags, синхронизируется триггерами
+_TEMPLATES_FTS_DDL = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS templates_fts USING fts5(
+        name, description, tags, content='templates', content_rowid='id'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS templates_fts_ai AFTER INSERT ON templates BEGIN
+        INSERT INTO templates_fts(rowid, name, description, tags)
+        VALUES (new.id, new.name, new.description, new.tags);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS templates_fts_ad AFTER DELETE ON templates BEGIN
+        INSERT INTO templates_fts(templates_fts, rowid, name, description, tags)
+        VALUES ('delete', old.id, old.name, old.description, old.tags);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS templates_fts_au AFTER UPDATE OF name, description, tags ON templates BEGIN
+        INSERT INTO templates_fts(templates_fts, rowid, name, description, tags)
+        VALUES ('delete', old.id, old.name, old.description, old.tags);
+        INSERT INTO templates_fts(rowid, name, description, tags)
+        VALUES (new.id, new.name, new.description, new.tags);
+    END""",
+)
+_TEMPLATES_FTS_REBUILD = "INSERT INTO templates_fts(templates_fts) VALUES ('rebuild')"
+
+for _statement in _TEMPLATES_FTS_DDL + (_TEMPLATES_FTS_REBUILD,):
+    db.event.listen(
+        Template.__table__, 'after_create',
+        db.DDL(_statement).execute_if(dialect='sqlite')
+    )
+
 
 class UserWorkflow(db.Model):
     """Модель для отслеживания workflows пользователей"""
     __tablename__ = 'user_workflows'
+    __table_args__ = (
+        # Workflow пользователя ищется по паре (user_id, workflow_id); workflow_id уникален в n8n
+        db.Index('ix_uw_user_wf', 'user_id', 'workflow_id', unique=True),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.BigInteger, nullable=False, index=True)  # Telegram user ID
@@ -98,8 +272,8 @@ class UserWorkflow(db.Model):
     execution_count = db.Column(db.Integer, default=0)
     error_count = db.Column(db.Integer, default=0)
     
-    # Связь с шаблоном
-    template = db.relationship('Template', backref='user_workflows')
+    # Связь с шаблоном; ленивая загрузка запрещена, чтобы не допускать N+1 запросов
+    template = db.relationship('Template', back_populates='user_workflows', lazy='raise')
     
     def __repr__(self):
         return f'<UserWorkflow {self.workflow_name} for user {self.user_id}>'
@@ -136,17 +310,51 @@ class UserSession(db.Model):
     
     def get_session_data(self):
         """Получить данные сессии"""
-        return json.loads(self.session_data) if self.session_data else {}
+        return orjson.loads(self.session_data) if self.session_data else {}
     
     def set_session_data(self, data):
-        """Установить данные сессии"""
-        self.session_data = json.dumps(data)
+        """Установить данные сессии
+        
+        Принимает объект или уже сериализованный JSON (str/bytes): во втором
+        случае текст только проверяется на валидность и сохраняется как есть.
+        """
+        if isinstance(data, (bytes, bytearray, str)):
+            orjson.loads(data)
+            self.session_data = data.decode() if isinstance(data, (bytes, bytearray)) else data
+        else:
+            self.session_data = orjson.dumps(data).decode()
         self.updated_at = datetime.utcnow()
+    
+    def set_n8n_api_key(self, api_key):
+        """Сохранить API ключ n8n в зашифрованном виде (nonce||ciphertext, base64)
+        
+        user_id используется как associated data: значение, скопированное
+        в сессию другого пользователя, не расшифруется.
+        """
+        if not api_key:
+            self.n8n_api_key = None
+            return
+        nonce = os.urandom(_API_KEY_NONCE_SIZE)
+        ct = _api_key_cipher().encrypt(nonce, api_key.encode(), str(self.user_id).encode())
+        self.n8n_api_key = API_KEY_CIPHER_PREFIX + base64.urlsafe_b64encode(nonce + ct).decode()
+    
+    def get_n8n_api_key(self):
+        """Получить расшифрованный API ключ n8n"""
+        value = self.n8n_api_key
+        if not value or not value.startswith(API_KEY_CIPHER_PREFIX):
+            return value
+        raw = base64.urlsafe_b64decode(value[len(API_KEY_CIPHER_PREFIX):])
+        nonce, ct = raw[:_API_KEY_NONCE_SIZE], raw[_API_KEY_NONCE_SIZE:]
+        return _api_key_cipher().decrypt(nonce, ct, str(self.user_id).encode()).decode()
 
 
 class ExecutionLog(db.Model):
     """Модель для логирования выполнений"""
     __tablename__ = 'execution_logs'
+    __table_args__ = (
+        # Логи и статистика пользователя выбираются диапазоном по created_at
+        db.Index('ix_exec_user_created', 'user_id', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.BigInteger, nullable=False, index=True)
@@ -159,9 +367,100 @@ class ExecutionLog(db.Model):
     error_message = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Строковые поля лога и их предельная длина (None - без ограничения)
+    _STRING_FIELDS = (('workflow_id', 100), ('execution_id', 100), ('status', 50), ('error_message', None))
+    
     def __repr__(self):
         return f'<ExecutionLog {self.execution_id}>'
     
+    @staticmethod
+    def _coerce_datetime(value):
+        """datetime или ISO-строка -> naive datetime в UTC"""
+        if value is None or value == '':
+            return None
+        if not isinstance(value, datetime):
+            value = datetime.fromisoformat(str(value))
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+    
+    @classmethod
+    def coerce_row(cls, data):
+        """Проверяет и приводит поля лога к типам колонок
+        
+        Возвращает словарь для db.insert(ExecutionLog) без created_at; при
+        невалидном значении бросает ValueError с именем поля. Логи пишутся
+        пачками, поэтому все проверки делаются здесь, до постановки в очередь.
+        """
+        user_id = data.get('user_id')
+        if user_id is None or user_id == '' or isinstance(user_id, bool):
+            raise ValueError('user_id обязателен')
+        try:
+            row = {'user_id': int(user_id)}
+        except (TypeError, ValueError):
+            raise ValueError('user_id должен быть целым числом')
+        
+        for field, max_length in cls._STRING_FIELDS:
+            value = data.get(field)
+            if value is not None:
+                value = str(value)
+                if max_length is not None and len(value) > max_length:
+                    raise ValueError(f'{field} длиннее {max_length} символов')
+            row[field] = value
+        
+        for field in ('start_time', 'end_time'):
+            try:
+                row[field] = cls._coerce_datetime(data.get(field))
+            except (TypeError, ValueError):
+                raise ValueError(f'{field} должен быть датой в формате ISO 8601')
+        
+        duration = data.get('duration')
+        if duration is None or duration == '':
+            row['duration'] = None
+        else:
+            try:
+                if isinstance(duration, bool):
+                    raise ValueError(duration)
+                row['duration'] = float(duration)
+                if not math.isfinite(row['duration']):
+                    raise ValueError(duration)
+            except (TypeError, ValueError):
+                raise ValueError('duration должен быть числом секунд')
+        
+        return row
+    
+    @classmethod
+    def insert_rows(cls, rows):
+        """Вставляет пачку логов одним executemany; возвращает число записанных
+        
+        Если пачка не прошла целиком, она откатывается и вставляется построчно:
+        теряются только строки, которые не удалось записать, а не вся пачка.
+        """
+        if not rows:
+            return 0
+        statement = db.insert(cls)
+        try:
+            db.session.execute(statement, rows)
+            db.session.commit()
+            return len(rows)
+        except Exception as e:
+            db.session.rollback()
+            if len(rows) == 1:
+                logger.error(f"Execution log dropped: {e}; row: {rows[0]!r}")
+                return 0
+            logger.warning(f"Execution log batch of {len(rows)} failed, retrying row by row: {e}")
+        
+        written = 0
+        for row in rows:
+            try:
+                db.session.execute(statement, [row])
+                db.session.commit()
+                written += 1
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Execution log dropped: {e}; row: {row!r}")
+        return written
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -174,3 +473,85 @@ class ExecutionLog(db.Model):
             'error_message': self.error_message,
             'created_at': self.created_at.isoformat()
         }
+
+
+def _upgrade_templates_fts(connection):
+    """Индекс templates_fts и триггеры синхронизации; при создании индекс заполняется"""
+    exists = connection.execute(
+        db.text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'templates_fts'")
+    ).first()
+    for statement in _TEMPLATES_FTS_DDL:
+        connection.execute(db.text(statement))
+    if not exists:
+        connection.execute(db.text(_TEMPLATES_FTS_REBUILD))
+
+def _upgrade_json_content_blob(connection):
+    """json_content, записанный до JSONBlob как TEXT, переводится в BLOB с теми же байтами"""
+    connection.execute(db.text(
+        "UPDATE templates SET json_content = CAST(json_content AS BLOB) "
+        "WHERE typeof(json_content) = 'text'"
+    ))
+
+def _upgrade_unique_template_names(connection):
+    """Уникальный индекс по templates.name (на нем держится ON CONFLICT(name) при импорте)
+    
+    Из шаблонов с одинаковым именем остается первый: ему переходят счетчик
+    скачиваний и ссылки из user_workflows, остальные удаляются.
+    """
+    indexes = db.inspect(connection).get_indexes(Template.__tablename__)
+    if any(index['unique'] and index['column_names'] == ['name'] for index in indexes):
+        return
+    duplicates = "SELECT id FROM templates WHERE id NOT IN (SELECT MIN(id) FROM templates GROUP BY name)"
+    connection.execute(db.text(
+        "UPDATE templates SET download_count = "
+        "(SELECT SUM(COALESCE(d.download_count, 0)) FROM templates d WHERE d.name = templates.name) "
+        "WHERE id IN (SELECT MIN(id) FROM templates GROUP BY name HAVING COUNT(*) > 1)"
+    ))
+    connection.execute(db.text(
+        "UPDATE user_workflows SET template_id = "
+        "(SELECT MIN(k.id) FROM templates k JOIN templates d ON d.name = k.name "
+        "WHERE d.id = user_workflows.template_id) "
+        f"WHERE template_id IN ({duplicates})"
+    ))
+    connection.execute(db.text(f"DELETE FROM templates WHERE id IN ({duplicates})"))
+    connection.execute(db.text("DROP INDEX IF EXISTS ix_templates_name"))
+    connection.execute(db.text("CREATE UNIQUE INDEX ix_templates_name ON templates (name)"))
+
+def _upgrade_model_indexes(connection):
+    """Индексы моделей, которых нет в существующей БД; замененный ix_tpl_active_cat удаляется
+    
+    Перед уникальным ix_uw_user_wf из повторяющихся пар (user_id, workflow_id)
+    остается последняя запись.
+    """
+    connection.execute(db.text("DROP INDEX IF EXISTS ix_tpl_active_cat"))
+    if not db.inspect(connection).has_index(UserWorkflow.__tablename__, 'ix_uw_user_wf'):
+        connection.execute(db.text(
+            "DELETE FROM user_workflows WHERE id NOT IN "
+            "(SELECT MAX(id) FROM user_workflows GROUP BY user_id, workflow_id)"
+        ))
+    for model in (Template, UserWorkflow, ExecutionLog):
+        for index in model.__table__.indexes:
+            index.create(connection, checkfirst=True)
+
+# Шаги миграции по порядку; каждый сам проверяет, нужен ли он
+_SCHEMA_UPGRADE_STEPS = (
+    _upgrade_templates_fts,
+    _upgrade_json_content_blob,
+    _upgrade_unique_template_names,
+    _upgrade_model_indexes,
+)
+
+def upgrade_schema():
+    """Идемпотентная миграция уже развернутой БД SQLite под текущие модели
+    
+    create_all() создает только отсутствующие таблицы, а DDL из after_create
+    выполняется лишь при создании таблицы templates, поэтому на существующей
+    БД индексы и преобразования данных добавляются здесь. Вызывается при
+    старте после create_all(); повторный и одновременный (несколько воркеров)
+    запуск безопасен.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return
+    with db.engine.begin() as connection:
+        for step in _SCHEMA_UPGRADE_STEPS:
+            step(connection)
@@ -1,74 +1,232 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, current_app, request, jsonify, stream_with_context
+from sqlalchemy.orm import selectinload
 from src.models.template import db, Template, UserWorkflow, UserSession, ExecutionLog
-import json
+import atexit
+import threading
+import time
+import orjson
+from collections import deque
+from datetime import datetime
+from itertools import chain, islice
 
 template_bp = Blueprint('template', __name__)
 
+def ojsonify(obj, status=200):
+    """JSON-ответ, сериализованный через orjson"""
+    return Response(orjson.dumps(obj), status=status, mimetype='application/json')
+
+# Сколько строк за раз читается из курсора БД и отправляется клиенту одним чанком
+STREAM_BATCH_SIZE = 500
+
+# Предел ?limit= для списков: значения вне 1..MAX_PAGE_LIMIT приводятся к границам
+MAX_PAGE_LIMIT = 500
+
+def _query_int(name, default):
+    """Целый query-параметр; ValueError с понятным текстом, если это не число"""
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f'{name} должен быть целым числом')
+
+def _page_limit(default):
+    """?limit=, приведенный к диапазону 1..MAX_PAGE_LIMIT"""
+    return min(max(_query_int('limit', default), 1), MAX_PAGE_LIMIT)
+
+def stream_jsonify(rows, serialize, tail=None):
+    """Потоковый JSON-ответ вида {"data": [...], "success": true, ...}
+    
+    Строки сериализуются по мере чтения из БД пачками по STREAM_BATCH_SIZE,
+    поэтому список целиком не материализуется в памяти. tail - функция,
+    возвращающая дополнительные поля ответа; вызывается после выдачи всех строк.
+    
+    Первая пачка читается до возврата Response, то есть внутри try/except
+    маршрута: ошибка запроса к БД дает обычный JSON с кодом 500. Если чтение
+    сорвалось уже во время выдачи (статус 200 отправлен), массив закрывается
+    и ответ завершается полями success: false и error - JSON остается целым.
+    """
+    rows = iter(rows)
+    first_batch = list(islice(rows, STREAM_BATCH_SIZE))
+    
+    def generate():
+        yield b'{"data":['
+        chunk = []
+        separator = b''
+        try:
+            for row in chain(first_batch, rows):
+                item = orjson.dumps(serialize(row))
+                chunk.append(separator)
+                chunk.append(item)
+                separator = b','
+                if len(chunk) >= 2 * STREAM_BATCH_SIZE:
+                    yield b''.join(chunk)
+                    chunk = []
+            trailer = {'success': True}
+            if tail:
+                trailer.update(tail())
+        except Exception as e:
+            current_app.logger.error(f"Ошибка потоковой выдачи списка: {e}")
+            trailer = {'success': False, 'error': str(e)}
+        chunk.append(b']')
+        for key, value in trailer.items():
+            chunk.append(b',' + orjson.dumps(key) + b':' + orjson.dumps(value))
+        chunk.append(b'}')
+        yield b''.join(chunk)
+    
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+def _encode_cursor(template):
+    """Курсор keyset-пагинации: updated_at и id последней строки страницы"""
+    return f"{template.updated_at.isoformat()}_{template.id}"
+
+def _decode_cursor(cursor):
+    updated_at, template_id = cursor.rsplit('_', 1)
+    return datetime.fromisoformat(updated_at), int(template_id)
+
 @template_bp.route('/templates', methods=['GET'])
 def get_templates():
-    """Получить список шаблонов с фильтрацией"""
+    """Получить список шаблонов с фильтрацией
+    
+    Пагинация keyset по (updated_at, id): следующая страница запрашивается
+    с ?cursor=<next_cursor> из предыдущего ответа; total считается только
+    с ?include_total=1. Для старых клиентов ?offset= включает прежнюю
+    OFFSET-пагинацию: ответ тогда, как раньше, содержит total и offset.
+    limit приводится к 1..MAX_PAGE_LIMIT.
+    """
     try:
         category = request.args.get('category')
         keywords = request.args.get('keywords', '').split(',') if request.args.get('keywords') else []
-        limit = int(request.args.get('limit', 20))
-        offset = int(request.args.get('offset', 0))
+        cursor = request.args.get('cursor')
+        try:
+            limit = _page_limit(20)
+            offset = _query_int('offset', None)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        if offset is not None and (offset < 0 or cursor):
+            return jsonify({'success': False, 'error': 'offset должен быть >= 0 и не сочетается с cursor'}), 400
+        include_total = request.args.get('include_total') == '1' or offset is not None
         
         query = Template.query.filter_by(is_active=True)
         
         if category:
             query = query.filter_by(category=category)
         
+        keywords = [keyword.strip() for keyword in keywords if keyword.strip()]
         if keywords:
-            for keyword in keywords:
-                if keyword.strip():
-                    query = query.filter(
-                        db.or_(
-                            Template.name.contains(keyword.strip()),
-                            Template.description.contains(keyword.strip()),
-                            Template.tags.contains(keyword.strip())
-                        )
-                    )
-        
-        total = query.count()
-        templates = query.offset(offset).limit(limit).all()
+            query = query.filter(Template.keywords_filter(keywords))
         
-        return jsonify({
-            'success': True,
-            'data': [template.to_dict() for template in templates],
-            'total': total,
-            'limit': limit,
-            'offset': offset
-        })
+        total = query.count() if include_total else None
+        
+        if cursor:
+            try:
+                cursor_updated_at, cursor_id = _decode_cursor(cursor)
+            except ValueError:
+                return jsonify({'success': False, 'error': 'Invalid cursor'}), 400
+            query = query.filter(
+                db.tuple_(Template.updated_at, Template.id) < (cursor_updated_at, cursor_id)
+            )
+        
+        query = query.order_by(Template.updated_at.desc(), Template.id.desc())
+        if offset:
+            query = query.offset(offset)
+        query = query.limit(limit + 1)
+        page = {'last': None, 'has_more': False}
+        
+        def page_rows():
+            for index, template in enumerate(query.yield_per(STREAM_BATCH_SIZE)):
+                if index == limit:
+                    page['has_more'] = True
+                    break
+                page['last'] = template
+                yield template
+        
+        def page_tail():
+            tail = {
+                'limit': limit,
+                'next_cursor': _encode_cursor(page['last']) if page['has_more'] and page['last'] else None
+            }
+            if include_total:
+                tail['total'] = total
+            if offset is not None:
+                tail['offset'] = offset
+            return tail
+        
+        return stream_jsonify(page_rows(), lambda template: template.to_dict(raw=True), page_tail)
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @template_bp.route('/templates/<int:template_id>', methods=['GET'])
 def get_template(template_id):
-    """Получить конкретный шаблон"""
+    """Получить конкретный шаблон
+    
+    Ответ помечается слабым ETag по updated_at: если клиент прислал совпадающий
+    If-None-Match, возвращается 304 без загрузки и сериализации строки.
+    download_count меняется при каждом просмотре и в ETag не входит, поэтому
+    ETag слабый - представления "семантически равны", счетчик может отставать.
+    Просмотр учитывается и при 304, так что каждый запрос - одна запись в БД.
+    """
     try:
-        template = Template.query.get_or_404(template_id)
-        
-        # Увеличиваем счетчик просмотров
-        template.download_count += 1
+        # Один UPDATE ... RETURNING: проверка существования, атомарный +1 к счетчику
+        # и данные для ETag. updated_at сохраняем, чтобы просмотры не сбрасывали ETag
+        row = db.session.execute(
+            db.update(Template)
+              .where(Template.id == template_id)
+              .values(download_count=Template.download_count + 1,
+                      updated_at=Template.updated_at)
+              .returning(Template.updated_at)
+        ).one_or_none()
         db.session.commit()
+        if row is None:
+            return jsonify({'success': False, 'error': 'Шаблон не найден'}), 404
+        updated_at = row.updated_at
+        
+        etag = f"{template_id}-{updated_at.isoformat()}"
+        # Сравниваем слабо: клиент может прислать и сильную форму того же значения
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag, weak=True)
+            return response
         
-        result = template.to_dict()
+        template = db.session.get(Template, template_id)
+        
+        result = template.to_dict(raw=True)
         if template.json_content:
-            result['json_content'] = json.loads(template.json_content)
+            # JSON проверен при записи (Template.validate_json_content) - вставляем без разбора
+            result['json_content'] = orjson.Fragment(template.json_content)
         
-        return jsonify({
+        response = ojsonify({
             'success': True,
             'data': result
         })
+        response.set_etag(etag, weak=True)
+        return response
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@template_bp.route('/templates/categories', methods=['GET'])
-def get_categories():
-    """Получить статистику по категориям"""
-    try:
+# Кэш ответа /templates/categories: готовое JSON-тело живет CATEGORIES_CACHE_TTL секунд
+CATEGORIES_CACHE_TTL = 60
+_categories_cache = {'body': None, 'expires_at': 0.0}
+
+# Кэш ответов /templates/popular по значению limit, с тем же TTL
+POPULAR_CACHE_TTL = 60
+POPULAR_CACHE_MAX_ENTRIES = 32
+_popular_cache = {}
+
+def _invalidate_template_caches(*args):
+    _categories_cache['body'] = None
+    _popular_cache.clear()
+
+for _event_name in ('after_insert', 'after_update', 'after_delete'):
+    db.event.listen(Template, _event_name, _invalidate_template_caches)
+
+def _categories_body():
+    """Сериализованная статистика по категориям с TTL-кэшем"""
+    now = time.monotonic()
+    if _categories_cache['body'] is None or now >= _categories_cache['expires_at']:
         stats = Template.get_categories_stats()
         categories = {}
         
@@ -78,26 +236,51 @@ def get_categories():
                 'templates': []
             }
         
-        return jsonify({
+        _categories_cache['body'] = orjson.dumps({
             'success': True,
             'data': categories,
             'total_categories': len(categories)
         })
+        _categories_cache['expires_at'] = now + CATEGORIES_CACHE_TTL
+    
+    return _categories_cache['body']
+
+@template_bp.route('/templates/categories', methods=['GET'])
+def get_categories():
+    """Получить статистику по категориям"""
+    try:
+        return Response(_categories_body(), mimetype='application/json')
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def _popular_body(limit):
+    """Сериализованный список популярных шаблонов с TTL-кэшем"""
+    now = time.monotonic()
+    cached = _popular_cache.get(limit)
+    if cached is None or now >= cached[1]:
+        templates = Template.get_popular_templates(limit)
+        body = orjson.dumps({
+            'success': True,
+            'data': [template.to_dict(raw=True) for template in templates]
+        })
+        # Не даем кэшу разрастаться от произвольных значений limit
+        if len(_popular_cache) >= POPULAR_CACHE_MAX_ENTRIES:
+            _popular_cache.clear()
+        cached = _popular_cache[limit] = (body, now + POPULAR_CACHE_TTL)
+    
+    return cached[0]
+
 @template_bp.route('/templates/popular', methods=['GET'])
 def get_popular_templates():
-    """Получить популярные шаблоны"""
+    """Получить популярные шаблоны (limit приводится к 1..MAX_PAGE_LIMIT)"""
     try:
-        limit = int(request.args.get('limit', 10))
-        templates = Template.get_popular_templates(limit)
+        try:
+            limit = _page_limit(10)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
         
-        return jsonify({
-            'success': True,
-            'data': [template.to_dict() for template in templates]
-        })
+        return Response(_popular_body(limit), mimetype='application/json')
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -130,13 +313,13 @@ def search_templates():
         
         if tags:
             for tag in tags:
-                query = query.filter(Template.tags.contains(tag))
+                query = query.filter(Template.tag_filter(tag))
         
         templates = query.all()
         
-        return jsonify({
+        return ojsonify({
             'success': True,
-            'data': [template.to_dict() for template in templates],
+            'data': [template.to_dict(raw=True) for template in templates],
             'total': len(templates)
         })
         
@@ -147,12 +330,11 @@ def search_templates():
 def get_user_workflows(user_id):
     """Получить workflows пользователя"""
     try:
-        workflows = UserWorkflow.query.filter_by(user_id=user_id).all()
+        workflows = UserWorkflow.query.options(selectinload(UserWorkflow.template))\
+                                      .filter_by(user_id=user_id)\
+                                      .yield_per(STREAM_BATCH_SIZE)
         
-        return jsonify({
-            'success': True,
-            'data': [workflow.to_dict() for workflow in workflows]
-        })
+        return stream_jsonify(workflows, UserWorkflow.to_dict)
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -173,6 +355,7 @@ def create_user_workflow(user_id):
         
         db.session.add(workflow)
         db.session.commit()
+        db.session.refresh(workflow, ['template'])
         
         return jsonify({
             'success': True,
@@ -225,7 +408,7 @@ def update_user_session(user_id):
             session.set_session_data(data['session_data'])
         
         if 'n8n_api_key' in data:
-            session.n8n_api_key = data['n8n_api_key']  # TODO: Добавить шифрование
+            session.set_n8n_api_key(data['n8n_api_key'])
         
         if 'n8n_base_url' in data:
             session.n8n_base_url = data['n8n_base_url']
@@ -246,12 +429,15 @@ def update_user_session(user_id):
 
 @template_bp.route('/executions', methods=['GET'])
 def get_executions():
-    """Получить логи выполнений"""
+    """Получить логи выполнений (limit приводится к 1..MAX_PAGE_LIMIT)"""
     try:
         user_id = request.args.get('user_id', type=int)
         workflow_id = request.args.get('workflow_id')
         status = request.args.get('status')
-        limit = int(request.args.get('limit', 50))
+        try:
+            limit = _page_limit(50)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
         
         query = ExecutionLog.query
         
@@ -264,41 +450,97 @@ def get_executions():
         if status:
             query = query.filter_by(status=status)
         
-        executions = query.order_by(ExecutionLog.created_at.desc()).limit(limit).all()
+        executions = query.order_by(ExecutionLog.created_at.desc())\
+                          .limit(limit)\
+                          .yield_per(STREAM_BATCH_SIZE)
         
-        return jsonify({
-            'success': True,
-            'data': [execution.to_dict() for execution in executions]
-        })
+        return stream_jsonify(executions, ExecutionLog.to_dict)
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# Буфер логов выполнений: строки копятся в памяти и пишутся в БД одним
+# INSERT на пачку - раз в EXECUTION_FLUSH_INTERVAL секунд или по достижении
+# EXECUTION_FLUSH_SIZE строк
+EXECUTION_FLUSH_SIZE = 500
+EXECUTION_FLUSH_INTERVAL = 1.0
+_exec_buffer = deque()
+_flush_lock = threading.Lock()
+_flush_wakeup = threading.Event()
+_flush_thread = None
+
+def flush_execution_logs():
+    """Записать накопленные логи выполнений в БД (нужен контекст приложения)
+    
+    Возвращает число записанных строк. Строка, которую БД не приняла,
+    отбрасывается с записью в лог, остальные строки пачки сохраняются.
+    """
+    written = 0
+    with _flush_lock:
+        while _exec_buffer:
+            rows = [_exec_buffer.popleft() for _ in range(min(len(_exec_buffer), EXECUTION_FLUSH_SIZE))]
+            try:
+                written += ExecutionLog.insert_rows(rows)
+            finally:
+                db.session.remove()
+    return written
+
+def _flush_loop(app):
+    while True:
+        _flush_wakeup.wait(EXECUTION_FLUSH_INTERVAL)
+        _flush_wakeup.clear()
+        with app.app_context():
+            flush_execution_logs()
+
+def _flush_on_exit(app):
+    with app.app_context():
+        flush_execution_logs()
+
+def _ensure_flush_thread():
+    global _flush_thread
+    if _flush_thread is not None:
+        return
+    with _flush_lock:
+        if _flush_thread is None:
+            app = current_app._get_current_object()
+            _flush_thread = threading.Thread(target=_flush_loop, args=(app,), daemon=True)
+            _flush_thread.start()
+            # Остаток буфера дописываем при остановке процесса
+            atexit.register(_flush_on_exit, app)
+
 @template_bp.route('/executions', methods=['POST'])
 def log_execution():
-    """Записать лог выполнения"""
+    """Записать лог выполнения
+    
+    Все поля проверяются и приводятся к типам колонок сразу (ошибка - 400),
+    затем запись ставится в очередь и сохраняется в БД фоновым потоком пачкой.
+    Ответ 202 возвращается без ожидания коммита: в data - запись в том виде,
+    в каком она будет сохранена, но с id: null (id назначается при вставке).
+    Запись at-most-once: строки, не дождавшиеся сброса при аварийном завершении
+    процесса, теряются.
+    """
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'success': False, 'error': 'Ожидается JSON-объект'}), 400
         
-        execution = ExecutionLog(
-            user_id=data.get('user_id'),
-            workflow_id=data.get('workflow_id'),
-            execution_id=data.get('execution_id'),
-            status=data.get('status'),
-            start_time=data.get('start_time'),
-            end_time=data.get('end_time'),
-            duration=data.get('duration'),
-            error_message=data.get('error_message')
-        )
+        try:
+            row = ExecutionLog.coerce_row(data)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        row['created_at'] = datetime.utcnow()
         
-        db.session.add(execution)
-        db.session.commit()
+        _exec_buffer.append(row)
+        
+        _ensure_flush_thread()
+        if len(_exec_buffer) >= EXECUTION_FLUSH_SIZE:
+            _flush_wakeup.set()
         
         return jsonify({
             'success': True,
-            'data': execution.to_dict()
-        })
+            'queued': True,
+            'data': ExecutionLog(**row).to_dict()
+        }), 202
         
     except Exception as e:
-        db.session.rollback()
         return jsonify({'success': False, 'error': str(e)}), 500
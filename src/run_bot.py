@@ -0,0 +1,35 @@
+import os
+import sys
+import logging
+from dotenv import load_dotenv
+
+# Загружаем переменные окружения
+load_dotenv()
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from src.main import app
+from src.telegram_bot import N8nTelegramBot
+
+logger = logging.getLogger(__name__)
+
+def main():
+    """Запуск Telegram бота в отдельном процессе
+
+    Бот не делит процесс (и GIL) с веб-приложением; общее состояние хранится
+    в той же базе SQLite, доступ к которой дает контекст Flask-приложения.
+    """
+    required_env_vars = ['TELEGRAM_BOT_TOKEN', 'OPENAI_API_KEY']
+    missing_vars = [var for var in required_env_vars if not os.getenv(var)]
+    
+    if missing_vars:
+        logger.error(f"Отсутствуют переменные окружения: {', '.join(missing_vars)}")
+        logger.info("Создайте файл .env на основе .env.example")
+        sys.exit(1)
+    
+    with app.app_context():
+        logger.info("Запуск Telegram бота...")
+        N8nTelegramBot().run()
+
+if __name__ == '__main__':
+    main()
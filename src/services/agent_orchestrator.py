@@ -4,7 +4,14 @@ import json
 from typing import Dict, List, Any, Optional, Callable
 from datetime import datetime
 from enum import Enum
+from collections import deque
+import itertools
+import os
+import time
 import uuid
+import zlib
+
+import numpy as np
 
 from src.services.thinking_service import ThinkingService, ThinkingType, ThoughtLevel, ReflectionEngine
 from src.services.voice_service import MemoryService
@@ -13,6 +20,37 @@ from src.services.n8n_api import N8nApiClient, N8nMonitor
 
 logger = logging.getLogger(__name__)
 
+# Кэш результатов анализа шаблонов: время жизни записи и максимальный размер
+ANALYSIS_CACHE_TTL = 300.0
+ANALYSIS_CACHE_SIZE = 512
+
+# Кэш мыслей агентов по шаблону: время жизни записи и максимальный размер
+THOUGHT_CACHE_TTL = 600.0
+THOUGHT_CACHE_SIZE = 256
+
+# Через сколько секунд ожидания в очереди задача поднимается на один уровень приоритета
+PRIORITY_AGING_INTERVAL = 30.0
+
+# Как часто история мыслей отправляется на пакетную (офлайн) рефлексию
+REFLECTION_BACKFILL_INTERVAL = 3600.0
+
+# Сколько задач один агент выполняет одновременно (общий предел - MAX_CONCURRENT_TASKS)
+AGENT_MAX_CONCURRENCY = int(os.getenv('AGENT_MAX_CONCURRENCY', 8))
+
+# Общий пустой словарь для значений по умолчанию (только для чтения)
+_EMPTY: Dict[str, Any] = {}
+
+def _scan_nodes(nodes: List[Dict[str, Any]]) -> tuple:
+    """Один проход по узлам шаблона: (число различных типов, число узлов с учетными данными)"""
+    node_types = set()
+    credential_nodes = 0
+    for node in nodes:
+        node_types.add(node.get('type', ''))
+        # В n8n учетные данные узла лежат в ключе верхнего уровня 'credentials'
+        if 'credentials' in node:
+            credential_nodes += 1
+    return len(node_types), credential_nodes
+
 class AgentRole(Enum):
     """Роли агентов в системе"""
     COORDINATOR = "coordinator"        # Координатор
@@ -41,6 +79,13 @@ class TaskStatus(Enum):
 class Agent:
     """Базовый класс агента"""
     
+    # Сколько задач агент выполняет одновременно; обработчики агентов не хранят
+    # состояние задачи в self, выполняемые задачи учитываются в _active_tasks
+    max_concurrency = AGENT_MAX_CONCURRENCY
+    
+    # Типы задач, которые выполняются без предварительного think()
+    SKIP_THINK_TYPES: frozenset = frozenset()
+    
     def __init__(self, 
                  name: str, 
                  role: AgentRole, 
@@ -48,24 +93,95 @@ class Agent:
                  memory_service: MemoryService):
         self.name = name
         self.role = role
+        # Ключ агента в MemoryService; crc32 стабилен между процессами, в отличие от hash()
+        self._memory_key = zlib.crc32(name.encode('utf-8'))
         self.thinking_service = thinking_service
         self.memory_service = memory_service
         self.capabilities = set()
-        self.current_task = None
+        # id(задача) -> задача для выполняемых сейчас задач; порядок = порядок запуска
+        self._active_tasks: Dict[int, Dict[str, Any]] = {}
         self.performance_metrics = {
             'tasks_completed': 0,
             'tasks_failed': 0,
-            'average_response_time': 0.0,
-            'last_activity': None
+            'average_response_time': 0.0
         }
-        self.is_busy = False
+        # Время последней активности: monotonic для интервалов, epoch - для отображения
+        self._last_activity_ts = 0.0
+        self._last_activity_epoch = None
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        # (тип мышления, ключ) -> (истекает_в, мысль)
+        self._thought_cache: Dict[tuple, tuple] = {}
         self.created_at = datetime.now()
+        self._started_monotonic = time.monotonic()
+        self._static_status = None
+        self._capabilities_list: tuple = ()
     
-    async def think(self, context: Dict[str, Any], thinking_type: ThinkingType) -> Dict[str, Any]:
-        """Заставляет агента думать"""
-        return await self.thinking_service.think(
+    @property
+    def is_busy(self) -> bool:
+        """Агент занят, когда все max_concurrency слотов заняты задачами"""
+        return len(self._active_tasks) >= self.max_concurrency
+    
+    @property
+    def current_task(self) -> Optional[Dict[str, Any]]:
+        """Последняя запущенная из выполняемых задач (None, если агент простаивает)"""
+        return next(reversed(self._active_tasks.values()), None)
+    
+    def _freeze_status(self):
+        """Фиксирует неизменяемую часть статуса; вызывается в конце __init__ наследников"""
+        self._capabilities_list = tuple(self.capabilities)
+        self._static_status = {
+            'name': self.name,
+            'role': self.role.value,
+            'capabilities': self._capabilities_list
+        }
+    
+    async def think(self, context: Dict[str, Any], thinking_type: ThinkingType,
+                    cache_key: Optional[tuple] = None) -> Dict[str, Any]:
+        """Заставляет агента думать
+        
+        cache_key - структурный ключ контекста (например, id шаблона): мысль по
+        тому же ключу повторно используется THOUGHT_CACHE_TTL секунд.
+        """
+        if cache_key is None:
+            return await self.thinking_service.think(
+                self.name, context, thinking_type, ThoughtLevel.DEEP
+            )
+        
+        key = (thinking_type.value, cache_key)
+        now = time.monotonic()
+        cached = self._thought_cache.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+        
+        thought = await self.thinking_service.think(
             self.name, context, thinking_type, ThoughtLevel.DEEP
         )
+        
+        self._thought_cache.pop(key, None)
+        if len(self._thought_cache) >= THOUGHT_CACHE_SIZE:
+            del self._thought_cache[next(iter(self._thought_cache))]
+        self._thought_cache[key] = (now + THOUGHT_CACHE_TTL, thought)
+        
+        return thought
+    
+    @property
+    def last_activity(self) -> Optional[str]:
+        """Время последней активности в ISO-формате (форматируется только при чтении)"""
+        if self._last_activity_epoch is None:
+            return None
+        return datetime.fromtimestamp(self._last_activity_epoch).isoformat()
+    
+    def _performance_snapshot(self) -> Dict[str, Any]:
+        return {**self.performance_metrics, 'last_activity': self.last_activity}
+    
+    async def _think_safely(self, context: Dict[str, Any], thinking_type: ThinkingType,
+                            cache_key: Optional[tuple] = None) -> Dict[str, Any]:
+        """think(), ошибка которого не прерывает выполнение задачи"""
+        try:
+            return await self.think(context, thinking_type, cache_key)
+        except Exception as e:
+            logger.error(f"{self.name} thinking error: {e}")
+            return {}
     
     async def execute_task(self, task: Dict[str, Any]) -> Dict[str, Any]:
         """Выполняет задачу (должен быть переопределен в наследниках)"""
@@ -74,9 +190,9 @@ class Agent:
     async def reflect_on_performance(self) -> Dict[str, Any]:
         """Рефлексия над собственной производительностью"""
         context = {
-            'performance_metrics': self.performance_metrics,
+            'performance_metrics': self._performance_snapshot(),
             'recent_tasks': await self.get_recent_tasks(),
-            'capabilities': list(self.capabilities)
+            'capabilities': self._capabilities_list
         }
         
         return await self.thinking_service.think(
@@ -86,7 +202,7 @@ class Agent:
     async def get_recent_tasks(self) -> List[Dict[str, Any]]:
         """Получает последние задачи агента"""
         return await self.memory_service.get_short_term(
-            hash(self.name), 'recent_tasks'
+            self._memory_key, 'recent_tasks'
         ) or []
     
     def update_performance(self, task_result: Dict[str, Any]):
@@ -96,23 +212,28 @@ class Agent:
         else:
             self.performance_metrics['tasks_failed'] += 1
         
-        self.performance_metrics['last_activity'] = datetime.now().isoformat()
+        self._last_activity_ts = time.monotonic()
+        self._last_activity_epoch = time.time()
     
     def get_status(self) -> Dict[str, Any]:
         """Возвращает статус агента"""
+        if self._static_status is None:
+            self._freeze_status()
+        
         return {
-            'name': self.name,
-            'role': self.role.value,
+            **self._static_status,
             'is_busy': self.is_busy,
             'current_task': self.current_task,
-            'capabilities': list(self.capabilities),
-            'performance': self.performance_metrics,
-            'uptime': (datetime.now() - self.created_at).total_seconds()
+            'performance': self._performance_snapshot(),
+            'uptime': time.monotonic() - self._started_monotonic
         }
 
 class TemplateAgent(Agent):
     """Агент для работы с шаблонами"""
     
+    # Статистика по категориям - простая выборка, размышлять не о чем
+    SKIP_THINK_TYPES = frozenset({'categorize_templates'})
+    
     def __init__(self, thinking_service: ThinkingService, memory_service: MemoryService):
         super().__init__("TemplateAgent", AgentRole.TEMPLATE_SPECIALIST, thinking_service, memory_service)
         self.template_service = TemplateService()
@@ -120,40 +241,48 @@ class TemplateAgent(Agent):
             'search_templates', 'analyze_templates', 'categorize_templates',
             'recommend_templates', 'validate_templates'
         }
+        self._freeze_status()
+        # (template_id, updated_at) -> (истекает_в, анализ)
+        self._analysis_cache: Dict[tuple, tuple] = {}
+        # Обработчики по типу задачи
+        self._handlers: Dict[str, Callable] = {
+            'search_templates': self._search_templates,
+            'analyze_template': self._analyze_template,
+            'recommend_templates': self._recommend_templates,
+            'categorize_templates': self._categorize_templates
+        }
     
     async def execute_task(self, task: Dict[str, Any]) -> Dict[str, Any]:
         """Выполняет задачи по работе с шаблонами"""
         try:
-            self.is_busy = True
-            self.current_task = task
+            self._active_tasks[id(task)] = task
             
             task_type = task.get('type')
             task_data = task.get('data', {})
             
-            # Думаем о задаче
-            thinking_context = {
-                'task_type': task_type,
-                'task_data': task_data,
-                'agent_capabilities': list(self.capabilities)
-            }
-            
-            thought = await self.think(thinking_context, ThinkingType.ANALYSIS)
+            handler = self._handlers.get(task_type)
             
-            result = None
-            
-            if task_type == 'search_templates':
-                result = await self._search_templates(task_data)
-            elif task_type == 'analyze_template':
-                result = await self._analyze_template(task_data)
-            elif task_type == 'recommend_templates':
-                result = await self._recommend_templates(task_data)
-            elif task_type == 'categorize_templates':
-                result = await self._categorize_templates(task_data)
-            else:
+            if handler is None:
+                thought = {}
                 result = {
                     'success': False,
                     'error': f'Unknown task type: {task_type}'
                 }
+            elif task_type in self.SKIP_THINK_TYPES:
+                thought = {}
+                result = await handler(task_data)
+            else:
+                # Думаем о задаче параллельно с ее выполнением: обработчик от мысли не зависит
+                thinking_context = {
+                    'task_type': task_type,
+                    'task_data': task_data,
+                    'agent_capabilities': self._capabilities_list
+                }
+                thought, result = await asyncio.gather(
+                    self._think_safely(thinking_context, ThinkingType.ANALYSIS,
+                                       self._thought_cache_key(task_type, task_data)),
+                    handler(task_data)
+                )
             
             # Добавляем мысли к результату
             result['agent_thoughts'] = thought
@@ -167,8 +296,14 @@ class TemplateAgent(Agent):
             self.update_performance(result)
             return result
         finally:
-            self.is_busy = False
-            self.current_task = None
+            self._active_tasks.pop(id(task), None)
+    
+    def _thought_cache_key(self, task_type: str, data: Dict[str, Any]) -> Optional[tuple]:
+        """Ключ кэша мыслей: задачи по одному шаблону дают одинаковый контекст"""
+        template_id = data.get('template_id')
+        if template_id is None or data.get('fresh_thinking'):
+            return None
+        return (task_type, template_id)
     
     async def _search_templates(self, data: Dict[str, Any]) -> Dict[str, Any]:
         """Поиск шаблонов"""
@@ -199,20 +334,40 @@ class TemplateAgent(Agent):
         if not template:
             return {'success': False, 'error': 'Template not found'}
         
-        # Анализируем шаблон
-        analysis = {
-            'complexity_score': self._calculate_complexity(template),
-            'node_count': len(template.get('json_content', {}).get('nodes', [])),
-            'category_relevance': self._assess_category_relevance(template),
-            'potential_issues': self._identify_potential_issues(template)
-        }
-        
         return {
             'success': True,
             'template': template,
-            'analysis': analysis
+            'analysis': self._get_analysis(template)
         }
     
+    def _get_analysis(self, template: Dict[str, Any]) -> Dict[str, Any]:
+        """Анализ шаблона с кэшем по (id, updated_at)"""
+        key = (template.get('id'), template.get('updated_at'))
+        now = time.monotonic()
+        
+        cached = self._analysis_cache.get(key)
+        if cached and cached[0] > now:
+            return dict(cached[1])
+        
+        # Узлы сканируются один раз для сложности и для поиска проблем
+        nodes = (template.get('json_content') or _EMPTY).get('nodes') or ()
+        node_stats = _scan_nodes(nodes)
+        
+        analysis = {
+            'complexity_score': self._calculate_complexity(template, node_stats),
+            'node_count': len(nodes),
+            'category_relevance': self._assess_category_relevance(template),
+            'potential_issues': self._identify_potential_issues(template, node_stats)
+        }
+        
+        # Вытесняем самую старую запись (dict сохраняет порядок вставки)
+        self._analysis_cache.pop(key, None)
+        if len(self._analysis_cache) >= ANALYSIS_CACHE_SIZE:
+            del self._analysis_cache[next(iter(self._analysis_cache))]
+        self._analysis_cache[key] = (now + ANALYSIS_CACHE_TTL, analysis)
+        
+        return dict(analysis)
+    
     async def _recommend_templates(self, data: Dict[str, Any]) -> Dict[str, Any]:
         """Рекомендация шаблонов"""
         user_preferences = data.get('preferences', {})
@@ -221,26 +376,46 @@ class TemplateAgent(Agent):
         # Получаем популярные шаблоны
         popular = await self.template_service.get_popular_templates(20)
         
-        # Фильтруем по предпочтениям
-        recommendations = []
-        for template in popular:
-            score = self._calculate_recommendation_score(template, user_preferences, user_history)
-            if score > 0.5:
-                recommendations.append({
-                    'template': template,
-                    'score': score,
-                    'reason': self._get_recommendation_reason(template, user_preferences)
-                })
+        # Множество предпочитаемых категорий строим один раз на весь запрос
+        pref_cats = frozenset(user_preferences.get('categories', ()))
+        
+        # Фильтруем по предпочтениям и берем 10 лучших по скору
+        scores = self._score_recommendations(popular, user_preferences, pref_cats)
+        candidates = np.flatnonzero(scores > 0.5)
+        top = candidates[np.argsort(-scores[candidates], kind='stable')][:10]
         
-        # Сортируем по скору
-        recommendations.sort(key=lambda x: x['score'], reverse=True)
+        recommendations = [{
+            'template': popular[i],
+            'score': float(scores[i]),
+            'reason': self._get_recommendation_reason(popular[i], user_preferences, pref_cats)
+        } for i in top]
         
         return {
             'success': True,
-            'recommendations': recommendations[:10],
+            'recommendations': recommendations,
             'total_analyzed': len(popular)
         }
     
+    def _score_recommendations(self, templates: List[Dict[str, Any]],
+                               preferences: Dict[str, Any],
+                               preferred_categories: frozenset) -> np.ndarray:
+        """Скоры рекомендаций для списка шаблонов сразу (те же правила, что в _calculate_recommendation_score)"""
+        count = len(templates)
+        preferred_complexity = preferences.get('complexity', 'medium')
+        
+        category_match = np.fromiter((t.get('category') in preferred_categories for t in templates),
+                                     dtype=bool, count=count)
+        complexity_match = np.fromiter((t.get('complexity', 'unknown') == preferred_complexity for t in templates),
+                                       dtype=bool, count=count)
+        downloads = np.fromiter((t.get('download_count', 0) for t in templates),
+                                dtype=np.int64, count=count)
+        
+        scores = np.full(count, 0.5)
+        scores += 0.3 * category_match
+        scores += 0.2 * complexity_match
+        scores += 0.1 * (downloads > 100)
+        return np.minimum(scores, 1.0)
+    
     async def _categorize_templates(self, data: Dict[str, Any]) -> Dict[str, Any]:
         """Категоризация шаблонов"""
         stats = await self.template_service.get_categories_with_stats()
@@ -252,12 +427,15 @@ class TemplateAgent(Agent):
             'total_categories': stats['total_categories']
         }
     
-    def _calculate_complexity(self, template: Dict[str, Any]) -> float:
-        """Вычисляет сложность шаблона"""
+    def _calculate_complexity(self, template: Dict[str, Any], node_stats: Optional[tuple] = None) -> float:
+        """Вычисляет сложность шаблона
+        
+        node_stats - готовый результат _scan_nodes, если узлы уже просканированы.
+        """
         try:
-            json_content = template.get('json_content', {})
-            nodes = json_content.get('nodes', [])
-            connections = json_content.get('connections', {})
+            json_content = template.get('json_content') or _EMPTY
+            nodes = json_content.get('nodes') or ()
+            connections = json_content.get('connections') or _EMPTY
             
             # Базовая сложность по количеству узлов
             node_complexity = len(nodes) * 0.1
@@ -266,8 +444,8 @@ class TemplateAgent(Agent):
             connection_complexity = len(connections) * 0.2
             
             # Сложность по типам узлов
-            node_types = set(node.get('type', '') for node in nodes)
-            type_complexity = len(node_types) * 0.15
+            unique_types, _ = node_stats or _scan_nodes(nodes)
+            type_complexity = unique_types * 0.15
             
             total_complexity = min(node_complexity + connection_complexity + type_complexity, 1.0)
             return round(total_complexity, 2)
@@ -292,12 +470,11 @@ class TemplateAgent(Agent):
         
         return min(relevance, 1.0)
     
-    def _identify_potential_issues(self, template: Dict[str, Any]) -> List[str]:
+    def _identify_potential_issues(self, template: Dict[str, Any], node_stats: Optional[tuple] = None) -> List[str]:
         """Выявляет потенциальные проблемы в шаблоне"""
         issues = []
         
-        json_content = template.get('json_content', {})
-        nodes = json_content.get('nodes', [])
+        nodes = (template.get('json_content') or _EMPTY).get('nodes') or ()
         
         if len(nodes) == 0:
             issues.append("Шаблон не содержит узлов")
@@ -306,7 +483,7 @@ class TemplateAgent(Agent):
             issues.append("Очень сложный шаблон (>50 узлов)")
         
         # Проверяем наличие учетных данных
-        credential_nodes = [node for node in nodes if 'credentials' in str(node)]
+        _, credential_nodes = node_stats or _scan_nodes(nodes)
         if credential_nodes:
             issues.append("Требует настройки учетных данных")
         
@@ -337,11 +514,15 @@ class TemplateAgent(Agent):
         return min(score, 1.0)
     
     def _get_recommendation_reason(self, template: Dict[str, Any], 
-                                 preferences: Dict[str, Any]) -> str:
+                                 preferences: Dict[str, Any],
+                                 preferred_categories: Optional[frozenset] = None) -> str:
         """Возвращает причину рекомендации"""
         reasons = []
         
-        if template.get('category') in preferences.get('categories', []):
+        if preferred_categories is None:
+            preferred_categories = preferences.get('categories', [])
+        
+        if template.get('category') in preferred_categories:
             reasons.append(f"соответствует предпочитаемой категории {template.get('category')}")
         
         if template.get('download_count', 0) > 100:
@@ -355,6 +536,9 @@ class TemplateAgent(Agent):
 class ServerAgent(Agent):
     """Агент для управления сервером n8n"""
     
+    # Список workflows - простая выборка, размышлять не о чем
+    SKIP_THINK_TYPES = frozenset({'get_workflows'})
+    
     def __init__(self, thinking_service: ThinkingService, memory_service: MemoryService):
         super().__init__("ServerAgent", AgentRole.SERVER_MANAGER, thinking_service, memory_service)
         self.workflow_service = UserWorkflowService()
@@ -362,45 +546,48 @@ class ServerAgent(Agent):
             'import_templates', 'export_workflows', 'activate_workflows',
             'deactivate_workflows', 'monitor_executions', 'manage_credentials'
         }
+        self._freeze_status()
+        # Обработчики по типу задачи
+        self._handlers: Dict[str, Callable] = {
+            'import_template': self._import_template,
+            'export_workflow': self._export_workflow,
+            'activate_workflow': self._activate_workflow,
+            'deactivate_workflow': self._deactivate_workflow,
+            'get_workflows': self._get_workflows,
+            'monitor_system': self._monitor_system
+        }
     
     async def execute_task(self, task: Dict[str, Any]) -> Dict[str, Any]:
         """Выполняет задачи по управлению сервером"""
         try:
-            self.is_busy = True
-            self.current_task = task
+            self._active_tasks[id(task)] = task
             
             task_type = task.get('type')
             task_data = task.get('data', {})
             user_id = task_data.get('user_id')
             
-            # Думаем о задаче
-            thinking_context = {
-                'task_type': task_type,
-                'user_id': user_id,
-                'server_capabilities': list(self.capabilities)
-            }
-            
-            thought = await self.think(thinking_context, ThinkingType.PLANNING)
+            handler = self._handlers.get(task_type)
             
-            result = None
-            
-            if task_type == 'import_template':
-                result = await self._import_template(task_data)
-            elif task_type == 'export_workflow':
-                result = await self._export_workflow(task_data)
-            elif task_type == 'activate_workflow':
-                result = await self._activate_workflow(task_data)
-            elif task_type == 'deactivate_workflow':
-                result = await self._deactivate_workflow(task_data)
-            elif task_type == 'get_workflows':
-                result = await self._get_workflows(task_data)
-            elif task_type == 'monitor_system':
-                result = await self._monitor_system(task_data)
-            else:
+            if handler is None:
+                thought = {}
                 result = {
                     'success': False,
                     'error': f'Unknown task type: {task_type}'
                 }
+            elif task_type in self.SKIP_THINK_TYPES:
+                thought = {}
+                result = await handler(task_data)
+            else:
+                # Думаем о задаче параллельно с ее выполнением: обработчик от мысли не зависит
+                thinking_context = {
+                    'task_type': task_type,
+                    'user_id': user_id,
+                    'server_capabilities': self._capabilities_list
+                }
+                thought, result = await asyncio.gather(
+                    self._think_safely(thinking_context, ThinkingType.PLANNING),
+                    handler(task_data)
+                )
             
             result['agent_thoughts'] = thought
             self.update_performance(result)
@@ -412,8 +599,7 @@ class ServerAgent(Agent):
             self.update_performance(result)
             return result
         finally:
-            self.is_busy = False
-            self.current_task = None
+            self._active_tasks.pop(id(task), None)
     
     async def _import_template(self, data: Dict[str, Any]) -> Dict[str, Any]:
         """Импорт шаблона"""
@@ -429,19 +615,37 @@ class ServerAgent(Agent):
         
         return await self.workflow_service.export_workflow(user_id, workflow_id)
     
+    @staticmethod
+    def _workflow_ids(data: Dict[str, Any]) -> List[str]:
+        """id workflows задачи: workflow_ids или workflow_id из данных задачи либо из сущностей NLU"""
+        entities = data.get('entities') or _EMPTY
+        workflow_ids = data.get('workflow_ids') or entities.get('workflow_ids')
+        if not workflow_ids:
+            workflow_id = data.get('workflow_id') or entities.get('workflow_id')
+            workflow_ids = [workflow_id] if workflow_id else []
+        return [str(workflow_id) for workflow_id in workflow_ids]
+    
     async def _activate_workflow(self, data: Dict[str, Any]) -> Dict[str, Any]:
-        """Активация workflow"""
+        """Активация workflow; несколько workflows активируются параллельно"""
         user_id = data.get('user_id')
-        workflow_id = data.get('workflow_id')
+        workflow_ids = self._workflow_ids(data)
         
-        return await self.workflow_service.activate_workflow(user_id, workflow_id)
+        if not workflow_ids:
+            return {'success': False, 'error': 'workflow_id is required'}
+        if len(workflow_ids) > 1:
+            return await self.workflow_service.activate_workflows(user_id, workflow_ids)
+        return await self.workflow_service.activate_workflow(user_id, workflow_ids[0])
     
     async def _deactivate_workflow(self, data: Dict[str, Any]) -> Dict[str, Any]:
-        """Деактивация workflow"""
+        """Деактивация workflow; несколько workflows деактивируются параллельно"""
         user_id = data.get('user_id')
-        workflow_id = data.get('workflow_id')
+        workflow_ids = self._workflow_ids(data)
         
-        return await self.workflow_service.deactivate_workflow(user_id, workflow_id)
+        if not workflow_ids:
+            return {'success': False, 'error': 'workflow_id is required'}
+        if len(workflow_ids) > 1:
+            return await self.workflow_service.deactivate_workflows(user_id, workflow_ids)
+        return await self.workflow_service.deactivate_workflow(user_id, workflow_ids[0])
     
     async def _get_workflows(self, data: Dict[str, Any]) -> Dict[str, Any]:
         """Получение списка workflows"""
@@ -477,11 +681,54 @@ class ServerAgent(Agent):
                 'system_status': status
             }
 
+class TaskStore:
+    """Учет активных и завершенных задач
+    
+    Хранит активные задачи, ограниченную историю и индекс истории по id.
+    Блокировки не нужны: все методы вызываются из одного event loop оркестратора
+    и не содержат await, поэтому каждый выполняется целиком, без переключения
+    на другие корутины.
+    """
+    
+    def __init__(self, history_size: int = 1000):
+        self._active: Dict[str, Dict[str, Any]] = {}
+        self._completed = deque(maxlen=max(history_size, 1))
+        self._completed_by_id: Dict[str, Dict[str, Any]] = {}
+    
+    def add_active(self, task: Dict[str, Any]):
+        self._active[task['id']] = task
+    
+    def finish(self, task: Dict[str, Any]):
+        """Переносит задачу из активных в историю"""
+        task_id = task['id']
+        self._active.pop(task_id, None)
+        
+        # Задача, вытесняемая из истории, удаляется и из индекса
+        if len(self._completed) == self._completed.maxlen:
+            self._completed_by_id.pop(self._completed[0]['id'], None)
+        self._completed.append(task)
+        self._completed_by_id[task_id] = task
+    
+    def get_completed(self, task_id: str) -> Optional[Dict[str, Any]]:
+        return self._completed_by_id.get(task_id)
+    
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """Задача по id - активная или из истории"""
+        return self._active.get(task_id) or self._completed_by_id.get(task_id)
+    
+    def active_count(self) -> int:
+        return len(self._active)
+    
+    def completed_count(self) -> int:
+        return len(self._completed)
+
 class AgentOrchestrator:
     """Оркестратор агентов"""
     
-    def __init__(self):
-        self.thinking_service = ThinkingService()
+    def __init__(self, thinking_service: Optional[ThinkingService] = None):
+        # Сервис мышления передается извне, чтобы лимиты OpenAI (ведра RPM/TPM и число
+        # одновременных запросов) и кэш ответов были общими с остальным приложением
+        self.thinking_service = thinking_service or ThinkingService()
         self.memory_service = MemoryService()
         self.reflection_engine = ReflectionEngine(self.thinking_service)
         
@@ -493,10 +740,24 @@ class AgentOrchestrator:
             'monitor': MonitorAgent(self.thinking_service, self.memory_service)
         }
         
-        # Очередь задач
-        self.task_queue = asyncio.Queue()
-        self.active_tasks = {}
-        self.completed_tasks = []
+        # Агент по типу задачи
+        self._type_to_agent: Dict[str, Agent] = {}
+        for agent_name, task_types in (
+            ('template', ('search_templates', 'analyze_template', 'recommend_templates', 'categorize_templates')),
+            ('server', ('import_template', 'export_workflow', 'activate_workflow', 'deactivate_workflow', 'get_workflows', 'monitor_system')),
+            ('coordinator', ('coordinate_agents', 'plan_execution')),
+            ('monitor', ('system_health', 'performance_analysis'))
+        ):
+            for task_type in task_types:
+                self._type_to_agent[task_type] = self.agents[agent_name]
+        
+        # Очередь задач: элементы (приоритет, порядковый номер, время постановки, задача);
+        # порядковый номер сохраняет FIFO внутри одного приоритета
+        self.task_queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self.tasks = TaskStore()  # активные задачи и история (1000 последних)
+        # Future результата по id задачи: разрешается при завершении задачи
+        self._result_futures: Dict[str, asyncio.Future] = {}
         
         # Метрики системы
         self.system_metrics = {
@@ -506,30 +767,57 @@ class AgentOrchestrator:
             'average_response_time': 0.0,
             'system_uptime': datetime.now()
         }
+        self._started_monotonic = time.monotonic()
+        
+        # Ограничение числа одновременно выполняемых задач; слот занимается
+        # до чтения из очереди, поэтому при перегрузке задачи ждут в очереди
+        self._global_semaphore = asyncio.Semaphore(int(os.getenv('MAX_CONCURRENT_TASKS', 16)))
         
         # Запускаем фоновые процессы
         self.running = False
+        self._stop_event = asyncio.Event()
+        self._bg_tasks: set = set()
     
     async def start(self):
         """Запуск оркестратора"""
         self.running = True
+        self._stop_event.clear()
         
-        # Запускаем обработчик задач
-        asyncio.create_task(self._task_processor())
-        
-        # Запускаем мониторинг агентов
-        asyncio.create_task(self._agent_monitor())
-        
-        # Запускаем систему рефлексии
-        asyncio.create_task(self._reflection_loop())
+        self._bg_tasks = {
+            # Обработчик задач
+            asyncio.create_task(self._task_processor()),
+            # Мониторинг агентов
+            asyncio.create_task(self._agent_monitor()),
+            # Система рефлексии
+            asyncio.create_task(self._reflection_loop()),
+            # Пакетная рефлексия над историей мыслей (Batch API)
+            asyncio.create_task(self._reflection_backfill_loop()),
+            # Старение приоритетов, чтобы низкоприоритетные задачи не голодали
+            asyncio.create_task(self._priority_aging_loop())
+        }
         
         logger.info("Agent Orchestrator started")
     
     async def stop(self):
-        """Остановка оркестратора"""
+        """Остановка оркестратора: фоновые циклы отменяются сразу, без ожидания их таймеров"""
         self.running = False
+        self._stop_event.set()
+        
+        for task in self._bg_tasks:
+            task.cancel()
+        await asyncio.gather(*self._bg_tasks, return_exceptions=True)
+        self._bg_tasks.clear()
+        
         logger.info("Agent Orchestrator stopped")
     
+    async def _sleep_or_stop(self, delay: float) -> bool:
+        """Ждет delay секунд; возвращает True, если за это время оркестратор остановлен"""
+        try:
+            await asyncio.wait_for(self._stop_event.wait(), timeout=delay)
+            return True
+        except asyncio.TimeoutError:
+            return False
+    
     async def submit_task(self, 
                          task_type: str,
                          data: Dict[str, Any],
@@ -545,11 +833,12 @@ class AgentOrchestrator:
             'data': data,
             'priority': priority,
             'required_agent': required_agent,
-            'created_at': datetime.now().isoformat(),
+            'created_at': time.time(),  # метки времени задач - epoch-секунды
             'status': TaskStatus.PENDING
         }
         
-        await self.task_queue.put(task)
+        self._result_futures[task_id] = asyncio.get_running_loop().create_future()
+        await self.task_queue.put((priority.value, next(self._seq), time.monotonic(), task))
         self.system_metrics['total_tasks'] += 1
         
         logger.info(f"Task submitted: {task_id} ({task_type})")
@@ -557,30 +846,34 @@ class AgentOrchestrator:
     
     async def get_task_result(self, task_id: str, timeout: float = 30.0) -> Optional[Dict[str, Any]]:
         """Получает результат задачи"""
-        start_time = datetime.now()
+        future = self._result_futures.get(task_id)
         
-        while (datetime.now() - start_time).total_seconds() < timeout:
-            # Проверяем завершенные задачи
-            for task in self.completed_tasks:
-                if task['id'] == task_id:
-                    return task
-            
-            # Проверяем активные задачи
-            if task_id in self.active_tasks:
-                task = self.active_tasks[task_id]
-                if task['status'] in [TaskStatus.COMPLETED, TaskStatus.FAILED]:
-                    return task
-            
-            await asyncio.sleep(0.1)
+        if future is None:
+            # Задача уже завершена (или неизвестна) - ищем в истории
+            return self.tasks.get_completed(task_id)
         
-        return None
+        try:
+            # shield: по таймауту не отменяем future, результат можно запросить повторно
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            return None
+    
+    def _finish_task(self, task: Dict[str, Any]):
+        """Переносит задачу в завершенные и будит ожидающих результат"""
+        self.tasks.finish(task)
+        
+        future = self._result_futures.pop(task['id'], None)
+        if future is not None and not future.done():
+            future.set_result(task)
     
     async def _task_processor(self):
         """Обработчик задач"""
         while self.running:
+            await self._global_semaphore.acquire()
+            launched = False
             try:
                 # Получаем задачу из очереди
-                task = await asyncio.wait_for(self.task_queue.get(), timeout=1.0)
+                _, _, _, task = await asyncio.wait_for(self.task_queue.get(), timeout=1.0)
                 
                 # Выбираем подходящего агента
                 agent = await self._select_agent(task)
@@ -588,35 +881,48 @@ class AgentOrchestrator:
                 if not agent:
                     task['status'] = TaskStatus.FAILED
                     task['error'] = 'No suitable agent found'
-                    self.completed_tasks.append(task)
+                    self._finish_task(task)
                     continue
                 
                 # Выполняем задачу
                 task['status'] = TaskStatus.IN_PROGRESS
                 task['assigned_agent'] = agent.name
-                task['started_at'] = datetime.now().isoformat()
-                self.active_tasks[task['id']] = task
+                task['started_at'] = time.time()
+                self.tasks.add_active(task)
                 
                 # Запускаем выполнение в отдельной корутине
                 asyncio.create_task(self._execute_task(agent, task))
+                launched = True
                 
             except asyncio.TimeoutError:
                 continue
             except Exception as e:
                 logger.error(f"Error in task processor: {e}")
+            finally:
+                # Слот освобождает _execute_task; если задача не запущена - освобождаем здесь
+                if not launched:
+                    self._global_semaphore.release()
     
     async def _execute_task(self, agent: Agent, task: Dict[str, Any]):
+        """Выполняет задачу агентом с учетом лимитов параллельности"""
+        try:
+            async with agent._semaphore:
+                await self._run_agent_task(agent, task)
+        finally:
+            self._global_semaphore.release()
+    
+    async def _run_agent_task(self, agent: Agent, task: Dict[str, Any]):
         """Выполняет задачу агентом"""
         try:
-            start_time = datetime.now()
+            start_time = time.monotonic()
             
             # Выполняем задачу
             result = await agent.execute_task(task)
             
             # Обновляем задачу
             task['result'] = result
-            task['completed_at'] = datetime.now().isoformat()
-            task['execution_time'] = (datetime.now() - start_time).total_seconds()
+            task['completed_at'] = time.time()
+            task['execution_time'] = time.monotonic() - start_time
             
             if result.get('success', False):
                 task['status'] = TaskStatus.COMPLETED
@@ -626,14 +932,7 @@ class AgentOrchestrator:
                 self.system_metrics['failed_tasks'] += 1
             
             # Перемещаем в завершенные
-            if task['id'] in self.active_tasks:
-                del self.active_tasks[task['id']]
-            
-            self.completed_tasks.append(task)
-            
-            # Ограничиваем размер истории
-            if len(self.completed_tasks) > 1000:
-                self.completed_tasks = self.completed_tasks[-1000:]
+            self._finish_task(task)
             
             logger.info(f"Task completed: {task['id']} by {agent.name}")
             
@@ -641,42 +940,48 @@ class AgentOrchestrator:
             logger.error(f"Error executing task {task['id']}: {e}")
             task['status'] = TaskStatus.FAILED
             task['error'] = str(e)
-            task['completed_at'] = datetime.now().isoformat()
-            
-            if task['id'] in self.active_tasks:
-                del self.active_tasks[task['id']]
-            
-            self.completed_tasks.append(task)
+            task['completed_at'] = time.time()
             self.system_metrics['failed_tasks'] += 1
+            
+            self._finish_task(task)
     
     async def _select_agent(self, task: Dict[str, Any]) -> Optional[Agent]:
         """Выбирает подходящего агента для задачи"""
         
         # Если указан конкретный агент
-        if task.get('required_agent'):
-            return self.agents.get(task['required_agent'])
-        
-        # Выбираем по типу задачи
-        task_type = task['type']
-        
-        if task_type in ['search_templates', 'analyze_template', 'recommend_templates', 'categorize_templates']:
-            return self.agents['template']
-        elif task_type in ['import_template', 'export_workflow', 'activate_workflow', 'deactivate_workflow', 'get_workflows', 'monitor_system']:
-            return self.agents['server']
-        elif task_type in ['coordinate_agents', 'plan_execution']:
-            return self.agents['coordinator']
-        elif task_type in ['system_health', 'performance_analysis']:
-            return self.agents['monitor']
-        
-        # Выбираем наименее загруженного агента
-        available_agents = [agent for agent in self.agents.values() if not agent.is_busy]
-        
-        if not available_agents:
-            return None
+        if required := task.get('required_agent'):
+            return self.agents.get(required)
         
-        # Выбираем агента с лучшей производительностью
-        best_agent = max(available_agents, key=lambda a: a.performance_metrics['tasks_completed'])
-        return best_agent
+        # Выбираем по типу задачи, иначе - свободного агента
+        return self._type_to_agent.get(task['type']) or self._pick_idle_agent()
+    
+    def _pick_idle_agent(self) -> Optional[Agent]:
+        """Свободный агент с лучшей производительностью (None, если все заняты)"""
+        return max(
+            (agent for agent in self.agents.values() if not agent.is_busy),
+            key=lambda a: a.performance_metrics['tasks_completed'],
+            default=None
+        )
+    
+    async def _priority_aging_loop(self):
+        """Поднимает приоритет задач, ожидающих в очереди дольше PRIORITY_AGING_INTERVAL"""
+        while self.running:
+            try:
+                if await self._sleep_or_stop(PRIORITY_AGING_INTERVAL):
+                    break
+                
+                now = time.monotonic()
+                entries = []
+                while not self.task_queue.empty():
+                    entries.append(self.task_queue.get_nowait())
+                
+                for prio, seq, enqueued_at, task in entries:
+                    if now - enqueued_at >= PRIORITY_AGING_INTERVAL and prio > TaskPriority.CRITICAL.value:
+                        prio, enqueued_at = prio - 1, now
+                    self.task_queue.put_nowait((prio, seq, enqueued_at, task))
+                
+            except Exception as e:
+                logger.error(f"Error in priority aging: {e}")
     
     async def _agent_monitor(self):
         """Мониторинг агентов"""
@@ -684,12 +989,11 @@ class AgentOrchestrator:
             try:
                 for agent in self.agents.values():
                     # Проверяем здоровье агента
-                    if agent.performance_metrics['last_activity']:
-                        last_activity = datetime.fromisoformat(agent.performance_metrics['last_activity'])
-                        if (datetime.now() - last_activity).total_seconds() > 3600:  # 1 час
-                            logger.warning(f"Agent {agent.name} has been inactive for over 1 hour")
+                    if agent._last_activity_ts and time.monotonic() - agent._last_activity_ts > 3600:  # 1 час
+                        logger.warning(f"Agent {agent.name} has been inactive for over 1 hour")
                 
-                await asyncio.sleep(60)  # Проверяем каждую минуту
+                if await self._sleep_or_stop(60):  # Проверяем каждую минуту
+                    break
                 
             except Exception as e:
                 logger.error(f"Error in agent monitor: {e}")
@@ -699,14 +1003,15 @@ class AgentOrchestrator:
         while self.running:
             try:
                 # Рефлексия каждые 10 минут
-                await asyncio.sleep(600)
+                if await self._sleep_or_stop(600):
+                    break
                 
                 # Коллективная рефлексия агентов
                 agent_names = list(self.agents.keys())
                 system_context = {
                     'system_metrics': self.system_metrics,
-                    'active_tasks': len(self.active_tasks),
-                    'completed_tasks': len(self.completed_tasks)
+                    'active_tasks': self.tasks.active_count(),
+                    'completed_tasks': self.tasks.completed_count()
                 }
                 
                 collaborative_reflection = await self.thinking_service.collaborative_thinking(
@@ -720,6 +1025,24 @@ class AgentOrchestrator:
             except Exception as e:
                 logger.error(f"Error in reflection loop: {e}")
     
+    async def _reflection_backfill_loop(self):
+        """Рефлексия над накопленными мыслями агентов через Batch API
+        
+        Пакет обрабатывается до 24 часов, поэтому цикл отдельный и не задерживает
+        ни задачи, ни интерактивную рефлексию.
+        """
+        while self.running:
+            try:
+                if await self._sleep_or_stop(REFLECTION_BACKFILL_INTERVAL):
+                    break
+                
+                reflected = await self.thinking_service.backfill_reflections()
+                if reflected:
+                    logger.info(f"Batch reflection completed for {reflected} thoughts")
+                
+            except Exception as e:
+                logger.error(f"Error in reflection backfill loop: {e}")
+    
     async def get_system_status(self) -> Dict[str, Any]:
         """Получает статус системы"""
         agent_statuses = {name: agent.get_status() for name, agent in self.agents.items()}
@@ -727,9 +1050,9 @@ class AgentOrchestrator:
         return {
             'system_metrics': self.system_metrics,
             'agents': agent_statuses,
-            'active_tasks': len(self.active_tasks),
+            'active_tasks': self.tasks.active_count(),
             'queue_size': self.task_queue.qsize(),
-            'uptime': (datetime.now() - self.system_metrics['system_uptime']).total_seconds(),
+            'uptime': time.monotonic() - self._started_monotonic,
             'timestamp': datetime.now().isoformat()
         }
     
@@ -749,6 +1072,7 @@ class CoordinatorAgent(Agent):
             'coordinate_agents', 'plan_execution', 'resolve_conflicts',
             'optimize_workflow', 'delegate_tasks'
         }
+        self._freeze_status()
     
     async def execute_task(self, task: Dict[str, Any]) -> Dict[str, Any]:
         """Выполняет координационные задачи"""
@@ -768,6 +1092,7 @@ class MonitorAgent(Agent):
             'system_health', 'performance_analysis', 'error_detection',
             'resource_monitoring', 'alert_management'
         }
+        self._freeze_status()
     
     async def execute_task(self, task: Dict[str, Any]) -> Dict[str, Any]:
         """Выполняет задачи мониторинга"""
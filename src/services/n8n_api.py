@@ -1,69 +1,521 @@
 import aiohttp
 import asyncio
-import json
+import hashlib
+import httpx
 import logging
-from typing import Dict, List, Any, Optional
-from datetime import datetime
+import numpy as np
+import orjson
+import os
+import time
+from importlib.util import find_spec
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Dict, Iterable, List, Optional, Tuple
+from datetime import datetime, timedelta, timezone
 
 logger = logging.getLogger(__name__)
 
+_UTC = timezone.utc
+
+# Общие HTTP-сессии: (класс клиента, base_url, sha256 ключа) ->
+# [сессия, число клиентов, event loop, таймер закрытия простаивающей сессии]
+_SESSIONS: Dict[tuple, list] = {}
+# Задачи закрытия простаивающих сессий (держим ссылки, чтобы их не собрал GC)
+_CLOSING_TASKS: set = set()
+# Состояние, общее для всех клиентов одного n8n и ключа: (base_url, sha256 ключа) -> _ClientState.
+# Клиент создается на каждое действие пользователя, а кэши и ограничитель живут здесь; порядок = LRU
+_CLIENT_STATES: OrderedDict = OrderedDict()
+CLIENT_STATES_MAX_ENTRIES = 1024
+
+# Максимум GET-ответов, хранимых для условных запросов (ETag/Last-Modified)
+ETAG_CACHE_SIZE = 256
+# Повторы при перегрузке n8n и базовая пауза экспоненциального backoff. 429 означает,
+# что запрос не выполнялся, и повторяется для любого метода; 502/503/504 - только для
+# идемпотентных методов (повтор POST мог бы создать workflow или запустить выполнение дважды)
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+RETRY_STATUSES = frozenset({502, 503, 504})
+IDEMPOTENT_METHODS = frozenset({'GET', 'PUT', 'DELETE'})
+# Сколько байт тела ошибки n8n попадает в текст N8nApiError
+ERROR_BODY_LIMIT = 1024
+# Сколько секунд общая сессия живет без клиентов, прежде чем закрыться
+SESSION_IDLE_TIMEOUT = 75.0
+# Соединений на хост n8n в пуле клиента; по умолчанию столько же задач в gather_bounded
+CONNECTIONS_PER_HOST = 32
+# Страница и верхний предел выборки для get_workflow_analytics_large
+LARGE_ANALYTICS_PAGE_SIZE = 250
+LARGE_ANALYTICS_MAX_EXECUTIONS = 20000
+# Периоды длиннее этого числа дней считаются по всей истории (get_workflow_analytics_large),
+# а не по последним 100 выполнениям
+RECENT_ANALYTICS_DAYS = 7
+# Сколько секунд N8nMonitor отдает аналитику workflow из кэша
+ANALYTICS_CACHE_TTL = 30.0
+# Размер страницы /executions для пакетной аналитики (максимум публичного API n8n)
+BULK_EXECUTIONS_LIMIT = 250
+
+def _parse_n8n_time(value: str) -> datetime:
+    """Разбирает ISO-время n8n ('...Z') в datetime с часовым поясом"""
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+def _strip_workflow(workflow: Dict[str, Any]) -> Dict[str, Any]:
+    """Оставляет только переносимые поля workflow (без id, дат и прочих серверных полей)"""
+    return {
+        'name': workflow.get('name'),
+        'nodes': workflow.get('nodes', []),
+        'connections': workflow.get('connections', {}),
+        'settings': workflow.get('settings', {}),
+        'staticData': workflow.get('staticData', {}),
+        'tags': workflow.get('tags', [])
+    }
+
+def _accumulate_executions(executions: List[Dict[str, Any]], cutoff_date: datetime,
+                           group_by_workflow: bool = True) -> Dict[Optional[str], List]:
+    """Один проход по выполнениям: фильтр по периоду и счетчики по workflowId
+    
+    Счетчики: [всего, успешных, с ошибкой, сумма длительностей, число длительностей];
+    каждая метка времени разбирается один раз. Без группировки все счетчики
+    собираются под ключом None.
+    """
+    by_workflow = {}
+    # Горячий цикл: функции и методы связаны с локальными именами один раз
+    parse_time = _parse_n8n_time
+    get_counters = by_workflow.get
+    for execution in executions:
+        get = execution.get
+        started_at = get('startedAt')
+        if not started_at:
+            continue
+        start = parse_time(started_at)
+        if start < cutoff_date:
+            continue
+        
+        key = str(get('workflowId')) if group_by_workflow else None
+        counters = get_counters(key)
+        if counters is None:
+            counters = by_workflow[key] = [0, 0, 0, 0.0, 0]
+        counters[0] += 1
+        stopped_at = get('stoppedAt')
+        if stopped_at:
+            counters[2] += 1
+            counters[3] += (parse_time(stopped_at) - start).total_seconds()
+            counters[4] += 1
+        elif get('finished', False):
+            counters[1] += 1
+    return by_workflow
+
+def _analytics_result(workflow_id: str, days: int, counters: Optional[List], timestamp: str) -> Dict[str, Any]:
+    """Собирает ответ аналитики workflow из накопленных счетчиков"""
+    total_executions, successful, failed, duration_sum, duration_count = counters or (0, 0, 0, 0.0, 0)
+    return {
+        'workflow_id': workflow_id,
+        'period_days': days,
+        'total_executions': total_executions,
+        'successful_executions': successful,
+        'failed_executions': failed,
+        'success_rate': successful / total_executions * 100 if total_executions > 0 else 0,
+        'average_duration_seconds': duration_sum / duration_count if duration_count else 0,
+        'executions_per_day': total_executions / days,
+        'timestamp': timestamp
+    }
+
+def _naive_utc_iso(value: str) -> str:
+    """ISO-время n8n без часового пояса (UTC) - в таком виде его разбирает numpy.datetime64"""
+    if value.endswith('Z'):
+        return value[:-1]
+    return _parse_n8n_time(value).astimezone(_UTC).replace(tzinfo=None).isoformat()
+
+def _now_iso() -> str:
+    """Текущее время UTC в ISO-формате с точностью до миллисекунд"""
+    return datetime.now(_UTC).isoformat(timespec='milliseconds')
+
+def _close_idle_session(key: tuple, entry: list):
+    """Закрывает общую сессию, если за время простоя ее так никто и не взял"""
+    if _SESSIONS.get(key) is not entry or entry[1] > 0:
+        return
+    del _SESSIONS[key]
+    client_class, session = key[0], entry[0]
+    if not client_class._session_closed(session):
+        task = entry[2].create_task(client_class._close_session(session))
+        _CLOSING_TASKS.add(task)
+        task.add_done_callback(_CLOSING_TASKS.discard)
+
+async def close_shared_sessions():
+    """Закрывает все общие сессии текущего event loop (вызывать при остановке приложения)"""
+    loop = asyncio.get_running_loop()
+    for key, entry in list(_SESSIONS.items()):
+        if entry[2] is not loop:
+            continue
+        del _SESSIONS[key]
+        if entry[3] is not None:
+            entry[3].cancel()
+        if not key[0]._session_closed(entry[0]):
+            await key[0]._close_session(entry[0])
+
+async def _bounded_gather(coros: Iterable[Awaitable], limit: int) -> List[Any]:
+    """asyncio.gather, в котором одновременно выполняется не больше limit корутин
+    
+    Исключения возвращаются в списке результатов, как при return_exceptions=True.
+    """
+    semaphore = asyncio.Semaphore(limit)
+    
+    async def _one(coro):
+        async with semaphore:
+            return await coro
+    
+    return await asyncio.gather(*(_one(coro) for coro in coros), return_exceptions=True)
+
+def _json_serialize(value: Any) -> str:
+    """Сериализатор тел запросов для aiohttp (ожидает str)"""
+    return orjson.dumps(value).decode()
+
+class _Throttle:
+    """AIMD-ограничитель параллельных запросов к n8n с лимитом запросов в минуту
+    
+    Окно параллелизма растет на alpha после быстрых успешных ответов и
+    умножается на beta при 429/5xx; лимит RPM можно задать явно или взять
+    из заголовка X-RateLimit-Limit первого ответа.
+    """
+    
+    __slots__ = (
+        'limit', 'c_min', 'c_max', 'alpha', 'beta', 'target_latency', 'rpm',
+        'in_flight', '_cond', '_window'
+    )
+    
+    def __init__(self, initial: int = 8, c_min: int = 1, c_max: int = 32,
+                 alpha: float = 1.0, beta: float = 0.5, target_latency: float = 2.0,
+                 rpm: Optional[int] = None):
+        self.limit = float(initial)
+        self.c_min = c_min
+        self.c_max = c_max
+        self.alpha = alpha
+        self.beta = beta
+        self.target_latency = target_latency
+        self.rpm = rpm
+        self.in_flight = 0
+        self._cond = asyncio.Condition()
+        self._window = deque()
+    
+    async def acquire(self):
+        """Занимает слот, дожидаясь свободного места в окне и в минутном лимите
+        
+        Если ожидание прервано (отмена задачи), занятый слот освобождается.
+        """
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        if not self.rpm:
+            return
+        try:
+            window = self._window
+            while True:
+                now = time.monotonic()
+                while window and now - window[0] >= 60.0:
+                    window.popleft()
+                if len(window) < self.rpm:
+                    window.append(now)
+                    break
+                await asyncio.sleep(60.0 - (now - window[0]))
+        except BaseException:
+            await asyncio.shield(self.release())
+            raise
+    
+    async def release(self):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+    
+    def on_success(self, latency: float, headers):
+        """Аддитивный рост окна и подхват лимитов из заголовков ответа"""
+        if self.rpm is None:
+            header_limit = headers.get('X-RateLimit-Limit')
+            if header_limit and header_limit.isdigit():
+                self.rpm = int(header_limit)
+        if headers.get('X-RateLimit-Remaining') == '0':
+            self.on_overload()
+        elif latency <= self.target_latency:
+            self.limit = min(self.c_max, self.limit + self.alpha)
+    
+    def on_overload(self):
+        """Мультипликативное уменьшение окна при перегрузке"""
+        self.limit = max(self.c_min, self.limit * self.beta)
+
+class _ClientState:
+    """Кэш условных GET, кэш аналитики N8nMonitor и ограничитель одного n8n и ключа"""
+    
+    __slots__ = ('etag_cache', 'analytics_cache', 'throttle', 'loop')
+    
+    def __init__(self, max_rpm: Optional[int], loop: asyncio.AbstractEventLoop):
+        # (endpoint, параметры) -> (ETag, Last-Modified, разобранное тело); порядок = LRU
+        self.etag_cache: OrderedDict = OrderedDict()
+        # (workflow_id, дни) -> (время расчета, аналитика)
+        self.analytics_cache: Dict[Tuple[str, int], Tuple[float, Dict[str, Any]]] = {}
+        self.throttle = _Throttle(rpm=max_rpm)
+        self.loop = loop
+    
+    def invalidate(self, prefix: str):
+        """Сбрасывает кэши после записи: GET-ответы коллекции prefix и всю аналитику"""
+        etag_cache = self.etag_cache
+        for key in [key for key in etag_cache if key[0].startswith(prefix)]:
+            del etag_cache[key]
+        self.analytics_cache.clear()
+
+def _client_state(base_url: str, api_key: str, max_rpm: Optional[int]) -> _ClientState:
+    """Общее состояние клиентов base_url + api_key; ограничитель привязан к текущему event loop"""
+    key = (base_url, hashlib.sha256(api_key.encode()).hexdigest())
+    loop = asyncio.get_running_loop()
+    state = _CLIENT_STATES.get(key)
+    if state is None:
+        state = _CLIENT_STATES[key] = _ClientState(max_rpm, loop)
+        if len(_CLIENT_STATES) > CLIENT_STATES_MAX_ENTRIES:
+            _CLIENT_STATES.popitem(last=False)
+        return state
+    
+    _CLIENT_STATES.move_to_end(key)
+    if state.loop is not loop:
+        # Condition ограничителя нельзя использовать из другого event loop
+        state.throttle = _Throttle(rpm=max_rpm or state.throttle.rpm)
+        state.loop = loop
+    elif max_rpm and state.throttle.rpm is None:
+        state.throttle.rpm = max_rpm
+    return state
+
+def _should_retry(method: str, status: int) -> bool:
+    """Можно ли повторить запрос, получивший этот статус"""
+    return status == 429 or (status in RETRY_STATUSES and method in IDEMPOTENT_METHODS)
+
+def _retry_delay(headers: Any, attempt: int) -> float:
+    """Пауза перед повтором: Retry-After от n8n либо экспоненциальный backoff"""
+    retry_after = headers.get('Retry-After')
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+    return RETRY_BACKOFF * (2 ** attempt)
+
 class N8nApiClient:
     """Клиент для работы с n8n API"""
     
-    def __init__(self, base_url: str, api_key: str):
+    # Фиксированный набор атрибутов без __dict__: клиентов бывает много на сервер
+    __slots__ = (
+        'base_url', 'api_key', 'headers', 'health_path', 'session', '_session_key',
+        'cache_enabled', 'max_rpm', '_shared'
+    )
+    
+    # Ошибки транспорта, которые превращаются в N8nApiError
+    _timeout_errors = (asyncio.TimeoutError,)
+    _network_errors = (aiohttp.ClientError,)
+    
+    def __init__(self, base_url: str, api_key: str, cache_enabled: bool = True,
+                 max_rpm: Optional[int] = None, health_path: Optional[str] = None):
         self.base_url = base_url.rstrip('/')
         self.api_key = api_key
+        # Отдельный health-эндпоинт (например, /healthz); без него проверка - /workflows?limit=1
+        self.health_path = health_path
         self.headers = {
             'X-N8N-API-KEY': api_key,
             'Content-Type': 'application/json',
             'Accept': 'application/json'
         }
         self.session = None
+        self._session_key = None
+        self.cache_enabled = cache_enabled
+        self.max_rpm = max_rpm
+        # Кэши и ограничитель общие с другими клиентами этого n8n и ключа (см. _client_state)
+        self._shared: Optional[_ClientState] = None
     
     async def __aenter__(self):
         """Асинхронный контекстный менеджер - вход"""
-        self.session = aiohttp.ClientSession(headers=self.headers)
+        self._ensure_session()
         return self
     
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         """Асинхронный контекстный менеджер - выход"""
-        if self.session:
-            await self.session.close()
+        await self.close()
+    
+    def _new_session(self) -> aiohttp.ClientSession:
+        """Создает сессию с пулом соединений"""
+        # Все запросы идут на один хост n8n: держим keep-alive соединения и кэшируем DNS
+        connector = aiohttp.TCPConnector(
+            limit=64,
+            limit_per_host=CONNECTIONS_PER_HOST,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True,
+            ttl_dns_cache=300
+        )
+        return aiohttp.ClientSession(
+            headers=self.headers,
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=30, connect=5),
+            json_serialize=_json_serialize
+        )
+    
+    @staticmethod
+    def _session_closed(session) -> bool:
+        return session.closed
+    
+    @staticmethod
+    async def _close_session(session):
+        await session.close()
+    
+    def _ensure_session(self) -> aiohttp.ClientSession:
+        """Возвращает сессию клиента, подключаясь к общей сессии для этого n8n и ключа
+        
+        Клиенты с одинаковыми base_url и API-ключом в одном event loop делят
+        одну сессию и пул соединений; сессия закрывается, когда ее освободит
+        последний клиент. Между проверкой и созданием нет await, поэтому
+        отдельная блокировка не нужна. Освобожденная сессия еще SESSION_IDLE_TIMEOUT
+        секунд остается открытой, чтобы следующие действия пользователя шли по
+        уже установленным соединениям.
+        """
+        if self.session is not None and not self._session_closed(self.session):
+            return self.session
+        
+        self._release_session_ref()
+        loop = asyncio.get_running_loop()
+        key = (type(self), self.base_url, hashlib.sha256(self.api_key.encode()).hexdigest())
+        entry = _SESSIONS.get(key)
+        if entry is None or entry[2] is not loop or self._session_closed(entry[0]):
+            entry = _SESSIONS[key] = [self._new_session(), 0, loop, None]
+        elif entry[3] is not None:
+            entry[3].cancel()
+            entry[3] = None
+        entry[1] += 1
+        self.session = entry[0]
+        self._session_key = key
+        return self.session
+    
+    def _release_session_ref(self) -> bool:
+        """Отпускает ссылку клиента на общую сессию; True, если сессию больше никто не использует"""
+        session, key = self.session, self._session_key
+        self.session = self._session_key = None
+        if session is None:
+            return False
+        entry = _SESSIONS.get(key)
+        if entry is None or entry[0] is not session:
+            # Сессия уже вытеснена из реестра (например, создана в другом event loop)
+            return True
+        entry[1] -= 1
+        if entry[1] > 0:
+            return False
+        loop = entry[2]
+        if SESSION_IDLE_TIMEOUT > 0 and loop.is_running():
+            entry[3] = loop.call_later(SESSION_IDLE_TIMEOUT, _close_idle_session, key, entry)
+            return False
+        del _SESSIONS[key]
+        return True
+    
+    async def close(self):
+        """Отпускает общую сессию и закрывает ее пул соединений, если клиент был последним"""
+        session = self.session
+        if self._release_session_ref() and not self._session_closed(session):
+            await self._close_session(session)
+    
+    async def gather_bounded(self, coros: Iterable[Awaitable], limit: int = CONNECTIONS_PER_HOST) -> List[Any]:
+        """Выполняет пачку запросов к n8n, держая в работе не больше limit одновременно"""
+        return await _bounded_gather(coros, limit)
+    
+    def _state(self) -> _ClientState:
+        """Общее состояние клиента; берется при первом запросе, уже в event loop"""
+        state = self._shared
+        if state is None or state.loop is not asyncio.get_running_loop():
+            state = self._shared = _client_state(self.base_url, self.api_key, self.max_rpm)
+        return state
+    
+    async def _send(self, method: str, endpoint: str, data: Optional[Dict], params: Optional[Dict],
+                    headers: Optional[Dict[str, str]]) -> Tuple[int, Any, bytes]:
+        """Транспорт: отправляет запрос и возвращает (статус, заголовки, тело в байтах)"""
+        session = self._ensure_session()
+        async with session.request(method, f"{self.base_url}{endpoint}", json=data, params=params,
+                                   headers=headers) as response:
+            # orjson разбирает байты напрямую: без промежуточной str и угадывания charset
+            return response.status, response.headers, await response.read()
+    
+    def _handle_response(self, method: str, endpoint: str, cache_key: tuple, status: int, headers: Any,
+                         raw: bytes, cacheable: bool, cached: Optional[tuple]) -> Any:
+        """Разбирает ответ n8n: 304 из кэша, ошибки HTTP, JSON-тело и обновление кэша"""
+        etag_cache = self._shared.etag_cache
+        if status == 304 and cached is not None:
+            etag_cache.move_to_end(cache_key)
+            return cached[2]
+        
+        if status >= 400:
+            # Ленивое форматирование; тело в логе и в исключении обрезается
+            logger.error("n8n API error %s %s %s: %.512s", status, method, endpoint, raw)
+            raise N8nApiError(f"HTTP {status}: {raw[:ERROR_BODY_LIMIT].decode('utf-8', errors='replace')}")
+        
+        result = orjson.loads(raw) if raw else {}
+        
+        if cacheable:
+            etag = headers.get('ETag')
+            last_modified = headers.get('Last-Modified')
+            if etag or last_modified:
+                etag_cache[cache_key] = (etag, last_modified, result)
+                etag_cache.move_to_end(cache_key)
+                if len(etag_cache) > ETAG_CACHE_SIZE:
+                    etag_cache.popitem(last=False)
+        elif method != "GET":
+            # Запись меняет ресурс: сбрасываем кэш всей коллекции (/workflows, /credentials, ...)
+            self._shared.invalidate('/' + endpoint.lstrip('/').split('/', 1)[0])
+        
+        return result
     
-    async def _make_request(self, method: str, endpoint: str, data: Optional[Dict] = None) -> Dict[str, Any]:
-        """Выполняет HTTP запрос к n8n API"""
-        url = f"{self.base_url}{endpoint}"
+    async def _make_request(self, method: str, endpoint: str, data: Optional[Dict] = None,
+                            params: Optional[Dict[str, Any]] = None) -> Any:
+        """Выполняет HTTP запрос к n8n API
         
+        GET-ответы с ETag/Last-Modified кэшируются: повторный запрос идет условным,
+        и на 304 возвращается ранее разобранный объект (его нельзя изменять на месте).
+        Параллелизм регулирует _Throttle; на 429 (и на 502/503/504 для GET/PUT/DELETE)
+        запрос повторяется после Retry-After или экспоненциальной паузы.
+        """
+        state = self._state()
+        cacheable = self.cache_enabled and method == "GET"
+        cache_key = (endpoint, tuple(params.items()) if params else ())
+        cached = state.etag_cache.get(cache_key) if cacheable else None
+        request_headers = None
+        if cached is not None:
+            etag, last_modified, _ = cached
+            request_headers = {'If-None-Match': etag} if etag else {'If-Modified-Since': last_modified}
+        
+        throttle = state.throttle
+        send = self._send
+        clock = asyncio.get_running_loop().time
         try:
-            if not self.session:
-                self.session = aiohttp.ClientSession(headers=self.headers)
-            
-            async with self.session.request(method, url, json=data) as response:
-                response_text = await response.text()
+            for attempt in range(MAX_RETRIES + 1):
+                await throttle.acquire()
+                try:
+                    t0 = clock()
+                    status, headers, raw = await send(method, endpoint, data, params, request_headers)
+                finally:
+                    await throttle.release()
                 
-                if response.status >= 400:
-                    logger.error(f"n8n API error {response.status}: {response_text}")
-                    raise N8nApiError(f"HTTP {response.status}: {response_text}")
+                if status == 429 or status >= 500:
+                    throttle.on_overload()
+                    if attempt < MAX_RETRIES and _should_retry(method, status):
+                        retry_delay = _retry_delay(headers, attempt)
+                        logger.warning("n8n API overloaded (%s), retry %s %s in %.1fs", status, method, endpoint, retry_delay)
+                        await asyncio.sleep(retry_delay)
+                        continue
+                else:
+                    throttle.on_success(clock() - t0, headers)
                 
-                if response_text:
-                    return json.loads(response_text)
-                return {}
+                return self._handle_response(method, endpoint, cache_key, status, headers, raw, cacheable, cached)
                 
-        except aiohttp.ClientError as e:
+        except self._timeout_errors:
+            logger.error(f"n8n API timeout: {method} {endpoint}")
+            raise N8nApiError(f"Timeout: {method} {endpoint}")
+        except self._network_errors as e:
             logger.error(f"Network error: {e}")
             raise N8nApiError(f"Network error: {str(e)}")
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             logger.error(f"JSON decode error: {e}")
             raise N8nApiError(f"Invalid JSON response: {str(e)}")
     
     # Workflow Management
     async def get_workflows(self, active_only: bool = False) -> List[Dict[str, Any]]:
         """Получает список всех workflows"""
-        endpoint = "/workflows"
-        if active_only:
-            endpoint += "?active=true"
-        
-        response = await self._make_request("GET", endpoint)
+        params = {'active': 'true'} if active_only else None
+        response = await self._make_request("GET", "/workflows", params=params)
         return response.get('data', [])
     
     async def get_workflow(self, workflow_id: str) -> Dict[str, Any]:
@@ -100,13 +552,23 @@ class N8nApiClient:
     # Execution Management
     async def get_executions(self, workflow_id: Optional[str] = None, limit: int = 20) -> List[Dict[str, Any]]:
         """Получает список выполнений"""
-        endpoint = f"/executions?limit={limit}"
+        params = {'limit': limit}
         if workflow_id:
-            endpoint += f"&workflowId={workflow_id}"
+            params['workflowId'] = workflow_id
         
-        response = await self._make_request("GET", endpoint)
+        response = await self._make_request("GET", "/executions", params=params)
         return response.get('data', [])
     
+    async def get_executions_page(self, workflow_id: Optional[str] = None, limit: int = 100,
+                                  cursor: Optional[str] = None) -> Dict[str, Any]:
+        """Получает страницу выполнений вместе с nextCursor для следующей страницы"""
+        params = {'limit': limit}
+        if workflow_id:
+            params['workflowId'] = workflow_id
+        if cursor:
+            params['cursor'] = cursor
+        return await self._make_request("GET", "/executions", params=params)
+    
     async def get_execution(self, execution_id: str) -> Dict[str, Any]:
         """Получает конкретное выполнение"""
         endpoint = f"/executions/{execution_id}"
@@ -161,26 +623,82 @@ class N8nApiClient:
     # Health Check
     async def health_check(self) -> Dict[str, Any]:
         """Проверяет состояние n8n сервера"""
+        now_iso = _now_iso()
         try:
-            endpoint = "/workflows"  # Простой endpoint для проверки
-            await self._make_request("GET", endpoint)
+            if self.health_path:
+                await self._make_request("GET", self.health_path)
+            else:
+                # Достаточно одной записи: проверяем доступность, а не выгружаем все workflows
+                await self._make_request("GET", "/workflows", params={'limit': 1})
             return {
                 'status': 'healthy',
-                'timestamp': datetime.now().isoformat(),
+                'timestamp': now_iso,
                 'api_accessible': True
             }
         except Exception as e:
             return {
                 'status': 'unhealthy',
-                'timestamp': datetime.now().isoformat(),
+                'timestamp': now_iso,
                 'api_accessible': False,
                 'error': str(e)
             }
 
 
+class N8nHttpxClient(N8nApiClient):
+    """Клиент n8n API поверх httpx.AsyncClient
+    
+    Тот же публичный API, кэш и ограничитель, что у N8nApiClient, но транспорт -
+    один долгоживущий httpx.AsyncClient; при установленном пакете h2 запросы
+    мультиплексируются по HTTP/2 в одном соединении.
+    """
+    
+    __slots__ = ()
+    
+    _timeout_errors = (httpx.TimeoutException,)
+    _network_errors = (httpx.HTTPError,)
+    
+    def _new_session(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            base_url=self.base_url,
+            headers=self.headers,
+            http2=find_spec('h2') is not None,
+            limits=httpx.Limits(max_keepalive_connections=CONNECTIONS_PER_HOST, max_connections=64, keepalive_expiry=75),
+            timeout=httpx.Timeout(30, connect=5)
+        )
+    
+    @staticmethod
+    def _session_closed(session) -> bool:
+        return session.is_closed
+    
+    @staticmethod
+    async def _close_session(session):
+        await session.aclose()
+    
+    async def _send(self, method: str, endpoint: str, data: Optional[Dict], params: Optional[Dict],
+                    headers: Optional[Dict[str, str]]) -> Tuple[int, Any, bytes]:
+        client = self._ensure_session()
+        response = await client.request(
+            method,
+            endpoint,
+            content=orjson.dumps(data) if data is not None else None,
+            params=params,
+            headers=headers
+        )
+        return response.status_code, response.headers, response.content
+
+
+def create_n8n_client(base_url: str, api_key: str, **kwargs) -> N8nApiClient:
+    """Создает клиент n8n с транспортом из N8N_HTTP_TRANSPORT ('aiohttp' по умолчанию или 'httpx')"""
+    if os.getenv('N8N_HTTP_TRANSPORT', 'aiohttp').lower() == 'httpx':
+        return N8nHttpxClient(base_url, api_key, **kwargs)
+    return N8nApiClient(base_url, api_key, **kwargs)
+
+
 class N8nTemplateManager:
     """Менеджер для работы с шаблонами n8n"""
     
+    __slots__ = ('api_client',)
+    
     def __init__(self, api_client: N8nApiClient):
         self.api_client = api_client
     
@@ -224,18 +742,11 @@ class N8nTemplateManager:
             workflow = await self.api_client.get_workflow(workflow_id)
             
             # Подготавливаем данные для экспорта
-            export_data = {
-                'name': workflow.get('name'),
-                'nodes': workflow.get('nodes', []),
-                'connections': workflow.get('connections', {}),
-                'settings': workflow.get('settings', {}),
-                'staticData': workflow.get('staticData', {}),
-                'tags': workflow.get('tags', []),
-                'meta': {
-                    'exported_at': datetime.now().isoformat(),
-                    'n8n_version': workflow.get('versionId'),
-                    'workflow_id': workflow_id
-                }
+            export_data = _strip_workflow(workflow)
+            export_data['meta'] = {
+                'exported_at': _now_iso(),
+                'n8n_version': workflow.get('versionId'),
+                'workflow_id': workflow_id
             }
             
             return {
@@ -255,19 +766,22 @@ class N8nTemplateManager:
     async def duplicate_workflow(self, workflow_id: str, new_name: str = None) -> Dict[str, Any]:
         """Дублирует существующий workflow"""
         try:
-            # Экспортируем workflow
-            export_result = await self.export_workflow(workflow_id)
-            if not export_result['success']:
-                return export_result
+            # Копируем напрямую: get_workflow -> переносимые поля -> create_workflow, без export/import
+            workflow = await self.api_client.get_workflow(workflow_id)
+            workflow_data = _strip_workflow(workflow)
+            workflow_data['name'] = new_name or f"Copy of {workflow.get('name', '')}"
+            workflow_data['active'] = False
             
-            # Импортируем как новый workflow
-            template_data = export_result['data']
-            if new_name:
-                template_data['name'] = new_name
-            else:
-                template_data['name'] = f"Copy of {template_data['name']}"
+            result = await self.api_client.create_workflow(workflow_data)
             
-            return await self.import_template(template_data, template_data['name'])
+            logger.info(f"Workflow '{workflow_id}' duplicated with ID: {result.get('id')}")
+            
+            return {
+                'success': True,
+                'workflow_id': result.get('id'),
+                'name': result.get('name'),
+                'message': f"Шаблон '{workflow_data['name']}' успешно импортирован"
+            }
             
         except Exception as e:
             logger.error(f"Error duplicating workflow: {e}")
@@ -281,35 +795,44 @@ class N8nTemplateManager:
 class N8nMonitor:
     """Монитор для отслеживания состояния n8n"""
     
-    def __init__(self, api_client: N8nApiClient):
+    __slots__ = ('api_client', 'analytics_ttl')
+    
+    def __init__(self, api_client: N8nApiClient, analytics_ttl: float = ANALYTICS_CACHE_TTL):
         self.api_client = api_client
+        # Повторные опросы дашборда в пределах TTL не ходят в n8n. Кэш общий для
+        # мониторов одного n8n и ключа и сбрасывается любой записью через клиента
+        self.analytics_ttl = analytics_ttl
     
     async def get_system_status(self) -> Dict[str, Any]:
         """Получает общий статус системы"""
+        now_iso = _now_iso()
         try:
-            # Проверяем доступность API
-            health = await self.api_client.health_check()
+            # Список workflows и последние выполнения - параллельно; успешный ответ
+            # сам подтверждает доступность API, отдельный health_check не нужен
+            workflows, recent_executions = await asyncio.gather(
+                self.api_client.get_workflows(),
+                self.api_client.get_executions(limit=10),
+                return_exceptions=True
+            )
+            for result in (workflows, recent_executions):
+                if isinstance(result, Exception):
+                    raise result
             
-            # Получаем статистику
-            workflows = await self.api_client.get_workflows()
             active_workflows = [w for w in workflows if w.get('active', False)]
             
-            # Получаем последние выполнения
-            recent_executions = await self.api_client.get_executions(limit=10)
-            
             # Анализируем выполнения
             successful_executions = [e for e in recent_executions if e.get('finished', False) and not e.get('stoppedAt')]
             failed_executions = [e for e in recent_executions if e.get('stoppedAt')]
             
             return {
-                'api_status': health['status'],
+                'api_status': 'healthy',
                 'total_workflows': len(workflows),
                 'active_workflows': len(active_workflows),
                 'recent_executions': len(recent_executions),
                 'successful_executions': len(successful_executions),
                 'failed_executions': len(failed_executions),
                 'success_rate': len(successful_executions) / len(recent_executions) * 100 if recent_executions else 0,
-                'timestamp': datetime.now().isoformat()
+                'timestamp': now_iso
             }
             
         except Exception as e:
@@ -317,59 +840,132 @@ class N8nMonitor:
             return {
                 'api_status': 'error',
                 'error': str(e),
-                'timestamp': datetime.now().isoformat()
+                'timestamp': now_iso
             }
     
     async def get_workflow_analytics(self, workflow_id: str, days: int = 7) -> Dict[str, Any]:
         """Получает аналитику по конкретному workflow"""
+        analytics_cache = self.api_client._state().analytics_cache
+        cache_key = (workflow_id, days)
+        started = time.monotonic()
+        hit = analytics_cache.get(cache_key)
+        if hit is not None and started - hit[0] < self.analytics_ttl:
+            return hit[1]
+        
+        now = datetime.now(_UTC)
+        now_iso = now.isoformat(timespec='milliseconds')
         try:
             # Получаем выполнения workflow
             executions = await self.api_client.get_executions(workflow_id=workflow_id, limit=100)
             
-            # Фильтруем по дням
-            from datetime import datetime, timedelta
-            cutoff_date = datetime.now() - timedelta(days=days)
+            # Время n8n приходит в UTC, поэтому и границу периода считаем в UTC
+            cutoff_date = now - timedelta(days=days)
+            counters = _accumulate_executions(executions, cutoff_date, group_by_workflow=False).get(None)
+            
+            result = _analytics_result(workflow_id, days, counters, now_iso)
+            analytics_cache[cache_key] = (started, result)
+            return result
             
-            recent_executions = []
-            for execution in executions:
-                if execution.get('startedAt'):
-                    start_time = datetime.fromisoformat(execution['startedAt'].replace('Z', '+00:00'))
-                    if start_time >= cutoff_date:
-                        recent_executions.append(execution)
+        except Exception as e:
+            logger.error(f"Error getting workflow analytics: {e}")
+            return {
+                'workflow_id': workflow_id,
+                'error': str(e),
+                'timestamp': now_iso
+            }
+    
+    async def get_workflow_analytics_large(self, workflow_id: str, days: int = 30,
+                                           page_size: int = LARGE_ANALYTICS_PAGE_SIZE,
+                                           max_executions: int = LARGE_ANALYTICS_MAX_EXECUTIONS) -> Dict[str, Any]:
+        """Аналитика workflow по длинной истории выполнений
+        
+        Выполнения выгружаются постранично (cursor n8n) до начала периода или до
+        max_executions, а фильтр по периоду, счетчики и средняя длительность
+        считаются векторно по массивам numpy.datetime64.
+        """
+        now = datetime.now(_UTC)
+        now_iso = now.isoformat(timespec='milliseconds')
+        cutoff_date = now - timedelta(days=days)
+        try:
+            started_list: List[str] = []
+            stopped_list: List[str] = []
+            finished_list: List[bool] = []
+            cursor = None
+            while len(started_list) < max_executions:
+                response = await self.api_client.get_executions_page(workflow_id, page_size, cursor)
+                page = response.get('data', [])
+                for execution in page:
+                    started_at = execution.get('startedAt')
+                    if not started_at:
+                        continue
+                    stopped_at = execution.get('stoppedAt')
+                    started_list.append(_naive_utc_iso(started_at))
+                    stopped_list.append(_naive_utc_iso(stopped_at) if stopped_at else 'NaT')
+                    finished_list.append(bool(execution.get('finished', False)))
+                
+                cursor = response.get('nextCursor')
+                # n8n отдает выполнения от новых к старым: страница, ушедшая за начало периода, последняя
+                if not cursor or not page or not started_list or \
+                        _parse_n8n_time(started_list[-1] + 'Z') < cutoff_date:
+                    break
             
-            # Анализируем данные
-            total_executions = len(recent_executions)
-            successful = len([e for e in recent_executions if e.get('finished', False) and not e.get('stoppedAt')])
-            failed = len([e for e in recent_executions if e.get('stoppedAt')])
+            started = np.array(started_list, dtype='datetime64[ms]')
+            stopped = np.array(stopped_list, dtype='datetime64[ms]')
+            finished = np.array(finished_list, dtype=bool)
             
-            # Вычисляем среднее время выполнения
-            durations = []
-            for execution in recent_executions:
-                if execution.get('startedAt') and execution.get('stoppedAt'):
-                    start = datetime.fromisoformat(execution['startedAt'].replace('Z', '+00:00'))
-                    end = datetime.fromisoformat(execution['stoppedAt'].replace('Z', '+00:00'))
-                    durations.append((end - start).total_seconds())
+            in_period = started >= np.datetime64(cutoff_date.replace(tzinfo=None), 'ms')
+            has_stop = ~np.isnat(stopped)
+            failed_mask = in_period & has_stop
+            durations = (stopped[failed_mask] - started[failed_mask]).astype(np.int64) / 1000.0
             
-            avg_duration = sum(durations) / len(durations) if durations else 0
+            counters = (
+                int(in_period.sum()),
+                int((in_period & finished & ~has_stop).sum()),
+                int(failed_mask.sum()),
+                float(durations.sum()),
+                int(durations.size)
+            )
+            return _analytics_result(workflow_id, days, counters, now_iso)
             
+        except Exception as e:
+            logger.error(f"Error getting large workflow analytics: {e}")
             return {
                 'workflow_id': workflow_id,
-                'period_days': days,
-                'total_executions': total_executions,
-                'successful_executions': successful,
-                'failed_executions': failed,
-                'success_rate': successful / total_executions * 100 if total_executions > 0 else 0,
-                'average_duration_seconds': avg_duration,
-                'executions_per_day': total_executions / days,
-                'timestamp': datetime.now().isoformat()
+                'error': str(e),
+                'timestamp': now_iso
+            }
+    
+    async def get_workflow_analytics_bulk(self, workflow_ids: List[str], days: int = 7) -> Dict[str, Dict[str, Any]]:
+        """Аналитика сразу по нескольким workflows: один запрос /executions и группировка по workflowId
+        
+        Если страница заполнена целиком и не покрывает период, данные могут быть
+        неполными - тогда аналитика собирается параллельными запросами по каждому workflow.
+        """
+        now = datetime.now(_UTC)
+        now_iso = now.isoformat(timespec='milliseconds')
+        try:
+            executions = await self.api_client.get_executions(limit=BULK_EXECUTIONS_LIMIT)
+            cutoff_date = now - timedelta(days=days)
+            
+            if len(executions) >= BULK_EXECUTIONS_LIMIT:
+                oldest = executions[-1].get('startedAt')
+                if not oldest or _parse_n8n_time(oldest) >= cutoff_date:
+                    results = await self.api_client.gather_bounded(
+                        self.get_workflow_analytics(workflow_id, days) for workflow_id in workflow_ids
+                    )
+                    return dict(zip(workflow_ids, results))
+            
+            by_workflow = _accumulate_executions(executions, cutoff_date)
+            return {
+                workflow_id: _analytics_result(workflow_id, days, by_workflow.get(str(workflow_id)), now_iso)
+                for workflow_id in workflow_ids
             }
             
         except Exception as e:
-            logger.error(f"Error getting workflow analytics: {e}")
+            logger.error(f"Error getting bulk workflow analytics: {e}")
             return {
-                'workflow_id': workflow_id,
-                'error': str(e),
-                'timestamp': datetime.now().isoformat()
+                workflow_id: {'workflow_id': workflow_id, 'error': str(e), 'timestamp': now_iso}
+                for workflow_id in workflow_ids
             }
 
 
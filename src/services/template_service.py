@@ -1,76 +1,366 @@
-import json
 import logging
+import orjson
 import asyncio
-from typing import Dict, List, Any, Optional, Tuple
-from datetime import datetime
+import time
+from typing import Dict, List, Any, Callable, Optional, Tuple
+from datetime import datetime, timedelta
 import aiohttp
+import numpy as np
 import os
+from flask import current_app
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 from src.models.template import db, Template, UserWorkflow, UserSession, ExecutionLog
-from src.services.n8n_api import N8nApiClient, N8nTemplateManager, N8nMonitor
+from src.services.n8n_api import (
+    N8nApiClient, N8nTemplateManager, N8nMonitor, RECENT_ANALYTICS_DAYS, create_n8n_client
+)
 
 logger = logging.getLogger(__name__)
 
+# TTL и предельный размер кэша популярных шаблонов и статистики категорий
+TEMPLATE_CACHE_TTL = 60.0
+TEMPLATE_CACHE_MAX_ENTRIES = 32
+
+# Счетчики просмотров в Redis сбрасываются в БД раз в интервал или по накоплении порога
+DOWNLOAD_COUNTER_KEY = 'template:{}:dl'
+DOWNLOAD_FLUSH_INTERVAL = 60.0
+DOWNLOAD_FLUSH_THRESHOLD = 1000
+
+# Сколько запросов активации/деактивации workflows одновременно уходит в n8n
+BULK_WORKFLOW_CONCURRENCY = 10
+
+# Настройки n8n пользователя (base_url, api_key) кэшируются на уровне модуля, чтобы не
+# загружать и не расшифровывать ключ на каждый запрос. Ключ меняет и бот, и Flask-маршрут
+# /user-session в другом процессе, поэтому запись сверяется с updated_at сессии в БД:
+# смена ключа в любом процессе видна при следующем обращении
+USER_CREDENTIALS_MAX_ENTRIES = 10000
+
+# user_id -> (updated_at сессии, (base_url, api_key) или None, если n8n не настроен)
+_user_credentials: Dict[int, Tuple[Optional[datetime], Optional[Tuple[str, str]]]] = {}
+
+# Логи выполнений копятся в памяти и вставляются пачкой: по размеру пачки или по таймеру
+EXECUTION_LOG_BATCH_SIZE = 200
+EXECUTION_LOG_FLUSH_INTERVAL = 0.5
+
+# Статистика выполнений за стандартный период считается сразу по всем пользователям
+# одним GROUP BY и обновляется не чаще раза в EXECUTION_STATS_REFRESH_INTERVAL
+EXECUTION_STATS_DAYS = 7
+EXECUTION_STATS_REFRESH_INTERVAL = 60.0
+
+# Колонки для списков шаблонов: все поля to_dict() без тяжелых json_content и download_url
+_TEMPLATE_LIST_COLUMNS = (
+    Template.id, Template.name, Template.description, Template.category, Template.complexity,
+    Template.author, Template.tags, Template.nodes_used, Template.created_at, Template.updated_at,
+    Template.download_count, Template.rating
+)
+
+# Выражения горячих выборок строятся один раз при импорте; значения подставляются через
+# bindparam, поэтому на вызове нет построения запроса, а компиляция берется из кэша
+_ACTIVE_SESSION_BY_USER = db.select(UserSession).where(
+    UserSession.user_id == db.bindparam('uid'),
+    UserSession.is_active == True
+).limit(1)
+
+# Версия настроек для проверки кэша _user_credentials: одна колонка вместо всей строки
+_ACTIVE_SESSION_VERSION = db.select(UserSession.updated_at).where(
+    UserSession.user_id == db.bindparam('uid'),
+    UserSession.is_active == True
+).limit(1)
+
+# Списки пользователя читаются колонками, без ORM-объектов: поля как в to_dict() моделей
+_USER_WORKFLOWS = db.select(
+    UserWorkflow.id, UserWorkflow.workflow_id, UserWorkflow.workflow_name, UserWorkflow.status,
+    Template.name.label('template_name'), UserWorkflow.created_at, UserWorkflow.last_execution,
+    UserWorkflow.execution_count, UserWorkflow.error_count
+).outerjoin(Template, UserWorkflow.template_id == Template.id).where(
+    UserWorkflow.user_id == db.bindparam('uid')
+).order_by(UserWorkflow.id)
+
+_USER_EXECUTION_LOGS = db.select(
+    ExecutionLog.id, ExecutionLog.workflow_id, ExecutionLog.execution_id, ExecutionLog.status,
+    ExecutionLog.start_time, ExecutionLog.end_time, ExecutionLog.duration,
+    ExecutionLog.error_message, ExecutionLog.created_at
+).where(
+    ExecutionLog.user_id == db.bindparam('uid')
+).order_by(ExecutionLog.created_at.desc(), ExecutionLog.id.desc()).limit(db.bindparam('limit'))
+
+# Keyset-продолжение: строки строго раньше (created_at, id) последней строки предыдущей страницы
+_USER_EXECUTION_LOGS_BEFORE = _USER_EXECUTION_LOGS.where(
+    db.tuple_(ExecutionLog.created_at, ExecutionLog.id) < db.tuple_(
+        db.bindparam('before_ts', type_=ExecutionLog.created_at.type),
+        db.bindparam('before_id', type_=ExecutionLog.id.type)
+    )
+)
+
+async def _run_db(func: Callable[..., Any], *args) -> Any:
+    """Выполняет синхронную работу с БД в пуле потоков, не блокируя event loop
+    
+    В потоке открывается свой app context, а с ним и своя сессия: scoped session
+    Flask-SQLAlchemy привязан к app context, и делить его между потоками нельзя.
+    При выходе из контекста сессия закрывается (незафиксированное откатывается),
+    поэтому func должна возвращать готовые данные, а не ORM-объекты.
+    """
+    app = current_app._get_current_object()
+    
+    def run():
+        with app.app_context():
+            return func(*args)
+    
+    return await asyncio.to_thread(run)
+
+# Агрегаты статистики выполнений: всего, успешных, с ошибкой, средняя длительность
+_EXECUTION_STATS_COLUMNS = (
+    db.func.count(ExecutionLog.id),
+    db.func.count(db.case((ExecutionLog.status == 'success', 1))),
+    db.func.count(db.case((ExecutionLog.status == 'error', 1))),
+    # Нулевая длительность, как и NULL, в среднее не входит
+    db.func.avg(db.func.nullif(ExecutionLog.duration, 0))
+)
+
+def _active_user_session(user_id: int) -> Optional[UserSession]:
+    """Активная сессия пользователя или None"""
+    return db.session.execute(_ACTIVE_SESSION_BY_USER, {'uid': user_id}).scalars().first()
+
+def _template_row_to_dict(row) -> Dict[str, Any]:
+    """Словарь шаблона (как Template.to_dict) из строки с колонками _TEMPLATE_LIST_COLUMNS"""
+    return {
+        'id': row.id,
+        'name': row.name,
+        'description': row.description,
+        'category': row.category,
+        'complexity': row.complexity,
+        'author': row.author,
+        'tags': orjson.loads(row.tags) if row.tags else [],
+        'nodes_used': orjson.loads(row.nodes_used) if row.nodes_used else [],
+        'created_at': row.created_at.isoformat(),
+        'updated_at': row.updated_at.isoformat(),
+        'download_count': row.download_count,
+        'rating': row.rating
+    }
+
+def _isoformat_or_none(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value else None
+
+def _workflow_row_to_dict(row) -> Dict[str, Any]:
+    """Словарь workflow (как UserWorkflow.to_dict) из строки _USER_WORKFLOWS"""
+    result = dict(row._mapping)
+    result['created_at'] = row.created_at.isoformat()
+    result['last_execution'] = _isoformat_or_none(row.last_execution)
+    return result
+
+def _invalidate_user_credentials(user_id: int):
+    """Сбрасывает закэшированные настройки n8n пользователя"""
+    _user_credentials.pop(user_id, None)
+
+def _update_workflows_status(user_id: int, workflow_ids: List[str], status: str):
+    """Ставит статус workflows пользователя одним UPDATE"""
+    db.session.execute(
+        db.update(UserWorkflow)
+          .where(UserWorkflow.user_id == user_id, UserWorkflow.workflow_id.in_(workflow_ids))
+          .values(status=status)
+    )
+    db.session.commit()
+
+def _execution_log_row_to_dict(row) -> Dict[str, Any]:
+    """Словарь лога (как ExecutionLog.to_dict) из строки _USER_EXECUTION_LOGS"""
+    result = dict(row._mapping)
+    result['start_time'] = _isoformat_or_none(row.start_time)
+    result['end_time'] = _isoformat_or_none(row.end_time)
+    result['created_at'] = row.created_at.isoformat()
+    return result
+
 class TemplateService:
     """Сервис для управления шаблонами n8n"""
     
-    def __init__(self):
+    # Версия набора шаблонов, общая для всех экземпляров; входит в ключ кэша,
+    # поэтому импорт шаблона сразу делает старые записи недостижимыми
+    _cache_version = 0
+    
+    def __init__(self, redis_client=None):
+        # (версия, запрос, параметры) -> (time.monotonic() записи, результат)
         self.templates_cache = {}
         self.last_cache_update = None
+        # С Redis просмотры копятся в счетчиках и не превращают чтение шаблона в запись в БД
+        self.redis_client = redis_client
+        self._last_download_flush = time.monotonic()
+        # Периодический сброс счетчиков, чтобы просмотры попадали в БД и без новых чтений
+        self._download_flush_task: Optional[asyncio.Task] = None
+    
+    def _cache_get(self, key: Tuple) -> Any:
+        """Возвращает закэшированный результат, если он не старше TEMPLATE_CACHE_TTL"""
+        entry = self.templates_cache.get((TemplateService._cache_version,) + key)
+        if entry is not None and time.monotonic() - entry[0] < TEMPLATE_CACHE_TTL:
+            return entry[1]
+        return None
+    
+    def _cache_put(self, key: Tuple, value: Any):
+        if len(self.templates_cache) >= TEMPLATE_CACHE_MAX_ENTRIES:
+            self.templates_cache.clear()
+        self.templates_cache[(TemplateService._cache_version,) + key] = (time.monotonic(), value)
+        self.last_cache_update = datetime.utcnow()
     
     async def search_templates(self, query: str = None, category: str = None, 
                              complexity: str = None, limit: int = 10) -> List[Dict[str, Any]]:
         """Поиск шаблонов по различным критериям"""
-        try:
-            templates_query = Template.query.filter_by(is_active=True)
+        def load():
+            # Только нужные колонки: без гидрации ORM-объектов и identity map
+            templates_query = db.session.query(*_TEMPLATE_LIST_COLUMNS).filter(Template.is_active == True)
             
             if category:
-                templates_query = templates_query.filter_by(category=category)
+                templates_query = templates_query.filter(Template.category == category)
             
             if complexity:
                 templates_query = templates_query.filter(Template.complexity.contains(complexity))
             
-            if query:
-                search_filter = db.or_(
-                    Template.name.contains(query),
-                    Template.description.contains(query),
-                    Template.tags.contains(query)
-                )
-                templates_query = templates_query.filter(search_filter)
+            keywords = query.split() if query else []
+            if keywords:
+                # Поиск по FTS5-индексу templates_fts вместо LIKE '%q%' с полным сканированием
+                templates_query = templates_query.filter(Template.keywords_filter(keywords))
             
-            templates = templates_query.order_by(Template.download_count.desc()).limit(limit).all()
+            rows = templates_query.order_by(Template.download_count.desc()).limit(limit).all()
             
-            return [template.to_dict() for template in templates]
+            return [_template_row_to_dict(row) for row in rows]
+        
+        try:
+            return await _run_db(load)
             
         except Exception as e:
             logger.error(f"Error searching templates: {e}")
             return []
     
+    def flush_download_counts(self) -> int:
+        """Переносит накопленные в Redis просмотры в download_count одним пакетным UPDATE
+        
+        Возвращает число обновленных шаблонов.
+        """
+        if not self.redis_client:
+            return 0
+        
+        self._last_download_flush = time.monotonic()
+        deltas = []
+        for key in self.redis_client.scan_iter(match=DOWNLOAD_COUNTER_KEY.format('*')):
+            # GETSET забирает значение и обнуляет счетчик атомарно: инкременты не теряются
+            delta = int(self.redis_client.getset(key, 0) or 0)
+            if delta:
+                template_id = int((key.decode() if isinstance(key, bytes) else key).split(':')[1])
+                deltas.append({'tid': template_id, 'delta': delta})
+        
+        if deltas:
+            templates = Template.__table__
+            try:
+                db.session.execute(
+                    db.update(templates)
+                      .where(templates.c.id == db.bindparam('tid'))
+                      .values(download_count=templates.c.download_count + db.bindparam('delta'),
+                              updated_at=templates.c.updated_at),
+                    deltas
+                )
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                # Возвращаем снятые значения, чтобы они ушли со следующим сбросом
+                for item in deltas:
+                    self.redis_client.incrby(DOWNLOAD_COUNTER_KEY.format(item['tid']), item['delta'])
+                raise
+        
+        return len(deltas)
+    
+    def _count_view_in_redis(self, template: Template) -> Optional[int]:
+        """Учитывает просмотр в Redis; возвращает актуальный download_count или None без Redis"""
+        try:
+            pending = self.redis_client.incr(DOWNLOAD_COUNTER_KEY.format(template.id))
+        except Exception as e:
+            logger.warning(f"Redis unavailable for download counters: {e}")
+            return None
+        
+        download_count = template.download_count + pending
+        if pending >= DOWNLOAD_FLUSH_THRESHOLD or \
+                time.monotonic() - self._last_download_flush >= DOWNLOAD_FLUSH_INTERVAL:
+            try:
+                self.flush_download_counts()
+            except Exception as e:
+                logger.error(f"Error flushing download counters: {e}")
+        return download_count
+    
+    async def _download_flusher(self):
+        """Сбрасывает счетчики просмотров раз в DOWNLOAD_FLUSH_INTERVAL"""
+        while True:
+            await asyncio.sleep(DOWNLOAD_FLUSH_INTERVAL)
+            try:
+                await _run_db(self.flush_download_counts)
+            except Exception as e:
+                logger.error(f"Error flushing download counters: {e}")
+    
+    async def close(self):
+        """Останавливает периодический сброс и переносит оставшиеся просмотры в БД"""
+        task, self._download_flush_task = self._download_flush_task, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if self.redis_client:
+            await _run_db(self.flush_download_counts)
+    
     async def get_template_by_id(self, template_id: int) -> Optional[Dict[str, Any]]:
         """Получает шаблон по ID"""
+        # Фоновая задача наследует контекст (в т.ч. app context Flask) от первого вызова
+        if self.redis_client and (self._download_flush_task is None or self._download_flush_task.done()):
+            self._download_flush_task = asyncio.create_task(self._download_flusher())
         try:
-            template = Template.query.get(template_id)
-            if template and template.is_active:
-                # Увеличиваем счетчик просмотров
-                template.download_count += 1
-                db.session.commit()
-                
-                result = template.to_dict()
-                if template.json_content:
-                    result['json_content'] = json.loads(template.json_content)
-                
-                return result
-            return None
+            return await _run_db(self._load_template, template_id)
             
         except Exception as e:
             logger.error(f"Error getting template by ID: {e}")
             return None
     
+    def _load_template(self, template_id: int) -> Optional[Dict[str, Any]]:
+        """Читает шаблон и учитывает просмотр (синхронно, вызывается через _run_db)"""
+        if self.redis_client:
+            template = db.session.get(Template, template_id)
+            if not template or not template.is_active:
+                return None
+            
+            download_count = self._count_view_in_redis(template)
+            if download_count is not None:
+                result = template.to_dict()
+                result['download_count'] = download_count
+                if template.json_content:
+                    result['json_content'] = orjson.loads(template.json_content)
+                return result
+        
+        # Увеличиваем счетчик просмотров атомарным UPDATE (он же проверяет, что шаблон
+        # существует и активен); updated_at сохраняем, чтобы просмотры не меняли ETag
+        bumped = db.session.execute(
+            db.update(Template)
+              .where(Template.id == template_id, Template.is_active == True)
+              .values(download_count=Template.download_count + 1,
+                      updated_at=Template.updated_at)
+        ).rowcount
+        if bumped:
+            db.session.commit()
+            template = db.session.get(Template, template_id)
+            
+            result = template.to_dict()
+            if template.json_content:
+                result['json_content'] = orjson.loads(template.json_content)
+            
+            return result
+        return None
+    
     async def get_popular_templates(self, limit: int = 10) -> List[Dict[str, Any]]:
         """Получает популярные шаблоны"""
+        cached = self._cache_get(('popular', limit))
+        if cached is not None:
+            return cached
+        
         try:
-            templates = Template.get_popular_templates(limit)
-            return [template.to_dict() for template in templates]
+            result = await _run_db(
+                lambda: [template.to_dict() for template in Template.get_popular_templates(limit)]
+            )
+            self._cache_put(('popular', limit), result)
+            return result
             
         except Exception as e:
             logger.error(f"Error getting popular templates: {e}")
@@ -78,27 +368,30 @@ class TemplateService:
     
     async def get_categories_with_stats(self) -> Dict[str, Any]:
         """Получает категории с статистикой"""
+        cached = self._cache_get(('categories',))
+        if cached is not None:
+            return cached
+        
         try:
-            stats = Template.get_categories_stats()
-            categories = {}
-            
-            for category, count in stats:
-                categories[category] = {
-                    'count': count,
-                    'percentage': 0  # Будет вычислено позже
-                }
-            
-            total = sum(cat['count'] for cat in categories.values())
-            for category in categories:
-                categories[category]['percentage'] = round(
-                    categories[category]['count'] / total * 100, 1
-                ) if total > 0 else 0
+            # Количество и доля считаются в SQL; сумма и округление долей - векторно в numpy
+            rows = await _run_db(Template.get_categories_share)
+            names, counts, shares = zip(*rows) if rows else ((), (), ())
+            counts = np.asarray(counts, dtype=np.int64)
+            shares = np.round(np.asarray(shares, dtype=np.float64), 1)
+            
+            categories = {
+                category: {'count': count, 'percentage': percentage}
+                for category, count, percentage in zip(names, counts.tolist(), shares.tolist())
+            }
+            total = int(counts.sum())
             
-            return {
+            result = {
                 'categories': categories,
                 'total_templates': total,
                 'total_categories': len(categories)
             }
+            self._cache_put(('categories',), result)
+            return result
             
         except Exception as e:
             logger.error(f"Error getting categories stats: {e}")
@@ -106,35 +399,39 @@ class TemplateService:
     
     async def import_template_to_database(self, template_data: Dict[str, Any]) -> bool:
         """Импортирует шаблон в базу данных"""
-        try:
-            # Проверяем, существует ли уже такой шаблон
-            existing = Template.query.filter_by(name=template_data['name']).first()
-            if existing:
-                logger.info(f"Template '{template_data['name']}' already exists")
-                return False
-            
-            template = Template(
-                name=template_data.get('name', 'Unknown Template'),
+        name = template_data.get('name', 'Unknown Template')
+        
+        def store():
+            # Один INSERT ... ON CONFLICT(name) DO NOTHING вместо SELECT + INSERT:
+            # без лишнего запроса и без гонки между проверкой и вставкой
+            statement = sqlite_insert(Template).values(
+                name=name,
                 description=template_data.get('description', ''),
                 category=template_data.get('category', 'Other'),
                 complexity=template_data.get('complexity', 'Unknown'),
-                json_content=json.dumps(template_data.get('json_content', {})),
+                json_content=template_data.get('json_content', {}),
                 download_url=template_data.get('download_url', ''),
                 author=template_data.get('author', ''),
-                tags=json.dumps(template_data.get('tags', [])),
-                nodes_used=json.dumps(template_data.get('nodes_used', [])),
+                tags=orjson.dumps(template_data.get('tags', [])).decode(),
+                nodes_used=orjson.dumps(template_data.get('nodes_used', [])).decode(),
                 rating=template_data.get('rating', 0.0)
-            )
+            ).on_conflict_do_nothing(index_elements=['name']).returning(Template.id)
             
-            db.session.add(template)
+            template_id = db.session.execute(statement).scalar()
             db.session.commit()
+            return template_id is not None
+        
+        try:
+            if not await _run_db(store):
+                logger.info(f"Template '{name}' already exists")
+                return False
+            TemplateService._cache_version += 1
             
-            logger.info(f"Template '{template_data['name']}' imported to database")
+            logger.info(f"Template '{name}' imported to database")
             return True
             
         except Exception as e:
             logger.error(f"Error importing template to database: {e}")
-            db.session.rollback()
             return False
 
 
@@ -145,13 +442,32 @@ class UserWorkflowService:
         pass
     
     async def get_user_n8n_client(self, user_id: int) -> Optional[N8nApiClient]:
-        """Получает n8n API клиент для пользователя"""
+        """Получает n8n API клиент для пользователя
+        
+        Настройки n8n берутся из кэша, если updated_at сессии в БД не изменился;
+        иначе сессия загружается заново и ключ расшифровывается.
+        """
+        def load():
+            version = db.session.execute(_ACTIVE_SESSION_VERSION, {'uid': user_id}).scalar()
+            entry = _user_credentials.get(user_id)
+            if entry is not None and entry[0] == version:
+                return entry[1]
+            
+            session = _active_user_session(user_id)
+            config = None
+            if session and session.n8n_api_key and session.n8n_base_url:
+                config = session.n8n_base_url, session.get_n8n_api_key()
+            if len(_user_credentials) >= USER_CREDENTIALS_MAX_ENTRIES:
+                _user_credentials.clear()
+            _user_credentials[user_id] = (session.updated_at if session else None, config)
+            return config
+        
         try:
-            session = UserSession.query.filter_by(user_id=user_id, is_active=True).first()
-            if not session or not session.n8n_api_key or not session.n8n_base_url:
+            config = await _run_db(load)
+            if not config:
                 return None
             
-            return N8nApiClient(session.n8n_base_url, session.n8n_api_key)
+            return create_n8n_client(*config)
             
         except Exception as e:
             logger.error(f"Error getting user n8n client: {e}")
@@ -159,14 +475,27 @@ class UserWorkflowService:
     
     async def import_template_to_n8n(self, user_id: int, template_id: int) -> Dict[str, Any]:
         """Импортирует шаблон на сервер n8n пользователя"""
+        def load_template():
+            # JSON шаблона разбирается тут же, в потоке БД, а не в event loop
+            row = db.session.execute(
+                db.select(Template.name, Template.json_content).where(Template.id == template_id)
+            ).first()
+            if not row:
+                return None
+            return row.name, orjson.loads(row.json_content) if row.json_content else {}
+        
         try:
-            # Получаем шаблон
-            template = Template.query.get(template_id)
+            # Шаблон и n8n клиент пользователя получаем параллельно
+            async with asyncio.TaskGroup() as tg:
+                template_task = tg.create_task(_run_db(load_template))
+                client_task = tg.create_task(self.get_user_n8n_client(user_id))
+            
+            template = template_task.result()
             if not template:
                 return {'success': False, 'error': 'Template not found'}
+            template_name, template_json = template
             
-            # Получаем n8n клиент пользователя
-            api_client = await self.get_user_n8n_client(user_id)
+            api_client = client_task.result()
             if not api_client:
                 return {
                     'success': False, 
@@ -178,29 +507,34 @@ class UserWorkflowService:
                 template_manager = N8nTemplateManager(api_client)
                 
                 # Импортируем шаблон
-                template_json = json.loads(template.json_content) if template.json_content else {}
-                result = await template_manager.import_template(template_json, template.name)
+                result = await template_manager.import_template(template_json, template_name)
                 
                 if result['success']:
-                    # Сохраняем информацию о workflow пользователя
-                    user_workflow = UserWorkflow(
-                        user_id=user_id,
-                        workflow_id=result['workflow_id'],
-                        template_id=template_id,
-                        workflow_name=template.name,
-                        status='inactive'
-                    )
+                    def store():
+                        # Workflow пользователя и счетчик загрузок фиксируются одной транзакцией
+                        with db.session.begin():
+                            db.session.add(UserWorkflow(
+                                user_id=user_id,
+                                workflow_id=result['workflow_id'],
+                                template_id=template_id,
+                                workflow_name=template_name,
+                                status='inactive'
+                            ))
+                            db.session.execute(
+                                db.update(Template)
+                                  .where(Template.id == template_id)
+                                  .values(download_count=Template.download_count + 1,
+                                          updated_at=Template.updated_at)
+                            )
                     
-                    db.session.add(user_workflow)
-                    db.session.commit()
-                    
-                    # Увеличиваем счетчик загрузок
-                    template.download_count += 1
-                    db.session.commit()
+                    await _run_db(store)
                 
                 return result
                 
         except Exception as e:
+            if isinstance(e, ExceptionGroup):
+                # Ошибка из TaskGroup: показываем исходную, а не обертку
+                e = e.exceptions[0]
             logger.error(f"Error importing template to n8n: {e}")
             return {'success': False, 'error': str(e)}
     
@@ -215,14 +549,7 @@ class UserWorkflowService:
                 result = await api_client.activate_workflow(workflow_id)
                 
                 # Обновляем статус в базе данных
-                user_workflow = UserWorkflow.query.filter_by(
-                    user_id=user_id, 
-                    workflow_id=workflow_id
-                ).first()
-                
-                if user_workflow:
-                    user_workflow.status = 'active'
-                    db.session.commit()
+                await _run_db(_update_workflows_status, user_id, [workflow_id], 'active')
                 
                 return {
                     'success': True,
@@ -245,14 +572,7 @@ class UserWorkflowService:
                 result = await api_client.deactivate_workflow(workflow_id)
                 
                 # Обновляем статус в базе данных
-                user_workflow = UserWorkflow.query.filter_by(
-                    user_id=user_id, 
-                    workflow_id=workflow_id
-                ).first()
-                
-                if user_workflow:
-                    user_workflow.status = 'inactive'
-                    db.session.commit()
+                await _run_db(_update_workflows_status, user_id, [workflow_id], 'inactive')
                 
                 return {
                     'success': True,
@@ -264,16 +584,83 @@ class UserWorkflowService:
             logger.error(f"Error deactivating workflow: {e}")
             return {'success': False, 'error': str(e)}
     
+    async def activate_workflows(self, user_id: int, workflow_ids: List[str]) -> Dict[str, Any]:
+        """Активирует несколько workflows пользователя параллельно"""
+        return await self._set_workflows_active(user_id, workflow_ids, True)
+    
+    async def deactivate_workflows(self, user_id: int, workflow_ids: List[str]) -> Dict[str, Any]:
+        """Деактивирует несколько workflows пользователя параллельно"""
+        return await self._set_workflows_active(user_id, workflow_ids, False)
+    
+    async def _set_workflows_active(self, user_id: int, workflow_ids: List[str], active: bool) -> Dict[str, Any]:
+        """Меняет состояние пачки workflows: запросы к n8n параллельно, статусы в БД одним UPDATE"""
+        try:
+            api_client = await self.get_user_n8n_client(user_id)
+            if not api_client:
+                return {'success': False, 'error': 'n8n API not configured'}
+            
+            async with api_client:
+                action = api_client.activate_workflow if active else api_client.deactivate_workflow
+                results = await api_client.gather_bounded(
+                    (action(workflow_id) for workflow_id in workflow_ids),
+                    limit=BULK_WORKFLOW_CONCURRENCY
+                )
+            
+            succeeded = []
+            failed = {}
+            for workflow_id, result in zip(workflow_ids, results):
+                if isinstance(result, Exception):
+                    failed[workflow_id] = str(result)
+                else:
+                    succeeded.append(workflow_id)
+            
+            if succeeded:
+                await _run_db(_update_workflows_status, user_id, succeeded,
+                              'active' if active else 'inactive')
+            
+            return {
+                'success': not failed,
+                'updated': succeeded,
+                'failed': failed
+            }
+            
+        except Exception as e:
+            logger.error(f"Error changing workflows state: {e}")
+            return {'success': False, 'error': str(e)}
+    
     async def get_user_workflows(self, user_id: int) -> List[Dict[str, Any]]:
         """Получает список workflows пользователя"""
+        def load():
+            rows = db.session.execute(_USER_WORKFLOWS, {'uid': user_id})
+            return [_workflow_row_to_dict(row) for row in rows]
+        
         try:
-            workflows = UserWorkflow.query.filter_by(user_id=user_id).all()
-            return [workflow.to_dict() for workflow in workflows]
+            return await _run_db(load)
             
         except Exception as e:
             logger.error(f"Error getting user workflows: {e}")
             return []
     
+    async def get_workflows_analytics(self, user_id: int, workflow_ids: List[str],
+                                      days: int = 7) -> Dict[str, Dict[str, Any]]:
+        """Аналитика нескольких workflows пользователя одним запросом /executions к n8n
+        
+        Возвращает {workflow_id: аналитика}; без настроенного n8n - пустой словарь.
+        """
+        if not workflow_ids:
+            return {}
+        try:
+            api_client = await self.get_user_n8n_client(user_id)
+            if not api_client:
+                return {}
+            
+            async with api_client:
+                return await N8nMonitor(api_client).get_workflow_analytics_bulk(workflow_ids, days)
+                
+        except Exception as e:
+            logger.error(f"Error getting workflows analytics: {e}")
+            return {}
+    
     async def export_workflow(self, user_id: int, workflow_id: str) -> Dict[str, Any]:
         """Экспортирует workflow пользователя"""
         try:
@@ -290,7 +677,11 @@ class UserWorkflowService:
             return {'success': False, 'error': str(e)}
     
     async def get_workflow_analytics(self, user_id: int, workflow_id: str, days: int = 7) -> Dict[str, Any]:
-        """Получает аналитику workflow"""
+        """Получает аналитику workflow
+        
+        Периоды длиннее RECENT_ANALYTICS_DAYS считаются по всей истории выполнений
+        (постранично и векторно), короткие - по последним выполнениям с кэшем.
+        """
         try:
             api_client = await self.get_user_n8n_client(user_id)
             if not api_client:
@@ -298,7 +689,10 @@ class UserWorkflowService:
             
             async with api_client:
                 monitor = N8nMonitor(api_client)
-                analytics = await monitor.get_workflow_analytics(workflow_id, days)
+                if days > RECENT_ANALYTICS_DAYS:
+                    analytics = await monitor.get_workflow_analytics_large(workflow_id, days)
+                else:
+                    analytics = await monitor.get_workflow_analytics(workflow_id, days)
                 
                 return {
                     'success': True,
@@ -318,22 +712,25 @@ class UserSessionService:
     
     async def set_user_n8n_config(self, user_id: int, api_key: str, base_url: str) -> bool:
         """Устанавливает конфигурацию n8n для пользователя"""
-        try:
-            session = UserSession.query.filter_by(user_id=user_id, is_active=True).first()
+        def store():
+            session = _active_user_session(user_id)
             
             if not session:
                 session = UserSession(user_id=user_id)
                 db.session.add(session)
             
-            # TODO: Добавить шифрование API ключа
-            session.n8n_api_key = api_key
+            session.set_n8n_api_key(api_key)
             session.n8n_base_url = base_url.rstrip('/')
             session.updated_at = datetime.utcnow()
             
             db.session.commit()
+        
+        try:
+            await _run_db(store)
+            _invalidate_user_credentials(user_id)
             
             # Проверяем подключение
-            api_client = N8nApiClient(base_url, api_key)
+            api_client = create_n8n_client(base_url, api_key)
             async with api_client:
                 health = await api_client.health_check()
                 if health['status'] == 'healthy':
@@ -345,13 +742,12 @@ class UserSessionService:
                     
         except Exception as e:
             logger.error(f"Error setting user n8n config: {e}")
-            db.session.rollback()
             return False
     
     async def get_user_session_data(self, user_id: int) -> Dict[str, Any]:
         """Получает данные сессии пользователя"""
-        try:
-            session = UserSession.query.filter_by(user_id=user_id, is_active=True).first()
+        def load():
+            session = _active_user_session(user_id)
             
             if not session:
                 return {}
@@ -362,6 +758,9 @@ class UserSessionService:
                 'created_at': session.created_at.isoformat(),
                 'updated_at': session.updated_at.isoformat()
             }
+        
+        try:
+            return await _run_db(load)
             
         except Exception as e:
             logger.error(f"Error getting user session data: {e}")
@@ -369,8 +768,8 @@ class UserSessionService:
     
     async def update_user_session_data(self, user_id: int, data: Dict[str, Any]) -> bool:
         """Обновляет данные сессии пользователя"""
-        try:
-            session = UserSession.query.filter_by(user_id=user_id, is_active=True).first()
+        def store():
+            session = _active_user_session(user_id)
             
             if not session:
                 session = UserSession(user_id=user_id)
@@ -378,12 +777,13 @@ class UserSessionService:
             
             session.set_session_data(data)
             db.session.commit()
-            
+        
+        try:
+            await _run_db(store)
             return True
             
         except Exception as e:
             logger.error(f"Error updating user session data: {e}")
-            db.session.rollback()
             return False
 
 
@@ -391,63 +791,150 @@ class ExecutionLogService:
     """Сервис для логирования выполнений"""
     
     def __init__(self):
-        pass
+        self._buffer: List[Dict[str, Any]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_event: Optional[asyncio.Event] = None
+        # user_id -> агрегаты за EXECUTION_STATS_DAYS; снимок пересчитывается целиком
+        self._stats: Dict[int, Tuple] = {}
+        self._stats_refreshed_at: Optional[float] = None
     
     async def log_execution(self, user_id: int, workflow_id: str, execution_data: Dict[str, Any]) -> bool:
-        """Логирует выполнение workflow"""
+        """Логирует выполнение workflow (запись попадает в БД со следующей пачкой)
+        
+        True означает, что запись проверена и принята в буфер, а не что она уже
+        в БД. Запись at-most-once: буфер дописывается в close() при остановке,
+        но при аварийном завершении процесса несброшенные строки теряются.
+        """
         try:
-            execution_log = ExecutionLog(
-                user_id=user_id,
-                workflow_id=workflow_id,
-                execution_id=execution_data.get('execution_id'),
-                status=execution_data.get('status'),
-                start_time=execution_data.get('start_time'),
-                end_time=execution_data.get('end_time'),
-                duration=execution_data.get('duration'),
-                error_message=execution_data.get('error_message')
-            )
+            row = ExecutionLog.coerce_row({**execution_data, 'user_id': user_id, 'workflow_id': workflow_id})
+            row['created_at'] = datetime.utcnow()
+            self._buffer.append(row)
             
-            db.session.add(execution_log)
-            db.session.commit()
+            # Фоновая задача наследует контекст (в т.ч. app context Flask) от первого вызова
+            if self._flush_task is None or self._flush_task.done():
+                self._flush_event = asyncio.Event()
+                self._flush_task = asyncio.create_task(self._flusher())
+            if len(self._buffer) >= EXECUTION_LOG_BATCH_SIZE:
+                self._flush_event.set()
             
             return True
             
         except Exception as e:
             logger.error(f"Error logging execution: {e}")
-            db.session.rollback()
             return False
     
-    async def get_user_execution_logs(self, user_id: int, limit: int = 50) -> List[Dict[str, Any]]:
-        """Получает логи выполнений пользователя"""
+    async def flush(self) -> int:
+        """Вставляет накопленные логи пачкой, возвращает число записанных
+        
+        Строки, которые БД не приняла, отбрасываются по одной (ExecutionLog.insert_rows),
+        остальные строки пачки сохраняются.
+        """
+        if not self._buffer:
+            return 0
+        rows, self._buffer = self._buffer, []
+        
         try:
-            logs = ExecutionLog.query.filter_by(user_id=user_id)\
-                                   .order_by(ExecutionLog.created_at.desc())\
-                                   .limit(limit).all()
-            
-            return [log.to_dict() for log in logs]
+            return await _run_db(ExecutionLog.insert_rows, rows)
+        except Exception as e:
+            logger.error(f"Error flushing execution logs ({len(rows)} rows): {e}")
+            return 0
+    
+    async def _flusher(self):
+        """Сбрасывает буфер раз в EXECUTION_LOG_FLUSH_INTERVAL или по заполнению пачки"""
+        event = self._flush_event
+        while True:
+            try:
+                await asyncio.wait_for(event.wait(), EXECUTION_LOG_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            event.clear()
+            await self.flush()
+            # Снимок статистики, если его уже читали, обновляется здесь, а не на запросе
+            if self._stats_refreshed_at is not None and \
+                    time.monotonic() - self._stats_refreshed_at >= EXECUTION_STATS_REFRESH_INTERVAL:
+                await self.refresh_statistics()
+    
+    async def refresh_statistics(self):
+        """Пересчитывает снимок статистики за EXECUTION_STATS_DAYS для всех пользователей"""
+        await self.flush()
+        cutoff_date = datetime.utcnow() - timedelta(days=EXECUTION_STATS_DAYS)
+        
+        def load():
+            rows = db.session.query(ExecutionLog.user_id, *_EXECUTION_STATS_COLUMNS)\
+                             .filter(ExecutionLog.created_at >= cutoff_date)\
+                             .group_by(ExecutionLog.user_id)
+            return {row[0]: tuple(row[1:]) for row in rows}
+        
+        try:
+            self._stats = await _run_db(load)
+            self._stats_refreshed_at = time.monotonic()
+        except Exception as e:
+            logger.error(f"Error refreshing execution statistics: {e}")
+    
+    async def close(self):
+        """Останавливает фоновый сброс и дописывает остаток буфера"""
+        task, self._flush_task = self._flush_task, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+    
+    async def get_user_execution_logs(self, user_id: int, limit: int = 50,
+                                      before_created_at: Optional[datetime] = None,
+                                      before_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Получает логи выполнений пользователя
+        
+        Пагинация keyset по (created_at, id): для следующей страницы передаются
+        created_at и id последнего лога предыдущей. Без before_id берутся логи
+        строго раньше before_created_at.
+        """
+        def load():
+            params = {'uid': user_id, 'limit': limit}
+            if before_created_at is None:
+                statement = _USER_EXECUTION_LOGS
+            else:
+                statement = _USER_EXECUTION_LOGS_BEFORE
+                params['before_ts'] = before_created_at
+                params['before_id'] = before_id if before_id is not None else 0
+            rows = db.session.execute(statement, params)
+            return [_execution_log_row_to_dict(row) for row in rows]
+        
+        try:
+            await self.flush()
+            return await _run_db(load)
             
         except Exception as e:
             logger.error(f"Error getting user execution logs: {e}")
             return []
     
     async def get_execution_statistics(self, user_id: int, days: int = 7) -> Dict[str, Any]:
-        """Получает статистику выполнений пользователя"""
+        """Получает статистику выполнений пользователя
+        
+        За EXECUTION_STATS_DAYS данные берутся из общего снимка (могут отставать
+        до EXECUTION_STATS_REFRESH_INTERVAL), за другие периоды считаются запросом.
+        """
         try:
-            from datetime import datetime, timedelta
-            cutoff_date = datetime.utcnow() - timedelta(days=days)
-            
-            logs = ExecutionLog.query.filter(
-                ExecutionLog.user_id == user_id,
-                ExecutionLog.created_at >= cutoff_date
-            ).all()
-            
-            total_executions = len(logs)
-            successful = len([log for log in logs if log.status == 'success'])
-            failed = len([log for log in logs if log.status == 'error'])
-            
-            # Вычисляем среднее время выполнения
-            durations = [log.duration for log in logs if log.duration]
-            avg_duration = sum(durations) / len(durations) if durations else 0
+            if days == EXECUTION_STATS_DAYS:
+                if self._stats_refreshed_at is None or \
+                        time.monotonic() - self._stats_refreshed_at >= EXECUTION_STATS_REFRESH_INTERVAL:
+                    await self.refresh_statistics()
+                stats = self._stats.get(user_id, (0, 0, 0, None))
+            else:
+                await self.flush()
+                cutoff_date = datetime.utcnow() - timedelta(days=days)
+                
+                # Все агрегаты одним запросом: в Python приходит одна строка вместо всех логов
+                stats = await _run_db(
+                    lambda: db.session.query(*_EXECUTION_STATS_COLUMNS).filter(
+                        ExecutionLog.user_id == user_id,
+                        ExecutionLog.created_at >= cutoff_date
+                    ).one()
+                )
+            total_executions, successful, failed, avg_duration = stats
+            avg_duration = avg_duration or 0
             
             return {
                 'period_days': days,
@@ -1,14 +1,147 @@
-import json
 import logging
+import hashlib
+import orjson
+import re
 import asyncio
-from typing import Dict, List, Any, Optional, Callable
+import os
+import random
+import time
+from typing import Dict, List, Any, Optional, Callable, Tuple
 from datetime import datetime
 from enum import Enum
+from functools import lru_cache
+from collections import deque
+from itertools import islice
 import openai
-from openai import OpenAI
+from openai import AsyncOpenAI
+
+# tiktoken объявлен в requirements.txt; без него (или без его таблиц BPE) токены
+# считаются приблизительно, а не ломают сервис
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 logger = logging.getLogger(__name__)
 
+# Сколько запросов к OpenAI одновременно держит ThinkingService. Лимиты действуют на
+# экземпляр, поэтому в приложении он один (бот передает его в AgentOrchestrator)
+MAX_CONCURRENT_COMPLETIONS = int(os.getenv('OPENAI_MAX_CONCURRENCY', 8))
+
+# Лимиты аккаунта OpenAI: ограничитель держит запросы ниже них, а не ловит 429
+OPENAI_MAX_RPM = int(os.getenv('OPENAI_MAX_RPM', 500))
+OPENAI_MAX_TPM = int(os.getenv('OPENAI_MAX_TPM', 200000))
+# Оценка длины ответа для бюджета токенов, если max_tokens в запросе не передан
+COMPLETION_TOKENS_ESTIMATE = 512
+# OpenAI кэширует префикс запроса, только если он не короче этого числа токенов
+PROMPT_CACHE_MIN_TOKENS = 1024
+# Повторы после 429 и разброс паузы, чтобы повторы не шли одной волной
+RATE_LIMIT_RETRIES = 3
+RATE_LIMIT_JITTER = 1.0
+
+# Сколько последних мыслей хранится на агента
+THINKING_HISTORY_SIZE = 100
+
+# Кэш ответов модели на повтор одного и того же запроса одного агента
+# (агент, тип, уровень, контекст): время жизни и размер
+RESPONSE_CACHE_TTL = 600.0
+RESPONSE_CACHE_MAX_ENTRIES = 1024
+
+# Модель для всех запросов сервиса
+COMPLETION_MODEL = "gpt-4o-mini"
+
+# Пакетная рефлексия через Batch API: как часто проверять статус пакета
+BATCH_POLL_INTERVAL = 30.0
+_BATCH_FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+# Фоновая рефлексия истории: пакет отправляется, когда набралось столько мыслей без
+# рефлексии (меньшие не окупают ожидание), и содержит не больше REFLECTION_BACKFILL_MAX
+REFLECTION_BACKFILL_MIN = 20
+REFLECTION_BACKFILL_MAX = 500
+
+# Рефлексия и синтез отвечают JSON по схеме (Structured Outputs): ответ короче
+# и разбирается без регулярных выражений; max_tokens ограничивает длину ответа
+REFLECTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "quality": {"type": "number"},
+        "improvements": {"type": "array", "items": {"type": "string"}},
+        "alternatives": {"type": "array", "items": {"type": "string"}}
+    },
+    "required": ["quality", "improvements", "alternatives"],
+    "additionalProperties": False
+}
+SYNTHESIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "solution": {"type": "string"},
+        "common_ideas": {"type": "array", "items": {"type": "string"}},
+        "unique_proposals": {"type": "array", "items": {"type": "string"}},
+        "quality": {"type": "number"}
+    },
+    "required": ["solution", "common_ideas", "unique_proposals", "quality"],
+    "additionalProperties": False
+}
+REFLECTION_MAX_TOKENS = 300
+SYNTHESIS_MAX_TOKENS = 600
+_REFLECTION_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "reflection", "schema": REFLECTION_SCHEMA, "strict": True}
+}
+_SYNTHESIS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "synthesis", "schema": SYNTHESIS_SCHEMA, "strict": True}
+}
+
+# Признак структурированного ответа: строка, начинающаяся с пункта списка ("1.", "•", "-", "*")
+_STRUCTURE_RE = re.compile(r'(?:^|\n)\s*(?:\d+\.|[•\-\*])')
+
+# Вложенные значения контекста выводятся как JSON с отступами (ключи-не строки допустимы)
+_CONTEXT_JSON_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+
+# Ключ кэша ответов: контекст с отсортированными ключами, чтобы порядок ключей не влиял
+_CACHE_KEY_JSON_OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+
+# Общее начало всех запросов: первое system-сообщение одинаково для всех типов мышления,
+# поэтому OpenAI переиспользует закэшированный префикс. Сюда нельзя подставлять ничего
+# переменного (имя агента, время, контекст) - все динамическое идет в user-сообщение.
+_COMMON_PREAMBLE = """
+Ты - модуль мышления многоагентной системы, которая помогает пользователю Telegram-бота
+работать с n8n: подбирать и импортировать шаблоны workflows, настраивать и запускать их,
+следить за состоянием сервера n8n и выполнениями. Агенты системы обмениваются мыслями,
+планами и выводами; твой ответ прочитает другой агент или пользователь.
+
+Общие правила для всех модулей:
+1. Отвечай на русском языке.
+2. Опирайся только на переданный контекст; не выдумывай данные, которых в нем нет.
+3. Явно отмечай допущения и места, где данных недостаточно.
+4. Отвечай структурированно: нумерованные пункты или короткие списки.
+5. Будь конкретным: называй workflows, ноды, шаги и проверки, а не общие слова.
+6. Учитывай ограничения n8n: лимиты API, активность workflows, права и учетные данные.
+"""
+
+_REFLECTION_SYSTEM_PROMPT = """
+Ты - модуль рефлексии. Анализируй мысли других агентов.
+
+Рефлексия:
+1. Насколько качественна эта мысль? (quality - оценка от 0 до 1)
+2. Что можно улучшить? (improvements - короткие пункты)
+3. Какие есть альтернативы? (alternatives - короткие пункты)
+
+Будь конструктивным и честным. Пиши кратко: только суть, без вступлений.
+"""
+
+_SYNTHESIS_SYSTEM_PROMPT = """
+Ты - модуль синтеза коллективного мышления.
+
+Синтезируй лучшее решение:
+1. Найди общие идеи (common_ideas)
+2. Выдели уникальные предложения (unique_proposals)
+3. Объедини в комплексное решение (solution)
+4. Оцени качество синтеза (quality - от 0 до 1)
+
+Будь объективным и конструктивным.
+"""
+
 class ThinkingType(Enum):
     """Типы мышления агента"""
     ANALYSIS = "analysis"
@@ -24,13 +157,337 @@ class ThoughtLevel(Enum):
     DEEP = "deep"           # Глубокий анализ
     METACOGNITIVE = "meta"  # Мышление о мышлении
 
+class _RateLimiter:
+    """Ограничитель запросов к OpenAI по двум ведрам: запросы и токены в минуту
+    
+    Ведра пополняются непрерывно со скоростью rpm/60 и tpm/60 в секунду и
+    вмещают минутный лимит; запрос уходит, когда в обоих хватает на его стоимость.
+    """
+    
+    __slots__ = ('rpm', 'tpm', '_requests', '_tokens', '_updated', '_lock')
+    
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+    
+    async def acquire(self, tokens: int):
+        """Ждет, пока в ведрах хватит на один запрос и tokens токенов, и списывает их"""
+        # Запрос дороже всего ведра иначе не дождался бы никогда
+        tokens = min(tokens, self.tpm)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep(max(
+                    (1 - self._requests) * 60 / self.rpm,
+                    (tokens - self._tokens) * 60 / self.tpm
+                ))
+    
+    def penalize(self, delay: float):
+        """После 429 опустошает ведра так, чтобы новые запросы пошли не раньше чем через delay"""
+        self._refill()
+        self._requests = min(self._requests, 0.0) - delay * self.rpm / 60
+        self._tokens = min(self._tokens, 0.0) - delay * self.tpm / 60
+
+@lru_cache(maxsize=1)
+def _token_encoder():
+    """BPE-кодировщик модели; загружается один раз, None без tiktoken или его таблиц
+    
+    Первая загрузка синхронно скачивает таблицы BPE, поэтому из event loop
+    кодировщик загружается через _load_token_encoder.
+    """
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(COMPLETION_MODEL)
+    except Exception as e:
+        logger.warning(f"tiktoken encoder unavailable, falling back to length estimate: {e}")
+        return None
+
+async def _load_token_encoder():
+    """Загружает кодировщик в потоке, не блокируя event loop на скачивании таблиц"""
+    if not _token_encoder.cache_info().currsize:
+        await asyncio.to_thread(_token_encoder)
+
+def _count_tokens(text: str) -> int:
+    """Число токенов текста: точно через tiktoken, иначе ~4 символа на токен"""
+    encoder = _token_encoder()
+    if encoder is None:
+        return len(text) // 4
+    return len(encoder.encode(text))
+
+@lru_cache(maxsize=16)
+def _prefix_tokens(system_prompt: str) -> int:
+    """Длина статичного префикса запроса (преамбула + промпт модуля) в токенах"""
+    tokens = _count_tokens(_COMMON_PREAMBLE) + _count_tokens(system_prompt)
+    if tokens < PROMPT_CACHE_MIN_TOKENS:
+        logger.debug("Prompt prefix is %d tokens, below the %d-token cache threshold",
+                     tokens, PROMPT_CACHE_MIN_TOKENS)
+    return tokens
+
+def _estimate_tokens(system_prompt: str, user_content: str,
+                     completion_tokens: int = COMPLETION_TOKENS_ESTIMATE) -> int:
+    """Стоимость запроса для ограничителя: префикс, данные запроса и ожидаемый ответ"""
+    return _prefix_tokens(system_prompt) + _count_tokens(user_content) + completion_tokens
+
+def _rate_limit_delay(error: 'openai.RateLimitError', attempt: int) -> float:
+    """Пауза после 429: Retry-After от OpenAI либо экспоненциальный backoff"""
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+    return float(2 ** attempt)
+
+def _build_messages(system_prompt: str, user_content: str) -> List[Dict[str, str]]:
+    """Сообщения запроса в порядке от статичного к динамичному: общая преамбула,
+    промпт модуля, затем данные запроса"""
+    return [
+        {"role": "system", "content": _COMMON_PREAMBLE},
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_content}
+    ]
+
+def _reflection_request(agent_name: str, thought: Dict[str, Any]) -> str:
+    """Данные для рефлексии над мыслью агента"""
+    return f"""
+            Проанализируй эту мысль агента {agent_name}:
+            
+            Тип мышления: {thought['type']}
+            Уровень: {thought['level']}
+            Содержание: {thought['content']}
+            """
+
+def _format_points(title: str, items: List[str]) -> str:
+    """Раздел текстового представления структурированного ответа"""
+    if not items:
+        return ""
+    return f"\n{title}:\n" + "\n".join(f"- {item}" for item in items)
+
+def _parse_reflection(raw: str) -> Dict[str, Any]:
+    """Поля рефлексии из JSON-ответа модели и их текстовое представление"""
+    data = orjson.loads(raw)
+    return {
+        'content': (f"Качество: {data['quality']}"
+                    + _format_points("Что улучшить", data['improvements'])
+                    + _format_points("Альтернативы", data['alternatives'])),
+        'model_quality': data['quality'],
+        'improvements': data['improvements'],
+        'alternatives': data['alternatives']
+    }
+
+@lru_cache(maxsize=8)
+def _get_analysis_prompt(level: ThoughtLevel) -> str:
+    """Промпт для аналитического мышления"""
+    base_prompt = """
+    Ты - аналитический модуль агента n8n. Твоя задача - глубоко анализировать ситуацию.
+    
+    Анализируй:
+    1. Текущую ситуацию
+    2. Доступные данные
+    3. Возможные проблемы
+    4. Потенциальные решения
+    
+    Отвечай структурированно и логично.
+    """
+    
+    if level == ThoughtLevel.DEEP:
+        base_prompt += """
+        
+        Проведи ГЛУБОКИЙ анализ:
+        - Рассмотри скрытые связи
+        - Найди неочевидные паттерны
+        - Предскажи возможные последствия
+        - Оцени риски и возможности
+        """
+    elif level == ThoughtLevel.METACOGNITIVE:
+        base_prompt += """
+        
+        Проведи МЕТАКОГНИТИВНЫЙ анализ:
+        - Анализируй свой процесс анализа
+        - Оцени качество своих рассуждений
+        - Найди слабые места в логике
+        - Предложи улучшения методологии
+        """
+    
+    return base_prompt
+
+@lru_cache(maxsize=8)
+def _get_planning_prompt(level: ThoughtLevel) -> str:
+    """Промпт для планирования"""
+    return """
+    Ты - модуль планирования агента n8n. Создавай детальные планы действий.
+    
+    Планируй:
+    1. Последовательность действий
+    2. Необходимые ресурсы
+    3. Временные рамки
+    4. Точки контроля
+    5. План Б на случай проблем
+    
+    Будь конкретным и практичным.
+    """
+
+@lru_cache(maxsize=8)
+def _get_reflection_prompt(level: ThoughtLevel) -> str:
+    """Промпт для рефлексии"""
+    return """
+    Ты - модуль рефлексии агента n8n. Анализируй прошлые действия и решения.
+    
+    Рефлексируй:
+    1. Что прошло хорошо?
+    2. Что можно было сделать лучше?
+    3. Какие уроки извлечь?
+    4. Как применить опыт в будущем?
+    
+    Будь честным и конструктивным.
+    """
+
+@lru_cache(maxsize=8)
+def _get_decision_prompt(level: ThoughtLevel) -> str:
+    """Промпт для принятия решений"""
+    return """
+    Ты - модуль принятия решений агента n8n. Принимай обоснованные решения.
+    
+    Процесс принятия решения:
+    1. Определи варианты
+    2. Оцени плюсы и минусы каждого
+    3. Учти ограничения и риски
+    4. Выбери оптимальный вариант
+    5. Обоснуй выбор
+    
+    Будь логичным и решительным.
+    """
+
+@lru_cache(maxsize=8)
+def _get_learning_prompt(level: ThoughtLevel) -> str:
+    """Промпт для обучения"""
+    return """
+    Ты - модуль обучения агента n8n. Извлекай знания из опыта.
+    
+    Обучение:
+    1. Что нового узнал?
+    2. Какие паттерны обнаружил?
+    3. Как обновить знания?
+    4. Что запомнить на будущее?
+    
+    Будь любознательным и систематичным.
+    """
+
+@lru_cache(maxsize=8)
+def _get_problem_solving_prompt(level: ThoughtLevel) -> str:
+    """Промпт для решения проблем"""
+    return """
+    Ты - модуль решения проблем агента n8n. Находи творческие решения.
+    
+    Решение проблем:
+    1. Четко определи проблему
+    2. Найди корень проблемы
+    3. Сгенерируй варианты решений
+    4. Оцени осуществимость каждого
+    5. Выбери лучшее решение
+    
+    Будь креативным и практичным.
+    """
+
+# Промпт модуля по типу мышления; строится один раз на пару (тип, уровень)
+_PROMPT_BUILDERS = {
+    ThinkingType.ANALYSIS: _get_analysis_prompt,
+    ThinkingType.PLANNING: _get_planning_prompt,
+    ThinkingType.REFLECTION: _get_reflection_prompt,
+    ThinkingType.DECISION: _get_decision_prompt,
+    ThinkingType.LEARNING: _get_learning_prompt,
+    ThinkingType.PROBLEM_SOLVING: _get_problem_solving_prompt
+}
+
 class ThinkingService:
     """Сервис для системы мышления агентов"""
     
     def __init__(self):
-        self.openai_client = OpenAI()
+        # Асинхронный клиент: ожидание ответа модели не блокирует event loop
+        self.openai_client = AsyncOpenAI()
+        self._completion_semaphore = asyncio.Semaphore(MAX_CONCURRENT_COMPLETIONS)
+        self._limiter = _RateLimiter(OPENAI_MAX_RPM, OPENAI_MAX_TPM)
+        # Счетчики токенов промптов: сколько из них OpenAI взял из кэша префиксов
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+        # ключ запроса -> (time.monotonic() записи, ответ модели); повтор запроса агента
+        # в пределах RESPONSE_CACHE_TTL не идет в модель, а одновременные повторы ждут один запрос.
+        # Агент входит в ключ: разные агенты с одним контекстом получают независимые ответы
+        self._response_cache: Dict[str, Tuple[float, str]] = {}
+        self._pending_responses: Dict[str, asyncio.Task] = {}
         self.thinking_history = {}
         self.reflection_patterns = {}
+    
+    async def _complete(self, system_prompt: str, user_content: str, temperature: float,
+                        response_format: Optional[Dict[str, Any]] = None,
+                        max_tokens: Optional[int] = None) -> str:
+        """Запрос к модели в пределах лимитов RPM/TPM и числа одновременных запросов
+        
+        response_format и max_tokens передаются в API, только если заданы.
+        """
+        messages = _build_messages(system_prompt, user_content)
+        extra = {}
+        if response_format is not None:
+            extra['response_format'] = response_format
+        if max_tokens is not None:
+            extra['max_tokens'] = max_tokens
+        await _load_token_encoder()
+        estimated_tokens = _estimate_tokens(
+            system_prompt, user_content, max_tokens or COMPLETION_TOKENS_ESTIMATE
+        )
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            await self._limiter.acquire(estimated_tokens)
+            try:
+                async with self._completion_semaphore:
+                    response = await self.openai_client.chat.completions.create(
+                        model=COMPLETION_MODEL,
+                        messages=messages,
+                        temperature=temperature,
+                        **extra
+                    )
+                break
+            except openai.RateLimitError as e:
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise
+                delay = _rate_limit_delay(e, attempt)
+                logger.warning(f"OpenAI rate limit hit, retrying in {delay:.1f}s: {e}")
+                self._limiter.penalize(delay)
+                await asyncio.sleep(random.uniform(0, RATE_LIMIT_JITTER))
+        self._track_prompt_cache(response.usage)
+        return response.choices[0].message.content
+    
+    async def warm_up(self):
+        """Загружает кодировщик токенов заранее (вызывается при старте бота)"""
+        await _load_token_encoder()
+    
+    def _track_prompt_cache(self, usage):
+        """Учитывает попадания в кэш промптов OpenAI"""
+        if not usage:
+            return
+        details = getattr(usage, 'prompt_tokens_details', None)
+        self.prompt_tokens += usage.prompt_tokens or 0
+        self.cached_prompt_tokens += getattr(details, 'cached_tokens', None) or 0
+        if self.prompt_tokens:
+            logger.debug("Prompt cache hit rate: %.1f%% (%d of %d prompt tokens)",
+                         self.cached_prompt_tokens * 100 / self.prompt_tokens,
+                         self.cached_prompt_tokens, self.prompt_tokens)
         
     async def think(self, 
                    agent_name: str,
@@ -38,12 +495,15 @@ class ThinkingService:
                    thinking_type: ThinkingType,
                    level: ThoughtLevel = ThoughtLevel.SURFACE) -> Dict[str, Any]:
         """Основной метод мышления"""
+        # Одно время на весь вызов: мысль, рефлексия и ошибка получают одну метку
+        now_iso = datetime.now().isoformat()
         try:
-            thought_id = f"{agent_name}_{int(datetime.now().timestamp())}"
+            # Наносекунды: мысли одного агента в одну секунду не получают одинаковый id
+            thought_id = f"{agent_name}_{time.time_ns()}"
             
             # Генерируем мысль
             thought = await self._generate_thought(
-                agent_name, context, thinking_type, level
+                agent_name, context, thinking_type, level, now_iso
             )
             
             # Сохраняем в историю
@@ -51,7 +511,7 @@ class ThinkingService:
             
             # Выполняем рефлексию если нужно
             if level in [ThoughtLevel.DEEP, ThoughtLevel.METACOGNITIVE]:
-                reflection = await self._reflect_on_thought(agent_name, thought)
+                reflection = await self._reflect_on_thought(agent_name, thought, now_iso)
                 thought['reflection'] = reflection
             
             return thought
@@ -62,7 +522,7 @@ class ThinkingService:
                 'type': thinking_type.value,
                 'level': level.value,
                 'content': f"Ошибка мышления: {str(e)}",
-                'timestamp': datetime.now().isoformat(),
+                'timestamp': now_iso,
                 'success': False
             }
     
@@ -70,42 +530,30 @@ class ThinkingService:
                                agent_name: str,
                                context: Dict[str, Any],
                                thinking_type: ThinkingType,
-                               level: ThoughtLevel) -> Dict[str, Any]:
+                               level: ThoughtLevel,
+                               now_iso: Optional[str] = None) -> Dict[str, Any]:
         """Генерирует мысль с помощью LLM"""
+        now_iso = now_iso or datetime.now().isoformat()
         
-        system_prompts = {
-            ThinkingType.ANALYSIS: self._get_analysis_prompt(level),
-            ThinkingType.PLANNING: self._get_planning_prompt(level),
-            ThinkingType.REFLECTION: self._get_reflection_prompt(level),
-            ThinkingType.DECISION: self._get_decision_prompt(level),
-            ThinkingType.LEARNING: self._get_learning_prompt(level),
-            ThinkingType.PROBLEM_SOLVING: self._get_problem_solving_prompt(level)
-        }
-        
-        system_prompt = system_prompts.get(thinking_type, "Проанализируй ситуацию.")
+        prompt_builder = _PROMPT_BUILDERS.get(thinking_type)
+        system_prompt = prompt_builder(level) if prompt_builder else "Проанализируй ситуацию."
         
         # Формируем контекст для LLM
         context_text = self._format_context(context)
         
         try:
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"Контекст: {context_text}"}
-                ],
-                temperature=0.7
+            thought_content = await self._cached_complete(
+                self._response_key(agent_name, thinking_type, level, context),
+                system_prompt, f"Контекст: {context_text}", 0.7
             )
             
-            thought_content = response.choices[0].message.content
-            
             return {
                 'agent': agent_name,
                 'type': thinking_type.value,
                 'level': level.value,
                 'content': thought_content,
                 'context': context,
-                'timestamp': datetime.now().isoformat(),
+                'timestamp': now_iso,
                 'success': True
             }
             
@@ -116,130 +564,60 @@ class ThinkingService:
                 'type': thinking_type.value,
                 'level': level.value,
                 'content': f"Не удалось сгенерировать мысль: {str(e)}",
-                'timestamp': datetime.now().isoformat(),
+                'timestamp': now_iso,
                 'success': False
             }
     
-    def _get_analysis_prompt(self, level: ThoughtLevel) -> str:
-        """Промпт для аналитического мышления"""
-        base_prompt = """
-        Ты - аналитический модуль агента n8n. Твоя задача - глубоко анализировать ситуацию.
-        
-        Анализируй:
-        1. Текущую ситуацию
-        2. Доступные данные
-        3. Возможные проблемы
-        4. Потенциальные решения
-        
-        Отвечай структурированно и логично.
-        """
-        
-        if level == ThoughtLevel.DEEP:
-            base_prompt += """
-            
-            Проведи ГЛУБОКИЙ анализ:
-            - Рассмотри скрытые связи
-            - Найди неочевидные паттерны
-            - Предскажи возможные последствия
-            - Оцени риски и возможности
-            """
-        elif level == ThoughtLevel.METACOGNITIVE:
-            base_prompt += """
-            
-            Проведи МЕТАКОГНИТИВНЫЙ анализ:
-            - Анализируй свой процесс анализа
-            - Оцени качество своих рассуждений
-            - Найди слабые места в логике
-            - Предложи улучшения методологии
-            """
-        
-        return base_prompt
-    
-    def _get_planning_prompt(self, level: ThoughtLevel) -> str:
-        """Промпт для планирования"""
-        return """
-        Ты - модуль планирования агента n8n. Создавай детальные планы действий.
+    @staticmethod
+    def _response_key(agent_name: str, thinking_type: ThinkingType, level: ThoughtLevel,
+                      context: Dict[str, Any]) -> str:
+        """Ключ кэша ответов: хэш агента, типа, уровня и нормализованного контекста
         
-        Планируй:
-        1. Последовательность действий
-        2. Необходимые ресурсы
-        3. Временные рамки
-        4. Точки контроля
-        5. План Б на случай проблем
-        
-        Будь конкретным и практичным.
+        Ответ модели семплируется (temperature > 0), поэтому переиспользуется
+        только для повтора запроса того же агента: в коллективном мышлении
+        каждый агент должен получить свою мысль, а не копию чужой.
         """
+        context_json = orjson.dumps(context, option=_CACHE_KEY_JSON_OPTIONS, default=str)
+        return hashlib.blake2b(
+            orjson.dumps([agent_name, thinking_type.value, level.value]) + context_json, digest_size=16
+        ).hexdigest()
     
-    def _get_reflection_prompt(self, level: ThoughtLevel) -> str:
-        """Промпт для рефлексии"""
-        return """
-        Ты - модуль рефлексии агента n8n. Анализируй прошлые действия и решения.
-        
-        Рефлексируй:
-        1. Что прошло хорошо?
-        2. Что можно было сделать лучше?
-        3. Какие уроки извлечь?
-        4. Как применить опыт в будущем?
+    async def _cached_complete(self, key: str, system_prompt: str, user_content: str,
+                               temperature: float) -> str:
+        """_complete с кэшем ответов и объединением одновременных одинаковых запросов"""
+        entry = self._response_cache.get(key)
+        if entry is not None and time.monotonic() - entry[0] < RESPONSE_CACHE_TTL:
+            logger.debug("Thought response cache hit: %s", key)
+            return entry[1]
         
-        Будь честным и конструктивным.
-        """
+        task = self._pending_responses.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._complete(system_prompt, user_content, temperature))
+            self._pending_responses[key] = task
+            task.add_done_callback(lambda done: self._finish_response(key, done))
+        # shield: отмена одного из ждущих не отменяет общий запрос
+        return await asyncio.shield(task)
     
-    def _get_decision_prompt(self, level: ThoughtLevel) -> str:
-        """Промпт для принятия решений"""
-        return """
-        Ты - модуль принятия решений агента n8n. Принимай обоснованные решения.
-        
-        Процесс принятия решения:
-        1. Определи варианты
-        2. Оцени плюсы и минусы каждого
-        3. Учти ограничения и риски
-        4. Выбери оптимальный вариант
-        5. Обоснуй выбор
-        
-        Будь логичным и решительным.
-        """
-    
-    def _get_learning_prompt(self, level: ThoughtLevel) -> str:
-        """Промпт для обучения"""
-        return """
-        Ты - модуль обучения агента n8n. Извлекай знания из опыта.
-        
-        Обучение:
-        1. Что нового узнал?
-        2. Какие паттерны обнаружил?
-        3. Как обновить знания?
-        4. Что запомнить на будущее?
-        
-        Будь любознательным и систематичным.
-        """
-    
-    def _get_problem_solving_prompt(self, level: ThoughtLevel) -> str:
-        """Промпт для решения проблем"""
-        return """
-        Ты - модуль решения проблем агента n8n. Находи творческие решения.
-        
-        Решение проблем:
-        1. Четко определи проблему
-        2. Найди корень проблемы
-        3. Сгенерируй варианты решений
-        4. Оцени осуществимость каждого
-        5. Выбери лучшее решение
-        
-        Будь креативным и практичным.
-        """
+    def _finish_response(self, key: str, task: asyncio.Task):
+        """Снимает запрос из ожидающих и кэширует успешный ответ"""
+        self._pending_responses.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        cache = self._response_cache
+        cache.pop(key, None)
+        if len(cache) >= RESPONSE_CACHE_MAX_ENTRIES:
+            # Словарь хранит порядок вставки: первым удаляется самый старый ответ
+            del cache[next(iter(cache))]
+        cache[key] = (time.monotonic(), task.result())
     
     def _format_context(self, context: Dict[str, Any]) -> str:
         """Форматирует контекст для LLM"""
         try:
-            formatted_parts = []
-            
-            for key, value in context.items():
-                if isinstance(value, (dict, list)):
-                    formatted_parts.append(f"{key}: {json.dumps(value, ensure_ascii=False, indent=2)}")
-                else:
-                    formatted_parts.append(f"{key}: {value}")
-            
-            return "\n".join(formatted_parts)
+            return "\n".join([
+                f"{key}: {orjson.dumps(value, option=_CONTEXT_JSON_OPTIONS).decode()}"
+                if isinstance(value, (dict, list, tuple)) else f"{key}: {value}"
+                for key, value in context.items()
+            ])
             
         except Exception as e:
             logger.error(f"Error formatting context: {e}")
@@ -248,52 +626,28 @@ class ThinkingService:
     async def _store_thought(self, agent_name: str, thought_id: str, thought: Dict[str, Any]):
         """Сохраняет мысль в историю"""
         try:
-            if agent_name not in self.thinking_history:
-                self.thinking_history[agent_name] = []
-            
-            self.thinking_history[agent_name].append({
+            # deque с maxlen сам вытесняет старые мысли, без копирования истории
+            self.thinking_history.setdefault(agent_name, deque(maxlen=THINKING_HISTORY_SIZE)).append({
                 'id': thought_id,
                 'thought': thought
             })
             
-            # Ограничиваем размер истории
-            if len(self.thinking_history[agent_name]) > 100:
-                self.thinking_history[agent_name] = self.thinking_history[agent_name][-100:]
-                
         except Exception as e:
             logger.error(f"Error storing thought: {e}")
     
-    async def _reflect_on_thought(self, agent_name: str, thought: Dict[str, Any]) -> Dict[str, Any]:
+    async def _reflect_on_thought(self, agent_name: str, thought: Dict[str, Any],
+                                  now_iso: Optional[str] = None) -> Dict[str, Any]:
         """Выполняет рефлексию над мыслью"""
+        now_iso = now_iso or datetime.now().isoformat()
         try:
-            reflection_prompt = f"""
-            Проанализируй эту мысль агента {agent_name}:
-            
-            Тип мышления: {thought['type']}
-            Уровень: {thought['level']}
-            Содержание: {thought['content']}
-            
-            Рефлексия:
-            1. Насколько качественна эта мысль?
-            2. Что можно улучшить?
-            3. Какие есть альтернативы?
-            4. Как это поможет в будущем?
-            
-            Будь конструктивным и честным.
-            """
-            
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "Ты - модуль рефлексии. Анализируй мысли других агентов."},
-                    {"role": "user", "content": reflection_prompt}
-                ],
-                temperature=0.5
+            raw = await self._complete(
+                _REFLECTION_SYSTEM_PROMPT, _reflection_request(agent_name, thought), temperature=0.5,
+                response_format=_REFLECTION_RESPONSE_FORMAT, max_tokens=REFLECTION_MAX_TOKENS
             )
             
             return {
-                'content': response.choices[0].message.content,
-                'timestamp': datetime.now().isoformat(),
+                **_parse_reflection(raw),
+                'timestamp': now_iso,
                 'quality_score': self._assess_thought_quality(thought)
             }
             
@@ -301,10 +655,111 @@ class ThinkingService:
             logger.error(f"Error in reflection: {e}")
             return {
                 'content': f"Ошибка рефлексии: {str(e)}",
-                'timestamp': datetime.now().isoformat(),
+                'timestamp': now_iso,
                 'quality_score': 0.5
             }
     
+    async def reflect_bulk(self, thoughts: List[Dict[str, Any]],
+                           poll_interval: float = BATCH_POLL_INTERVAL) -> List[Dict[str, Any]]:
+        """Рефлексия над множеством мыслей через OpenAI Batch API
+        
+        Для офлайн-анализа истории: дешевле и с большими лимитами, но результат
+        приходит в пределах окна пакета (до 24 часов), а не сразу. Мысли - словари
+        из think(); результаты возвращаются в том же порядке и формате, что
+        у _reflect_on_thought. Интерактивная рефлексия остается на обычном пути.
+        """
+        if not thoughts:
+            return []
+        
+        try:
+            lines = [
+                orjson.dumps({
+                    'custom_id': str(index),
+                    'method': 'POST',
+                    'url': '/v1/chat/completions',
+                    'body': {
+                        'model': COMPLETION_MODEL,
+                        'messages': _build_messages(
+                            _REFLECTION_SYSTEM_PROMPT,
+                            _reflection_request(thought.get('agent', 'unknown'), thought)
+                        ),
+                        'temperature': 0.5,
+                        'response_format': _REFLECTION_RESPONSE_FORMAT,
+                        'max_tokens': REFLECTION_MAX_TOKENS
+                    }
+                })
+                for index, thought in enumerate(thoughts)
+            ]
+            batch_file = await self.openai_client.files.create(
+                file=('reflections.jsonl', b'\n'.join(lines)), purpose='batch'
+            )
+            batch = await self.openai_client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint='/v1/chat/completions',
+                completion_window='24h'
+            )
+            
+            while batch.status not in _BATCH_FINAL_STATUSES:
+                await asyncio.sleep(poll_interval)
+                batch = await self.openai_client.batches.retrieve(batch.id)
+            
+            contents = {}
+            if batch.output_file_id:
+                output = await self.openai_client.files.content(batch.output_file_id)
+                for line in output.content.splitlines():
+                    if not line.strip():
+                        continue
+                    item = orjson.loads(line)
+                    response = item.get('response') or {}
+                    if response.get('status_code') == 200:
+                        contents[item['custom_id']] = response['body']['choices'][0]['message']['content']
+            
+        except Exception as e:
+            logger.error(f"Error in bulk reflection: {e}")
+            contents, batch = {}, None
+        
+        timestamp = datetime.now().isoformat()
+        reflections = []
+        for index, thought in enumerate(thoughts):
+            raw = contents.get(str(index))
+            try:
+                if raw is None:
+                    status = batch.status if batch is not None else 'error'
+                    raise ValueError(f"пакет {status}, ответа нет")
+                reflections.append({
+                    **_parse_reflection(raw),
+                    'timestamp': timestamp,
+                    'quality_score': self._assess_thought_quality(thought)
+                })
+            except Exception as e:
+                reflections.append({
+                    'content': f"Ошибка рефлексии: {str(e)}",
+                    'timestamp': timestamp,
+                    'quality_score': 0.5
+                })
+        return reflections
+    
+    async def backfill_reflections(self, min_thoughts: int = REFLECTION_BACKFILL_MIN,
+                                   limit: int = REFLECTION_BACKFILL_MAX) -> int:
+        """Рефлексия задним числом над мыслями истории, у которых ее нет (через reflect_bulk)
+        
+        Рефлексия записывается в саму мысль и учитывается в get_thinking_summary.
+        Возвращает число обработанных мыслей; если их меньше min_thoughts, пакет
+        не отправляется.
+        """
+        pending = [
+            item['thought']
+            for history in self.thinking_history.values() for item in history
+            if item['thought'].get('success') and 'reflection' not in item['thought']
+        ][:limit]
+        if len(pending) < min_thoughts:
+            return 0
+        
+        reflections = await self.reflect_bulk(pending)
+        for thought, reflection in zip(pending, reflections):
+            thought.setdefault('reflection', reflection)
+        return len(pending)
+    
     def _assess_thought_quality(self, thought: Dict[str, Any]) -> float:
         """Оценивает качество мысли"""
         try:
@@ -322,7 +777,7 @@ class ThinkingService:
                 score += 0.1
             
             # Проверяем структурированность
-            if any(marker in content.lower() for marker in ['1.', '2.', '•', '-']):
+            if _STRUCTURE_RE.search(content):
                 score += 0.1
             
             return min(score, 1.0)
@@ -333,9 +788,10 @@ class ThinkingService:
     
     async def get_thinking_summary(self, agent_name: str, limit: int = 10) -> Dict[str, Any]:
         """Получает сводку мышления агента"""
+        now_iso = datetime.now().isoformat()
         try:
-            history = self.thinking_history.get(agent_name, [])
-            recent_thoughts = history[-limit:] if history else []
+            history = self.thinking_history.get(agent_name, ())
+            recent_thoughts = list(islice(history, max(len(history) - limit, 0), None))
             
             if not recent_thoughts:
                 return {
@@ -365,7 +821,7 @@ class ThinkingService:
                 'recent_thoughts': recent_thoughts,
                 'thinking_patterns': thinking_types,
                 'average_quality': avg_quality,
-                'timestamp': datetime.now().isoformat()
+                'timestamp': now_iso
             }
             
         except Exception as e:
@@ -373,7 +829,7 @@ class ThinkingService:
             return {
                 'agent': agent_name,
                 'error': str(e),
-                'timestamp': datetime.now().isoformat()
+                'timestamp': now_iso
             }
     
     async def collaborative_thinking(self, 
@@ -381,27 +837,39 @@ class ThinkingService:
                                    problem: str,
                                    context: Dict[str, Any]) -> Dict[str, Any]:
         """Коллективное мышление нескольких агентов"""
+        now_iso = datetime.now().isoformat()
         try:
-            collaborative_thoughts = {}
+            # Каждый агент думает независимо, все запросы к модели идут параллельно
+            agent_context = {**context, 'problem': problem}
+            results = await asyncio.gather(
+                *(self.think(agent, agent_context, ThinkingType.PROBLEM_SOLVING, ThoughtLevel.DEEP)
+                  for agent in agents),
+                return_exceptions=True
+            )
             
-            # Каждый агент думает независимо
-            for agent in agents:
-                thought = await self.think(
-                    agent, 
-                    {**context, 'problem': problem},
-                    ThinkingType.PROBLEM_SOLVING,
-                    ThoughtLevel.DEEP
-                )
+            collaborative_thoughts = {}
+            for agent, thought in zip(agents, results):
+                if isinstance(thought, Exception):
+                    # Сбой одного агента не отменяет мысли остальных
+                    logger.error(f"Error in collaborative thinking of agent {agent}: {thought}")
+                    thought = {
+                        'agent': agent,
+                        'type': ThinkingType.PROBLEM_SOLVING.value,
+                        'level': ThoughtLevel.DEEP.value,
+                        'content': f"Ошибка мышления: {str(thought)}",
+                        'timestamp': now_iso,
+                        'success': False
+                    }
                 collaborative_thoughts[agent] = thought
             
             # Синтезируем коллективное решение
-            synthesis = await self._synthesize_thoughts(collaborative_thoughts, problem)
+            synthesis = await self._synthesize_thoughts(collaborative_thoughts, problem, now_iso)
             
             return {
                 'problem': problem,
                 'individual_thoughts': collaborative_thoughts,
                 'synthesis': synthesis,
-                'timestamp': datetime.now().isoformat()
+                'timestamp': now_iso
             }
             
         except Exception as e:
@@ -409,11 +877,13 @@ class ThinkingService:
             return {
                 'problem': problem,
                 'error': str(e),
-                'timestamp': datetime.now().isoformat()
+                'timestamp': now_iso
             }
     
-    async def _synthesize_thoughts(self, thoughts: Dict[str, Any], problem: str) -> Dict[str, Any]:
+    async def _synthesize_thoughts(self, thoughts: Dict[str, Any], problem: str,
+                                   now_iso: Optional[str] = None) -> Dict[str, Any]:
         """Синтезирует мысли разных агентов"""
+        now_iso = now_iso or datetime.now().isoformat()
         try:
             synthesis_prompt = f"""
             Проблема: {problem}
@@ -424,38 +894,27 @@ class ThinkingService:
             for agent, thought in thoughts.items():
                 synthesis_prompt += f"\n{agent}: {thought.get('content', 'Нет мысли')}\n"
             
-            synthesis_prompt += """
-            
-            Синтезируй лучшее решение:
-            1. Найди общие идеи
-            2. Выдели уникальные предложения
-            3. Объедини в комплексное решение
-            4. Оцени качество синтеза
-            
-            Будь объективным и конструктивным.
-            """
-            
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "Ты - модуль синтеза коллективного мышления."},
-                    {"role": "user", "content": synthesis_prompt}
-                ],
-                temperature=0.6
+            raw = await self._complete(
+                _SYNTHESIS_SYSTEM_PROMPT, synthesis_prompt, temperature=0.6,
+                response_format=_SYNTHESIS_RESPONSE_FORMAT, max_tokens=SYNTHESIS_MAX_TOKENS
             )
+            data = orjson.loads(raw)
             
             return {
-                'content': response.choices[0].message.content,
+                'content': data['solution'],
+                'common_ideas': data['common_ideas'],
+                'unique_proposals': data['unique_proposals'],
+                'model_quality': data['quality'],
                 'participating_agents': list(thoughts.keys()),
                 'synthesis_quality': self._assess_synthesis_quality(thoughts),
-                'timestamp': datetime.now().isoformat()
+                'timestamp': now_iso
             }
             
         except Exception as e:
             logger.error(f"Error synthesizing thoughts: {e}")
             return {
                 'content': f"Ошибка синтеза: {str(e)}",
-                'timestamp': datetime.now().isoformat()
+                'timestamp': now_iso
             }
     
     def _assess_synthesis_quality(self, thoughts: Dict[str, Any]) -> float:
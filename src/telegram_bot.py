@@ -15,7 +15,7 @@ import openai
 from openai import OpenAI
 
 from src.services.template_service import TemplateService, UserWorkflowService, UserSessionService, ExecutionLogService
-from src.services.n8n_api import N8nApiClient
+from src.services.n8n_api import N8nApiClient, close_shared_sessions
 from src.services.voice_service import VoiceService, MemoryService, ReminderService
 from src.services.thinking_service import ThinkingService, ThinkingType, ThoughtLevel
 from src.services.agent_orchestrator import AgentOrchestrator, TaskPriority
@@ -48,7 +48,7 @@ class N8nTelegramBot:
         self.local_memory = {}
         
         # Инициализация сервисов
-        self.template_service = TemplateService()
+        self.template_service = TemplateService(self.redis_client)
         self.workflow_service = UserWorkflowService()
         self.session_service = UserSessionService()
         self.execution_service = ExecutionLogService()
@@ -59,8 +59,8 @@ class N8nTelegramBot:
         self.reminder_service = ReminderService(self.memory_service)
         self.thinking_service = ThinkingService()
         
-        # Оркестратор агентов
-        self.orchestrator = AgentOrchestrator()
+        # Оркестратор агентов; ThinkingService общий, чтобы лимиты OpenAI считались в одном месте
+        self.orchestrator = AgentOrchestrator(self.thinking_service)
         
         # Состояния пользователей
         self.user_states = {}
@@ -134,13 +134,14 @@ class N8nTelegramBot:
             1. intent (намерение): search_template, import_template, export_template, activate_workflow, 
                deactivate_workflow, list_workflows, get_help, research_info, analyze_data, set_api_key,
                show_stats, get_categories
-            2. entities (сущности): категория, название шаблона, ключевые слова, workflow_id, api_key, base_url
+            2. entities (сущности): категория, название шаблона, ключевые слова, workflow_id
+               (workflow_ids - если workflows несколько), api_key, base_url
             3. confidence (уверенность): 0.0-1.0
             
             Отвечай только в JSON формате:
             {
                 "intent": "название_намерения",
-                "entities": {"category": "категория", "template_name": "название", "keywords": ["слово1", "слово2"], "workflow_id": "id", "api_key": "key", "base_url": "url"},
+                "entities": {"category": "категория", "template_name": "название", "keywords": ["слово1", "слово2"], "workflow_id": "id", "workflow_ids": ["id1", "id2"], "api_key": "key", "base_url": "url"},
                 "confidence": 0.95
             }
             """
@@ -359,6 +360,10 @@ class N8nTelegramBot:
         thinking_msg = await self.show_thinking(update, context, "Получаю список ваших workflows...")
         
         workflows = await self.workflow_service.get_user_workflows(user_id)
+        # Статистика выполнений всех workflows - одним запросом к n8n
+        analytics = await self.workflow_service.get_workflows_analytics(
+            user_id, [workflow['workflow_id'] for workflow in workflows]
+        )
         
         await thinking_msg.delete()
         
@@ -377,6 +382,10 @@ class N8nTelegramBot:
             message += f"{status_emoji} **{workflow['workflow_name']}**\n"
             message += f"   ID: `{workflow['workflow_id']}`\n"
             message += f"   Статус: {workflow['status']}\n"
+            stats = analytics.get(workflow['workflow_id'])
+            if stats and 'error' not in stats:
+                message += (f"   Выполнений (7 дней): {stats['total_executions']}, "
+                            f"успешность {stats['success_rate']:.0f}%\n")
             message += f"   Создан: {workflow['created_at'][:10]}\n\n"
         
         await update.message.reply_text(message, parse_mode='Markdown')
@@ -502,9 +511,30 @@ class N8nTelegramBot:
                 parse_mode='Markdown'
             )
     
+    async def on_startup(self, application: Application):
+        """Загружает кодировщик токенов OpenAI до первого сообщения пользователя"""
+        await self.thinking_service.warm_up()
+    
+    async def on_shutdown(self, application: Application):
+        """Дописывает буфер логов выполнений и счетчики просмотров, закрывает общие HTTP-сессии n8n"""
+        try:
+            await self.execution_service.close()
+        except Exception as e:
+            logger.error(f"Error flushing execution logs on shutdown: {e}")
+        try:
+            await self.template_service.close()
+        except Exception as e:
+            logger.error(f"Error flushing download counters on shutdown: {e}")
+        await close_shared_sessions()
+    
     def run(self):
         """Запуск бота"""
-        application = Application.builder().token(self.telegram_token).build()
+        application = (
+            Application.builder().token(self.telegram_token)
+            .post_init(self.on_startup)
+            .post_shutdown(self.on_shutdown)
+            .build()
+        )
         
         # Регистрация обработчиков
         application.add_handler(CommandHandler("start", self.start_command))
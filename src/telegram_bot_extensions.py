@@ -118,6 +118,15 @@ class TelegramBotExtensions:
     
     async def _format_workflow_action_result(self, result: Dict[str, Any], intent: str, thinking_text: str) -> str:
         """Форматирует результат действий с workflow"""
+        if 'updated' in result:
+            # Пакетная операция: часть workflows могла не примениться
+            action = "Активировано" if intent == 'activate_workflow' else "Деактивировано"
+            emoji = "▶️" if intent == 'activate_workflow' else "⏸️"
+            message = f"{emoji} **{action} workflows: {len(result['updated'])}**\n"
+            for workflow_id, error in result['failed'].items():
+                message += f"❌ `{workflow_id}`: {error}\n"
+            return message + thinking_text
+        
         if result.get('success', False):
             action = "активирован" if intent == 'activate_workflow' else "деактивирован"
             emoji = "▶️" if intent == 'activate_workflow' else "⏸️"
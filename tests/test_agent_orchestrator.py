@@ -37,6 +37,16 @@ class TestAgentOrchestrator:
         assert orchestrator.task_queue is not None
         assert orchestrator.system_metrics is not None
     
+    @pytest.mark.asyncio
+    async def test_shared_thinking_service(self):
+        """Тест: переданный сервис мышления (и его лимиты OpenAI) общий для всех агентов"""
+        thinking_service = ThinkingService()
+        orchestrator = AgentOrchestrator(thinking_service)
+        
+        assert orchestrator.thinking_service is thinking_service
+        assert orchestrator.reflection_engine.thinking_service is thinking_service
+        assert all(agent.thinking_service is thinking_service for agent in orchestrator.agents.values())
+    
     @pytest.mark.asyncio
     async def test_task_submission(self, orchestrator):
         """Тест отправки задачи"""
@@ -141,6 +151,29 @@ class TestTemplateAgent:
             assert len(result['templates']) == 1
             assert 'agent_thoughts' in result
     
+    @pytest.mark.asyncio
+    async def test_concurrent_tasks(self, template_agent):
+        """Тест: агент выполняет несколько задач одновременно и учитывает каждую"""
+        release = asyncio.Event()
+        
+        async def slow_search(*args, **kwargs):
+            await release.wait()
+            return []
+        
+        with patch.object(template_agent.template_service, 'search_templates', side_effect=slow_search):
+            tasks = [{'type': 'search_templates', 'data': {'query': str(i)}} for i in range(2)]
+            running = [asyncio.create_task(template_agent.execute_task(task)) for task in tasks]
+            await asyncio.sleep(0)
+            
+            assert template_agent.current_task is tasks[1]
+            assert template_agent.is_busy is (template_agent.max_concurrency <= 2)
+            release.set()
+            results = await asyncio.gather(*running)
+        
+        assert all(result['success'] for result in results)
+        assert template_agent.current_task is None
+        assert template_agent.is_busy is False
+    
     @pytest.mark.asyncio
     async def test_analyze_template_task(self, template_agent):
         """Тест задачи анализа шаблона"""
@@ -247,6 +280,24 @@ class TestServerAgent:
             assert 'workflow_id' in result
             assert 'agent_thoughts' in result
     
+    @pytest.mark.asyncio
+    async def test_activate_several_workflows_task(self, server_agent):
+        """Тест: несколько workflows из сущностей NLU активируются одной пакетной операцией"""
+        with patch.object(server_agent.workflow_service, 'activate_workflows') as mock_bulk, \
+                patch.object(server_agent.workflow_service, 'activate_workflow') as mock_single:
+            mock_bulk.return_value = {'success': True, 'updated': ['1', '2'], 'failed': {}}
+            
+            task = {
+                'type': 'activate_workflow',
+                'data': {'user_id': 123, 'entities': {'workflow_ids': ['1', 2]}}
+            }
+            
+            result = await server_agent.execute_task(task)
+            
+            assert result['updated'] == ['1', '2']
+            mock_bulk.assert_awaited_once_with(123, ['1', '2'])
+            mock_single.assert_not_called()
+    
     @pytest.mark.asyncio
     async def test_get_workflows_task(self, server_agent):
         """Тест задачи получения workflows"""
@@ -0,0 +1,173 @@
+import pytest
+import asyncio
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from src.services import n8n_api
+from src.services.n8n_api import N8nApiClient, N8nApiError, N8nMonitor, _Throttle
+
+class FakeN8nClient(N8nApiClient):
+    """Клиент, который вместо n8n отдает заранее заданные статусы"""
+    
+    def __init__(self, statuses, response_headers=None, body=b'{"id": "1"}'):
+        super().__init__('http://n8n.test', 'key')
+        self.statuses = list(statuses)
+        self.response_headers = response_headers or {}
+        self.body = body
+        self.sent = []
+        self.request_headers = []
+    
+    async def _send(self, method, endpoint, data, params, headers):
+        self.sent.append(method)
+        self.request_headers.append(headers)
+        return self.statuses.pop(0), self.response_headers, self.body
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    """Повторы без пауз и чистое общее состояние клиентов"""
+    monkeypatch.setattr(n8n_api, 'RETRY_BACKOFF', 0.0)
+    n8n_api._CLIENT_STATES.clear()
+    yield
+    n8n_api._CLIENT_STATES.clear()
+
+class TestRetryRules:
+    """Тесты повторов запросов при перегрузке n8n"""
+    
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize('method', ['GET', 'PUT', 'DELETE'])
+    async def test_idempotent_retried_on_5xx(self, method):
+        """Тест: идемпотентный запрос повторяется на 502/503/504"""
+        client = FakeN8nClient([502, 503, 504, 200])
+        
+        assert await client._make_request(method, '/workflows/1') == {'id': '1'}
+        assert client.sent == [method] * 4
+    
+    @pytest.mark.asyncio
+    async def test_post_not_retried_on_5xx(self):
+        """Тест: POST на 503 не повторяется - n8n мог уже выполнить запрос"""
+        client = FakeN8nClient([503, 200])
+        
+        with pytest.raises(N8nApiError):
+            await client._make_request('POST', '/workflows', data={'name': 'wf'})
+        assert client.sent == ['POST']
+    
+    @pytest.mark.asyncio
+    async def test_post_retried_on_429(self):
+        """Тест: POST на 429 повторяется - запрос не выполнялся"""
+        client = FakeN8nClient([429, 200])
+        
+        assert await client._make_request('POST', '/workflows', data={'name': 'wf'}) == {'id': '1'}
+        assert client.sent == ['POST', 'POST']
+    
+    @pytest.mark.asyncio
+    async def test_retries_limited(self):
+        """Тест: после MAX_RETRIES повторов возвращается ошибка"""
+        client = FakeN8nClient([503] * (n8n_api.MAX_RETRIES + 1))
+        
+        with pytest.raises(N8nApiError):
+            await client._make_request('GET', '/workflows')
+        assert len(client.sent) == n8n_api.MAX_RETRIES + 1
+        assert client._state().throttle.in_flight == 0
+
+class TestThrottle:
+    """Тесты ограничителя параллельных запросов"""
+    
+    @pytest.mark.asyncio
+    async def test_window_limits_concurrency(self):
+        """Тест: в работе не больше limit запросов, слот освобождается release"""
+        throttle = _Throttle(initial=1)
+        await throttle.acquire()
+        waiter = asyncio.create_task(throttle.acquire())
+        await asyncio.sleep(0)
+        
+        assert not waiter.done()
+        await throttle.release()
+        await asyncio.wait_for(waiter, 1)
+        assert throttle.in_flight == 1
+    
+    @pytest.mark.asyncio
+    async def test_cancelled_rate_wait_frees_slot(self):
+        """Тест: отмена ожидания минутного лимита не оставляет занятый слот"""
+        throttle = _Throttle(initial=2, rpm=1)
+        await throttle.acquire()
+        await throttle.release()
+        waiter = asyncio.create_task(throttle.acquire())
+        await asyncio.sleep(0)
+        
+        assert throttle.in_flight == 1
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert throttle.in_flight == 0
+    
+    def test_aimd_window(self):
+        """Тест: окно растет на alpha после быстрых ответов и уменьшается в beta раз при перегрузке"""
+        throttle = _Throttle(initial=8, c_max=9)
+        throttle.on_success(0.1, {'X-RateLimit-Limit': '120'})
+        throttle.on_success(0.1, {})
+        
+        assert throttle.limit == 9
+        assert throttle.rpm == 120
+        throttle.on_overload()
+        throttle.on_success(5.0, {})
+        assert throttle.limit == 4.5
+        throttle.on_success(0.1, {'X-RateLimit-Remaining': '0'})
+        assert throttle.limit == 2.25
+
+class TestSharedClientState:
+    """Тесты состояния, общего для клиентов одного n8n и ключа"""
+    
+    @pytest.mark.asyncio
+    async def test_etag_cache_outlives_client(self):
+        """Тест: новый клиент для того же n8n и ключа отправляет условный запрос"""
+        first = FakeN8nClient([200], response_headers={'ETag': '"v1"'}, body=b'{"data": [{"id": "1"}]}')
+        second = FakeN8nClient([304])
+        other_key = FakeN8nClient([200])
+        other_key.api_key = 'other'
+        
+        workflows = await first.get_workflows()
+        
+        assert await second.get_workflows() == workflows == [{'id': '1'}]
+        assert second.request_headers == [{'If-None-Match': '"v1"'}]
+        assert second._state().throttle is first._state().throttle
+        await other_key.get_workflows()
+        assert other_key.request_headers == [None]
+    
+    @pytest.mark.asyncio
+    async def test_analytics_cache_shared_and_invalidated_by_writes(self):
+        """Тест: аналитика кэшируется между мониторами и сбрасывается записью через другой клиент"""
+        executions = b'{"data": [{"startedAt": "2999-01-01T00:00:00.000Z", "finished": true}]}'
+        first = FakeN8nClient([200], body=executions)
+        second = FakeN8nClient([])
+        writer = FakeN8nClient([200])
+        
+        analytics = await N8nMonitor(first).get_workflow_analytics('1')
+        
+        assert await N8nMonitor(second).get_workflow_analytics('1') is analytics
+        assert second.sent == []
+        await writer.activate_workflow('1')
+        assert n8n_api._client_state('http://n8n.test', 'key', None).analytics_cache == {}
+    
+    @pytest.mark.asyncio
+    async def test_bulk_analytics_single_request(self):
+        """Тест: аналитика нескольких workflows собирается из одного запроса /executions"""
+        executions = (
+            b'{"data": ['
+            b'{"workflowId": 1, "startedAt": "2999-01-01T00:00:00.000Z", "finished": true},'
+            b'{"workflowId": 1, "startedAt": "2999-01-01T00:00:00.000Z",'
+            b' "stoppedAt": "2999-01-01T00:00:02.000Z"},'
+            b'{"workflowId": 2, "startedAt": "2000-01-01T00:00:00.000Z", "finished": true}'
+            b']}'
+        )
+        client = FakeN8nClient([200], body=executions)
+        
+        analytics = await N8nMonitor(client).get_workflow_analytics_bulk(['1', '2'])
+        
+        assert client.sent == ['GET']
+        assert analytics['1']['total_executions'] == 2
+        assert analytics['1']['success_rate'] == 50
+        assert analytics['1']['average_duration_seconds'] == 2
+        assert analytics['2']['total_executions'] == 0
+
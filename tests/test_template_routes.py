@@ -0,0 +1,239 @@
+import pytest
+import orjson
+from datetime import datetime, timedelta
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from flask import Flask
+from src.models.template import db, Template, ExecutionLog
+from src.routes import template as template_routes
+from src.routes.template import template_bp
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """Приложение с blueprint шаблонов на отдельной SQLite-базе"""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path / 'app.db'}"
+    db.init_app(app)
+    app.register_blueprint(template_bp, url_prefix='/api')
+    with app.app_context():
+        db.create_all()
+    
+    # Фоновый поток сброса не запускаем: буфер сбрасывается в тестах явно
+    monkeypatch.setattr(template_routes, '_ensure_flush_thread', lambda: None)
+    template_routes._exec_buffer.clear()
+    yield app
+    template_routes._exec_buffer.clear()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def templates(app):
+    """25 активных шаблонов; у пар шаблонов одинаковый updated_at, порядок решает id"""
+    base = datetime(2024, 1, 1)
+    with app.app_context():
+        for index in range(25):
+            db.session.add(Template(
+                name=f'Template {index}', description='Email automation', category='Email',
+                updated_at=base + timedelta(minutes=index // 2)
+            ))
+        db.session.commit()
+        return [template.id for template in db.session.execute(
+            db.select(Template).order_by(Template.updated_at.desc(), Template.id.desc())
+        ).scalars()]
+
+def _log_row(**overrides):
+    row = {
+        'user_id': 1, 'workflow_id': 'wf', 'execution_id': 'ex', 'status': 'success',
+        'start_time': None, 'end_time': None, 'duration': 1.5, 'error_message': None,
+        'created_at': datetime.utcnow()
+    }
+    row.update(overrides)
+    return row
+
+class TestExecutionLogs:
+    """Тесты записи логов выполнений"""
+    
+    def test_log_execution_returns_row(self, client):
+        """Тест: 202 с данными записи в том виде, в каком она будет сохранена"""
+        response = client.post('/api/executions', json={
+            'user_id': '7', 'workflow_id': 'wf', 'status': 'success',
+            'start_time': '2024-01-01T10:00:00Z', 'duration': '2.5'
+        })
+        
+        assert response.status_code == 202
+        data = response.get_json()['data']
+        assert data['id'] is None
+        assert data['start_time'] == '2024-01-01T10:00:00'
+        assert data['duration'] == 2.5
+        assert len(template_routes._exec_buffer) == 1
+    
+    @pytest.mark.parametrize('payload', [
+        {'workflow_id': 'wf'},
+        {'user_id': 'abc'},
+        {'user_id': 1, 'duration': 'abc'},
+        {'user_id': 1, 'duration': float('inf')},
+        {'user_id': 1, 'start_time': 'yesterday'},
+        {'user_id': 1, 'status': 'x' * 51},
+    ])
+    def test_log_execution_rejects_invalid(self, client, payload):
+        """Тест: невалидные поля отклоняются до постановки в очередь"""
+        response = client.post('/api/executions', json=payload)
+        
+        assert response.status_code == 400
+        assert not template_routes._exec_buffer
+    
+    def test_flush_keeps_valid_rows_of_failed_batch(self, app):
+        """Тест: строка, которую не приняла БД, не уносит с собой остальную пачку"""
+        template_routes._exec_buffer.extend([
+            _log_row(execution_id='a'),
+            _log_row(execution_id='bad', user_id=None),
+            _log_row(execution_id='c'),
+        ])
+        
+        with app.app_context():
+            written = template_routes.flush_execution_logs()
+            stored = db.session.execute(db.select(ExecutionLog.execution_id)).scalars().all()
+        
+        assert written == 2
+        assert sorted(stored) == ['a', 'c']
+        assert not template_routes._exec_buffer
+
+
+class TestTemplatePagination:
+    """Тесты keyset-пагинации /templates"""
+    
+    def test_cursor_round_trip_covers_all_rows_once(self, client, templates):
+        """Тест: проход по next_cursor отдает все строки ровно один раз и по порядку"""
+        seen = []
+        url = '/api/templates?limit=7'
+        while True:
+            body = client.get(url).get_json()
+            assert body['success'] is True
+            seen.extend(item['id'] for item in body['data'])
+            if not body['next_cursor']:
+                break
+            url = f"/api/templates?limit=7&cursor={body['next_cursor']}"
+        
+        assert seen == templates
+    
+    @pytest.mark.parametrize('limit, clamped, rows', [('0', 1, 1), ('-5', 1, 1), ('3', 3, 3), ('100000', 500, 25)])
+    def test_limit_is_clamped(self, client, templates, limit, clamped, rows):
+        """Тест: limit вне диапазона приводится к границам, ответ - корректный JSON"""
+        response = client.get(f'/api/templates?limit={limit}')
+        
+        body = response.get_json()
+        assert response.status_code == 200
+        assert body['limit'] == clamped
+        assert len(body['data']) == rows
+    
+    @pytest.mark.parametrize('query', ['limit=abc', 'cursor=garbage', 'offset=-1', 'offset=x'])
+    def test_bad_parameters_are_rejected(self, client, templates, query):
+        """Тест: невалидные параметры - 400 до начала потоковой выдачи"""
+        response = client.get(f'/api/templates?{query}')
+        
+        assert response.status_code == 400
+        assert response.get_json()['success'] is False
+    
+    def test_offset_compatibility(self, client, templates):
+        """Тест: ?offset= работает как раньше и возвращает total и offset"""
+        body = client.get('/api/templates?limit=5&offset=10').get_json()
+        
+        assert [item['id'] for item in body['data']] == templates[10:15]
+        assert body['total'] == 25
+        assert body['offset'] == 10
+    
+    def test_total_only_on_request(self, client, templates):
+        """Тест: total без offset считается только с include_total=1"""
+        assert 'total' not in client.get('/api/templates').get_json()
+        assert client.get('/api/templates?include_total=1').get_json()['total'] == 25
+    
+    @pytest.mark.parametrize('url', ['/api/templates/popular?limit=0', '/api/executions?limit=-1'])
+    def test_other_lists_clamp_limit(self, client, templates, url):
+        """Тест: limit <= 0 в других списках не превращается в LIMIT без ограничения"""
+        response = client.get(url)
+        
+        assert response.status_code == 200
+        assert len(response.get_json()['data']) <= 1
+
+
+class TestStreamingErrors:
+    """Тесты ошибок потоковой выдачи списков"""
+    
+    def test_query_error_before_streaming_is_500(self, app, client, templates):
+        """Тест: ошибка запроса к БД возвращается как JSON 500, а не как обрезанный 200"""
+        with app.app_context():
+            db.session.execute(db.text('DROP TABLE templates_fts'))
+            db.session.commit()
+        
+        response = client.get('/api/templates?keywords=email')
+        
+        assert response.status_code == 500
+        assert response.get_json()['success'] is False
+    
+    def test_error_during_streaming_keeps_json_well_formed(self, client, templates, monkeypatch):
+        """Тест: сбой посреди выдачи завершает ответ корректным JSON с ошибкой"""
+        to_dict = Template.to_dict
+        calls = []
+        
+        def failing_to_dict(self, raw=False):
+            calls.append(self.id)
+            if len(calls) == 3:
+                raise RuntimeError('row failed')
+            return to_dict(self, raw)
+        
+        monkeypatch.setattr(Template, 'to_dict', failing_to_dict)
+        response = client.get('/api/templates?limit=10')
+        
+        body = orjson.loads(response.get_data())
+        assert response.status_code == 200
+        assert body['success'] is False
+        assert body['error'] == 'row failed'
+        assert len(body['data']) == 2
+
+class TestTemplateEtag:
+    """Тесты условных запросов /templates/<id>"""
+    
+    def test_etag_and_not_modified(self, client, templates):
+        """Тест: слабый ETag в ответе, совпадающий If-None-Match дает 304"""
+        url = f'/api/templates/{templates[0]}'
+        first = client.get(url)
+        etag = first.headers['ETag']
+        
+        assert first.status_code == 200
+        assert etag.startswith('W/')
+        assert first.get_json()['data']['download_count'] == 1
+        
+        cached = client.get(url, headers={'If-None-Match': etag})
+        assert cached.status_code == 304
+        assert cached.get_data() == b''
+        assert cached.headers['ETag'] == etag
+        assert client.get(url).get_json()['data']['download_count'] == 3
+    
+    def test_strong_form_matches(self, client, templates):
+        """Тест: сильная форма того же ETag тоже дает 304"""
+        url = f'/api/templates/{templates[0]}'
+        etag = client.get(url).headers['ETag']
+        
+        assert client.get(url, headers={'If-None-Match': etag[2:]}).status_code == 304
+    
+    def test_changed_template_gets_new_etag(self, app, client, templates):
+        """Тест: после изменения шаблона старый ETag не совпадает и отдается 200"""
+        url = f'/api/templates/{templates[0]}'
+        etag = client.get(url).headers['ETag']
+        with app.app_context():
+            template = db.session.get(Template, templates[0])
+            template.updated_at = template.updated_at + timedelta(hours=1)
+            db.session.commit()
+        
+        response = client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+    
+    def test_missing_template(self, client, templates):
+        """Тест: несуществующий шаблон - 404"""
+        assert client.get('/api/templates/999999').status_code == 404
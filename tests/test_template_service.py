@@ -0,0 +1,358 @@
+import pytest
+from datetime import datetime
+from unittest.mock import AsyncMock, patch
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from flask import Flask
+from cryptography.exceptions import InvalidTag
+from src.models.template import (
+    db, Template, ExecutionLog, UserSession,
+    API_KEY_CIPHER_PREFIX, upgrade_schema,
+)
+from src.services.n8n_api import N8nApiClient, N8nMonitor, close_shared_sessions
+from src.services import template_service
+from src.services.template_service import TemplateService, ExecutionLogService, UserWorkflowService
+
+# Схема БД до перехода на FTS5, BLOB и новые индексы (как у уже развернутых экземпляров)
+LEGACY_SCHEMA = (
+    """CREATE TABLE templates (
+        id INTEGER NOT NULL, name VARCHAR(255) NOT NULL, description TEXT,
+        category VARCHAR(100) NOT NULL, complexity VARCHAR(50), json_content TEXT,
+        download_url VARCHAR(500), author VARCHAR(100), tags TEXT, nodes_used TEXT,
+        created_at DATETIME, updated_at DATETIME, is_active BOOLEAN,
+        download_count INTEGER, rating FLOAT, PRIMARY KEY (id)
+    )""",
+    "CREATE INDEX ix_templates_name ON templates (name)",
+    "CREATE INDEX ix_templates_category ON templates (category)",
+    "CREATE INDEX ix_tpl_active_cat ON templates (is_active, category)",
+    """CREATE TABLE user_workflows (
+        id INTEGER NOT NULL, user_id BIGINT NOT NULL, workflow_id VARCHAR(100) NOT NULL,
+        template_id INTEGER, workflow_name VARCHAR(255), status VARCHAR(50),
+        created_at DATETIME, last_execution DATETIME, execution_count INTEGER,
+        error_count INTEGER, PRIMARY KEY (id), FOREIGN KEY(template_id) REFERENCES templates (id)
+    )""",
+    "CREATE INDEX ix_user_workflows_user_id ON user_workflows (user_id)",
+)
+
+@pytest.fixture
+def app(tmp_path):
+    """Приложение на отдельной SQLite-базе с открытым app context"""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path / 'app.db'}"
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+
+@pytest.fixture
+def legacy_app(tmp_path):
+    """Приложение на БД со старой схемой и данными, после старта (create_all + миграция)"""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path / 'legacy.db'}"
+    db.init_app(app)
+    with app.app_context():
+        with db.engine.begin() as connection:
+            for statement in LEGACY_SCHEMA:
+                connection.execute(db.text(statement))
+            connection.execute(db.text(
+                "INSERT INTO templates (id, name, description, category, json_content, tags, "
+                "created_at, updated_at, is_active, download_count, rating) VALUES "
+                "(1, 'Gmail to Slack', 'Forward email', 'Email', '{\"nodes\": []}', '[\"gmail\"]', "
+                "'2024-01-01 00:00:00', '2024-01-01 00:00:00', 1, 5, 0), "
+                "(2, 'Gmail to Slack', 'Duplicate', 'Email', NULL, '[]', "
+                "'2024-01-02 00:00:00', '2024-01-02 00:00:00', 1, 3, 0), "
+                "(3, 'Telegram bot', 'Chat automation', 'Chat', NULL, '[]', "
+                "'2024-01-03 00:00:00', '2024-01-03 00:00:00', 1, 1, 0)"
+            ))
+            connection.execute(db.text(
+                "INSERT INTO user_workflows (id, user_id, workflow_id, template_id, status) VALUES "
+                "(1, 7, 'wf1', 2, 'inactive'), (2, 7, 'wf1', 2, 'active'), (3, 8, 'wf2', 1, 'inactive')"
+            ))
+        
+        db.create_all()
+        upgrade_schema()
+        yield app
+
+class TestSchemaUpgrade:
+    """Тесты миграции уже развернутой БД"""
+    
+    def test_fts_index_built_for_existing_rows(self, legacy_app):
+        """Тест: FTS-индекс создается и заполняется существующими шаблонами"""
+        found = Template.search_by_keywords(['telegram'])
+        
+        assert [template.name for template in found] == ['Telegram bot']
+    
+    def test_fts_index_follows_changes(self, legacy_app):
+        """Тест: триггеры синхронизируют индекс при вставке и изменении"""
+        db.session.add(Template(name='Notion sync', description='Database sync', category='Data'))
+        template = db.session.get(Template, 3)
+        template.description = 'Messenger automation'
+        db.session.commit()
+        
+        assert [t.name for t in Template.search_by_keywords(['notion'])] == ['Notion sync']
+        assert Template.search_by_keywords(['chat']) == []
+        assert [t.name for t in Template.search_by_keywords(['messeng'])] == ['Telegram bot']
+    
+    def test_json_content_converted_to_blob(self, legacy_app):
+        """Тест: старый TEXT json_content хранится как BLOB и читается байтами"""
+        storage = db.session.execute(db.text(
+            "SELECT typeof(json_content) FROM templates WHERE id = 1"
+        )).scalar()
+        
+        assert storage == 'blob'
+        assert db.session.get(Template, 1).json_content == b'{"nodes": []}'
+    
+    def test_model_indexes_created(self, legacy_app):
+        """Тест: недостающие индексы созданы, из дублей workflow осталась последняя запись"""
+        inspector = db.inspect(db.engine)
+        template_indexes = {index['name'] for index in inspector.get_indexes('templates')}
+        workflow_indexes = {index['name']: index for index in inspector.get_indexes('user_workflows')}
+        workflows = db.session.execute(db.text(
+            "SELECT id, status FROM user_workflows ORDER BY id"
+        )).all()
+        
+        assert {'ix_tpl_active_cat_dlc', 'ix_tpl_active_popular', 'ix_tpl_active_updated'} <= template_indexes
+        assert 'ix_tpl_active_cat' not in template_indexes
+        assert workflow_indexes['ix_uw_user_wf']['unique']
+        assert workflows == [(2, 'active'), (3, 'inactive')]
+    
+    def test_duplicate_names_merged_into_unique_index(self, legacy_app):
+        """Тест: дубли имени объединены в первый шаблон, индекс по имени уникален"""
+        indexes = {index['name']: index for index in db.inspect(db.engine).get_indexes('templates')}
+        templates = db.session.execute(db.text(
+            "SELECT id, name, download_count FROM templates ORDER BY id"
+        )).all()
+        template_ids = db.session.execute(db.text(
+            "SELECT template_id FROM user_workflows ORDER BY id"
+        )).scalars().all()
+        
+        assert indexes['ix_templates_name']['unique']
+        assert templates == [(1, 'Gmail to Slack', 8), (3, 'Telegram bot', 1)]
+        assert template_ids == [1, 1]
+        assert [t.name for t in Template.search_by_keywords(['slack'])] == ['Gmail to Slack']
+    
+    @pytest.mark.asyncio
+    async def test_import_skips_existing_name(self, legacy_app):
+        """Тест: импорт через ON CONFLICT(name) работает на мигрированной БД"""
+        service = TemplateService()
+        
+        assert await service.import_template_to_database({'name': 'Gmail to Slack'}) is False
+        assert await service.import_template_to_database({'name': 'Notion sync', 'tags': ['notion']}) is True
+        assert db.session.execute(db.text("SELECT COUNT(*) FROM templates")).scalar() == 3
+    
+    @pytest.mark.asyncio
+    async def test_import_without_name(self, legacy_app):
+        """Тест: шаблон без имени импортируется как 'Unknown Template' и сбрасывает кэш"""
+        service = TemplateService()
+        version = TemplateService._cache_version
+        
+        assert await service.import_template_to_database({'description': 'no name'}) is True
+        assert TemplateService._cache_version == version + 1
+        assert await service.import_template_to_database({}) is False
+    
+    def test_upgrade_is_idempotent(self, legacy_app):
+        """Тест: повторный запуск миграции ничего не ломает и не дублирует индекс"""
+        upgrade_schema()
+        
+        assert len(Template.search_by_keywords(['telegram'])) == 1
+
+class TestTemplateSearch:
+    """Тесты поиска шаблонов"""
+    
+    @pytest.mark.asyncio
+    async def test_search_templates_uses_fts(self, app):
+        """Тест: поиск по нескольким словам и по префиксу через FTS"""
+        db.session.add_all([
+            Template(name='Gmail to Slack', description='Forward "important" email', category='Email',
+                     tags='["gmail", "slack"]', download_count=2),
+            Template(name='Slack digest', description='Daily summary', category='Chat', download_count=5),
+            Template(name='Inactive slack', category='Chat', is_active=False),
+        ])
+        db.session.commit()
+        service = TemplateService()
+        
+        assert [t['name'] for t in await service.search_templates('slack')] == ['Slack digest', 'Gmail to Slack']
+        assert [t['name'] for t in await service.search_templates('slack gma')] == ['Gmail to Slack']
+        assert [t['name'] for t in await service.search_templates('"important')] == ['Gmail to Slack']
+        assert await service.search_templates('slack', category='Email', limit=1) == [
+            t for t in await service.search_templates('gmail')
+        ]
+
+class FakeRedis:
+    """Минимальный redis-клиент для счетчиков просмотров"""
+    
+    def __init__(self):
+        self.values = {}
+    
+    def incr(self, key):
+        return self.incrby(key, 1)
+    
+    def incrby(self, key, amount):
+        self.values[key] = self.values.get(key, 0) + amount
+        return self.values[key]
+    
+    def getset(self, key, value):
+        old, self.values[key] = self.values.get(key), value
+        return old
+    
+    def scan_iter(self, match):
+        return [key for key in list(self.values) if key.startswith(match.rstrip('*').split('*')[0])]
+
+class TestDownloadCounters:
+    """Тесты счетчиков просмотров шаблонов в Redis"""
+    
+    @pytest.mark.asyncio
+    async def test_views_flushed_on_close(self, app):
+        """Тест: просмотры копятся в Redis, а close() переносит их в БД и снимает фоновый сброс"""
+        db.session.add(Template(name='Gmail to Slack', category='Email', download_count=5))
+        db.session.commit()
+        service = TemplateService(FakeRedis())
+        
+        first = await service.get_template_by_id(1)
+        second = await service.get_template_by_id(1)
+        stored_before_close = db.session.execute(db.text("SELECT download_count FROM templates")).scalar()
+        flusher = service._download_flush_task
+        await service.close()
+        
+        assert (first['download_count'], second['download_count']) == (6, 7)
+        assert stored_before_close == 5
+        assert db.session.execute(db.text("SELECT download_count FROM templates")).scalar() == 7
+        assert service.redis_client.values == {'template:1:dl': 0}
+        assert flusher.cancelled()
+
+class TestExecutionLogService:
+    """Тесты буфера логов выполнений"""
+    
+    @pytest.mark.asyncio
+    async def test_invalid_execution_is_rejected(self, app):
+        """Тест: невалидная запись не попадает в буфер"""
+        service = ExecutionLogService()
+        
+        assert await service.log_execution(1, 'wf', {'duration': 'abc'}) is False
+        assert service._buffer == []
+    
+    @pytest.mark.asyncio
+    async def test_flush_keeps_valid_rows_of_failed_batch(self, app):
+        """Тест: строка, которую не приняла БД, не уносит с собой остальную пачку"""
+        service = ExecutionLogService()
+        for execution_id in ('a', 'b'):
+            assert await service.log_execution(1, 'wf', {'execution_id': execution_id, 'duration': 1})
+        # Строка в обход проверки, которую БД отвергнет (user_id NOT NULL)
+        service._buffer.insert(1, {'user_id': None, 'execution_id': 'bad', 'created_at': datetime.utcnow()})
+        
+        written = await service.flush()
+        
+        stored = db.session.execute(db.select(ExecutionLog.execution_id)).scalars().all()
+        assert written == 2
+        assert sorted(stored) == ['a', 'b']
+        await service.close()
+    
+    @pytest.mark.asyncio
+    async def test_close_flushes_buffer(self, app):
+        """Тест: close() останавливает фоновый сброс и дописывает остаток буфера"""
+        service = ExecutionLogService()
+        await service.log_execution(1, 'wf', {'execution_id': 'last'})
+        
+        await service.close()
+        
+        assert service._flush_task is None
+        stored = db.session.execute(db.select(ExecutionLog.execution_id)).scalars().all()
+        assert stored == ['last']
+
+class TestWorkflowAnalytics:
+    """Тесты аналитики workflows пользователя"""
+    
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize('days, method', [
+        (7, 'get_workflow_analytics'),
+        (30, 'get_workflow_analytics_large'),
+    ])
+    async def test_long_period_uses_full_history(self, days, method):
+        """Тест: длинный период считается по всей истории выполнений"""
+        service = UserWorkflowService()
+        client = N8nApiClient('http://n8n.test', 'key')
+        analytics = AsyncMock(return_value={'workflow_id': 'wf'})
+        
+        with patch.object(service, 'get_user_n8n_client', AsyncMock(return_value=client)), \
+                patch.object(N8nMonitor, method, analytics):
+            result = await service.get_workflow_analytics(7, 'wf', days)
+        await close_shared_sessions()
+        
+        assert result == {'success': True, 'data': {'workflow_id': 'wf'}}
+        analytics.assert_awaited_once_with('wf', days)
+
+class TestUserSessionApiKey:
+    """Тесты шифрования API ключа n8n"""
+    
+    @pytest.fixture(autouse=True)
+    def secret(self, monkeypatch):
+        monkeypatch.setenv('N8N_KEY_SECRET', 'test-secret')
+    
+    def test_round_trip(self):
+        """Тест: ключ хранится зашифрованным и расшифровывается обратно"""
+        session = UserSession(user_id=7)
+        session.set_n8n_api_key('n8n-key')
+        first = session.n8n_api_key
+        session.set_n8n_api_key('n8n-key')
+        
+        assert first.startswith(API_KEY_CIPHER_PREFIX)
+        assert 'n8n-key' not in first
+        assert session.n8n_api_key != first
+        assert session.get_n8n_api_key() == 'n8n-key'
+    
+    def test_value_bound_to_user(self):
+        """Тест: значение из сессии другого пользователя не расшифровывается"""
+        session = UserSession(user_id=7)
+        session.set_n8n_api_key('n8n-key')
+        stolen = UserSession(user_id=8, n8n_api_key=session.n8n_api_key)
+        
+        with pytest.raises(InvalidTag):
+            stolen.get_n8n_api_key()
+    
+    def test_legacy_plaintext_and_empty(self):
+        """Тест: старый ключ в открытом виде и пустое значение отдаются как есть"""
+        session = UserSession(user_id=7, n8n_api_key='legacy-key')
+        
+        assert session.get_n8n_api_key() == 'legacy-key'
+        session.set_n8n_api_key('')
+        assert session.n8n_api_key is None
+        assert session.get_n8n_api_key() is None
+    
+    def test_missing_secret(self, monkeypatch):
+        """Тест: без секрета ключ не сохраняется в открытом виде"""
+        monkeypatch.delenv('N8N_KEY_SECRET')
+        monkeypatch.delenv('FLASK_SECRET_KEY', raising=False)
+        session = UserSession(user_id=7)
+        
+        with pytest.raises(RuntimeError):
+            session.set_n8n_api_key('n8n-key')
+    
+    @pytest.mark.asyncio
+    async def test_cached_credentials_follow_db_changes(self, app, monkeypatch):
+        """Тест: смена ключа в БД другим процессом видна клиенту без ожидания TTL"""
+        template_service._user_credentials.clear()
+        session = UserSession(user_id=7, n8n_base_url='http://n8n.test')
+        session.set_n8n_api_key('old-key')
+        db.session.add(session)
+        db.session.commit()
+        loads = []
+        active_session = template_service._active_user_session
+        monkeypatch.setattr(template_service, '_active_user_session',
+                            lambda user_id: loads.append(user_id) or active_session(user_id))
+        service = UserWorkflowService()
+        
+        assert (await service.get_user_n8n_client(7)).api_key == 'old-key'
+        assert (await service.get_user_n8n_client(7)).api_key == 'old-key'
+        assert loads == [7]
+        
+        # Как маршрут /user-session во Flask-процессе: запись мимо кэша бота
+        session.set_n8n_api_key('new-key')
+        session.updated_at = datetime(2030, 1, 1)
+        db.session.commit()
+        
+        assert (await service.get_user_n8n_client(7)).api_key == 'new-key'
+        assert loads == [7, 7]
+        template_service._user_credentials.clear()
@@ -0,0 +1,148 @@
+import pytest
+import asyncio
+import threading
+from unittest.mock import patch
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from src.services import thinking_service as thinking_module
+from src.services.thinking_service import ThinkingService, ThinkingType, ThoughtLevel
+
+@pytest.fixture
+def thinking_service():
+    """Сервис мышления с моделью-заглушкой: каждый запрос возвращает новый семпл"""
+    service = ThinkingService()
+    calls = []
+    
+    async def fake_complete(system_prompt, user_content, temperature, **kwargs):
+        sample = f"sample-{len(calls)}"
+        calls.append(user_content)
+        await asyncio.sleep(0.01)
+        return sample
+    
+    service._complete = fake_complete
+    service.calls = calls
+    return service
+
+class TestThoughtResponseCache:
+    """Тесты кэша и объединения запросов мыслей"""
+    
+    @pytest.mark.asyncio
+    async def test_agents_get_independent_thoughts(self, thinking_service):
+        """Тест: агенты с одним контекстом получают разные ответы модели"""
+        thoughts = await asyncio.gather(*(
+            thinking_service.think(agent, {'problem': 'p'}, ThinkingType.PROBLEM_SOLVING)
+            for agent in ('a', 'b', 'c')
+        ))
+        
+        assert len(thinking_service.calls) == 3
+        assert len({thought['content'] for thought in thoughts}) == 3
+    
+    @pytest.mark.asyncio
+    async def test_concurrent_repeats_share_one_request(self, thinking_service):
+        """Тест: одновременные повторы запроса одного агента уходят в модель один раз"""
+        thoughts = await asyncio.gather(*(
+            thinking_service.think('a', {'problem': 'p'}, ThinkingType.ANALYSIS)
+            for _ in range(3)
+        ))
+        
+        assert len(thinking_service.calls) == 1
+        assert {thought['content'] for thought in thoughts} == {'sample-0'}
+        assert thinking_service._pending_responses == {}
+    
+    @pytest.mark.asyncio
+    async def test_repeat_is_served_from_cache(self, thinking_service):
+        """Тест: повтор с тем же контекстом (в другом порядке ключей) берется из кэша"""
+        await thinking_service.think('a', {'x': 1, 'y': 2}, ThinkingType.ANALYSIS)
+        thought = await thinking_service.think('a', {'y': 2, 'x': 1}, ThinkingType.ANALYSIS)
+        
+        assert len(thinking_service.calls) == 1
+        assert thought['content'] == 'sample-0'
+    
+    @pytest.mark.asyncio
+    async def test_cache_key_includes_type_and_level(self, thinking_service):
+        """Тест: другой тип или уровень мышления - другой запрос"""
+        await thinking_service.think('a', {'x': 1}, ThinkingType.ANALYSIS)
+        await thinking_service.think('a', {'x': 1}, ThinkingType.PLANNING)
+        with patch.object(thinking_service, '_reflect_on_thought', return_value={}):
+            await thinking_service.think('a', {'x': 1}, ThinkingType.ANALYSIS, ThoughtLevel.DEEP)
+        
+        assert len(thinking_service.calls) == 3
+    
+    @pytest.mark.asyncio
+    async def test_failed_request_is_not_cached(self, thinking_service):
+        """Тест: ошибка модели не кэшируется"""
+        async def failing_complete(*args, **kwargs):
+            raise RuntimeError('boom')
+        
+        complete = thinking_service._complete
+        thinking_service._complete = failing_complete
+        failed = await thinking_service.think('a', {'x': 1}, ThinkingType.ANALYSIS)
+        thinking_service._complete = complete
+        thought = await thinking_service.think('a', {'x': 1}, ThinkingType.ANALYSIS)
+        
+        assert failed['success'] is False
+        assert thought['success'] is True
+
+class TestReflectionBackfill:
+    """Тесты пакетной рефлексии над историей мыслей"""
+    
+    @pytest.mark.asyncio
+    async def test_backfill_reflects_thoughts_without_reflection(self, thinking_service):
+        """Тест: в пакет попадают только успешные мысли без рефлексии, результат пишется в мысль"""
+        for index in range(3):
+            await thinking_service.think('a', {'n': index}, ThinkingType.ANALYSIS)
+        history = [item['thought'] for item in thinking_service.thinking_history['a']]
+        history[0]['reflection'] = {'quality_score': 0.1}
+        history[1]['success'] = False
+        
+        async def fake_reflect_bulk(thoughts):
+            return [{'quality_score': 0.9} for _ in thoughts]
+        
+        with patch.object(thinking_service, 'reflect_bulk', side_effect=fake_reflect_bulk) as bulk:
+            assert await thinking_service.backfill_reflections(min_thoughts=2) == 0
+            assert await thinking_service.backfill_reflections(min_thoughts=1) == 1
+        
+        bulk.assert_awaited_once_with([history[2]])
+        assert history[2]['reflection'] == {'quality_score': 0.9}
+        assert 'reflection' not in history[1]
+
+class TestTokenEncoder:
+    """Тесты загрузки кодировщика токенов"""
+    
+    @pytest.fixture
+    def fake_tiktoken(self, monkeypatch):
+        """tiktoken-заглушка, запоминающая поток, в котором загружается кодировщик"""
+        loads = []
+        
+        class FakeEncoder:
+            def encode(self, text):
+                return text.split()
+        
+        class FakeTiktoken:
+            @staticmethod
+            def encoding_for_model(model):
+                loads.append(threading.current_thread())
+                return FakeEncoder()
+        
+        monkeypatch.setattr(thinking_module, 'tiktoken', FakeTiktoken)
+        thinking_module._token_encoder.cache_clear()
+        yield loads
+        thinking_module._token_encoder.cache_clear()
+    
+    @pytest.mark.asyncio
+    async def test_warm_up_loads_encoder_off_loop(self, fake_tiktoken):
+        """Тест: кодировщик загружается один раз и не в потоке event loop"""
+        service = ThinkingService()
+        
+        await service.warm_up()
+        await service.warm_up()
+        
+        assert len(fake_tiktoken) == 1
+        assert fake_tiktoken[0] is not threading.current_thread()
+        assert thinking_module._count_tokens('three short words') == 3
+